@@ -2,25 +2,96 @@ from __future__ import annotations
 
 import json
 import sys
+import time
 import traceback
-from datetime import datetime
+import zlib
+from datetime import datetime, timedelta
+from typing import TYPE_CHECKING
 
 from agent.server import Server
+from agent.utils import run_concurrently
+
+if TYPE_CHECKING:
+    from agent.bench import Bench
+    from agent.site import Site
+
+# Runs every hour, every site is collected once a day in the hour it hashes to
+ANALYTICS_INTERVAL = timedelta(hours=23)
+# Sites missed in their hour, e.g. while the cron only ran daily, are collected in the next run
+ANALYTICS_OVERDUE = timedelta(days=2)
+ANALYTICS_SITES_PER_PROCESS = 10
+
+
+def get_site_hour(site: str) -> int:
+    return zlib.crc32(site.encode()) % 24
+
+
+def read_analytics(site: Site) -> dict:
+    try:
+        with open(site.analytics_file) as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def is_due(site: Site, previous: dict, now: datetime) -> bool:
+    if not previous.get("timestamp"):
+        return True
+    age = now - datetime.fromisoformat(previous["timestamp"])
+    if age >= ANALYTICS_OVERDUE:
+        return True
+    return age >= ANALYTICS_INTERVAL and now.hour == get_site_hour(site.name)
+
+
+def get_due_sites(bench: Bench, now: datetime) -> list[Site]:
+    return [site for site in bench.sites.values() if is_due(site, read_analytics(site), now)]
+
+
+def collect_analytics(bench: Bench, sites: list[Site]):
+    start = time.monotonic()
+    timestamp = str(datetime.utcnow())
+    try:
+        analytics = bench.get_sites_analytics([site.name for site in sites])
+    except Exception:
+        print(f"ERROR [{bench.name}:{timestamp}]: {traceback.format_exc()}", file=sys.stderr)
+        return
+
+    for site in sites:
+        result = analytics.get(site.name, {"error": "No analytics returned"})
+        if "error" in result:
+            print(f"ERROR [{site.name}:{timestamp}]: {result['error']}", file=sys.stderr)
+            continue
+
+        with open(site.analytics_file, "w") as f:
+            info = {
+                "timestamp": timestamp,
+                "analytics": result["analytics"],
+                "duration": result["duration"],
+            }
+            json.dump(info, f, indent=1)
+        print(f"COLLECTED [{site.name}]: {result['duration']:.2f}s")
+
+    print(f"COLLECTED [{bench.name}]: {len(sites)} sites in {time.monotonic() - start:.2f}s")
+
+
+def collect_bench_analytics(bench: Bench, now: datetime, batch_size: int):
+    """Collects due sites of the bench, `batch_size` sites per process, one process after another"""
+    sites = get_due_sites(bench, now)
+    for index in range(0, len(sites), batch_size):
+        collect_analytics(bench, sites[index : index + batch_size])
+
 
 if __name__ == "__main__":
-    info = []
     server = Server()
-    for bench in server.benches.values():
-        for site in bench.sites.values():
-            try:
-                timestamp = str(datetime.utcnow())
-                info = {
-                    "timestamp": timestamp,
-                    "analytics": site.get_analytics(),
-                }
-                with open(site.analytics_file, "w") as f:
-                    json.dump(info, f, indent=1)
-            except Exception:
-                exception = traceback.format_exc()
-                error_log = f"ERROR [{site.name}:{timestamp}]: {exception}"
-                print(error_log, file=sys.stderr)
+    now = datetime.utcnow()
+    batch_size = server.config.get("analytics_sites_per_process", ANALYTICS_SITES_PER_PROCESS)
+
+    # Benches are collected concurrently, each runs its batches in one worker
+    results = run_concurrently(
+        lambda bench: collect_bench_analytics(bench, now, batch_size),
+        server.benches.values(),
+        max_workers=server.bench_concurrency,
+    )
+    for result in results:
+        if result.error:
+            print(f"ERROR [{result.item.name}:{now}]: {result.traceback}", file=sys.stderr)
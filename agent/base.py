@@ -5,30 +5,267 @@ import os
 import shutil
 import subprocess
 import tempfile
+import threading
+import time
 import traceback
+import uuid
+from collections import deque
 from contextlib import suppress
 from datetime import datetime
-from functools import partial
 from typing import TYPE_CHECKING
 
 import filelock
 import redis
 
 from agent.exceptions import AgentException
-from agent.job import connection
-from agent.utils import get_execution_result
+from agent.job import connection, job_change, mark_job_changed
+from agent.utils import get_execution_result, read_json_file
 
 if TYPE_CHECKING:
     from typing import Any
 
+    from redis import Redis
+
     from agent.job import Job, Step
 
 
+class OutputReader:
+    """
+    Splits raw subprocess output into lines as a terminal would show them.
+
+    A carriage return that isn't followed by a newline discards the line so far.
+    This won't work for top, htop etc, but good enough to handle progress bars.
+
+    If `tail_size` is set, only the last `tail_size` characters of completed
+    lines are kept in memory.
+    """
+
+    def __init__(self, tail_size: int | None = None):
+        self.tail_size = tail_size
+        self.lines: deque[str] = deque()
+        self.size = 0
+        self.truncated = 0
+        self._line = bytearray()
+        self._after_carriage_return = False
+
+    def feed(self, chunk: bytes) -> list[str]:
+        """Consumes a chunk of output and returns the lines it completed"""
+        *segments, last = chunk.split(b"\n")
+        completed = []
+        for segment in segments:
+            self._consume(segment)
+            completed.append(self._line.decode(errors="replace"))
+            self._line = bytearray()
+            self._after_carriage_return = False
+
+        self._consume(last)
+        self._append(completed)
+        return completed
+
+    def close(self) -> list[str]:
+        """Completes the pending line, if any, and returns it"""
+        completed = [self.pending] if self._line else []
+        self._line = bytearray()
+        self._append(completed)
+        return completed
+
+    @property
+    def pending(self) -> str:
+        """Line that hasn't been terminated by a newline yet"""
+        return self._line.decode(errors="replace")
+
+    @property
+    def output(self) -> str:
+        lines = list(self.lines)
+        if self._line:
+            lines.append(self.pending)
+        if self.truncated:
+            lines.insert(0, f"... {self.truncated} characters truncated ...")
+        return "\n".join(lines)
+
+    def _consume(self, segment: bytes):
+        head, *overwrites = segment.split(b"\r")
+        if head:
+            if self._after_carriage_return:
+                self._line = bytearray(head)
+            else:
+                self._line.extend(head)
+
+        for part in overwrites:
+            if part:
+                self._line = bytearray(part)
+
+        if overwrites:
+            self._after_carriage_return = not overwrites[-1]
+        elif head:
+            self._after_carriage_return = False
+
+    def _append(self, lines: list[str]):
+        for line in lines:
+            self.lines.append(line)
+            self.size += len(line) + 1
+
+        if self.tail_size is None:
+            return
+
+        while self.size > self.tail_size and len(self.lines) > 1:
+            removed = len(self.lines.popleft()) + 1
+            self.size -= removed
+            self.truncated += removed
+
+
+class OutputPublisher:
+    """
+    Writes a command's result to the entry of a job or step in redis.
+
+    A job or step keeps a single entry, the latest command's, same as before
+    output was logged separately. The entry holds the command's metadata, its
+    output is appended to a separate log (see `output_key`) so it is never
+    re-serialized. The line being written (progress bars etc.) is kept in the
+    entry as `output_pending`.
+
+    Updates made within `interval` seconds of the last write are coalesced
+    and written once the interval is up, even if nothing else is written by
+    then. `flush` (or a forced publish) writes whatever is pending right away.
+    The entry, the log and their expiry are written in a single round trip.
+    """
+
+    ttl = 60 * 60 * 6
+
+    def __init__(
+        self,
+        redis: Redis,
+        key: str,
+        interval: float,
+        job_id=None,
+        change: str | None = None,
+        previous_output_key: str | None = None,
+    ):
+        self.redis = redis
+        self.key = key
+        self.interval = interval
+        # What to mark as changed in the job's version, see `mark_job_changed`
+        self.job_id = job_id
+        self.change = change
+        # Every command logs to its own key, readers keep offsets by key
+        self.log_id = uuid.uuid4().hex[:12]
+        # Log of the command this one replaces in the entry
+        self.previous_output_key = previous_output_key
+        self.written = False
+        self.pending: dict | None = None
+        self.pending_output: list[str] = []
+        self.replace_output = False
+        self.last_published = 0.0
+        self.lock = threading.RLock()
+        self.timer: threading.Timer | None = None
+
+    @staticmethod
+    def output_key(key: str, log_id) -> str:
+        return f"{key}:output:{log_id}"
+
+    @staticmethod
+    def assemble_output(log: str, pending: str = "") -> str:
+        """Returns output the way `OutputReader.output` would, from the log and the pending line"""
+        if not log:
+            return pending
+        # Every line in the log is terminated with a newline
+        log = log[:-1]
+        return f"{log}\n{pending}" if pending else log
+
+    @property
+    def due(self) -> bool:
+        return time.monotonic() - self.last_published >= self.interval
+
+    def append_output(self, lines: list[str]):
+        with self.lock:
+            self.pending_output.extend(f"{line}\n" for line in lines)
+
+    def set_output(self, output: str):
+        with self.lock:
+            self.pending_output = [f"{output}\n"] if output else []
+            self.replace_output = True
+
+    def publish(self, data: dict, force: bool = False):
+        with self.lock:
+            self.pending = data
+        if force or self.due:
+            self.flush()
+        else:
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        """Flushes once the interval is up, so the last updates before a silent stretch are written"""
+        with self.lock:
+            if self.timer is not None:
+                return
+            delay = max(self.interval - (time.monotonic() - self.last_published), 0)
+            self.timer = threading.Timer(delay, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.pending is None and not self.pending_output and not self.replace_output:
+                return
+            self._write()
+
+    def _write(self):
+        self.last_published = time.monotonic()
+        data, self.pending = self.pending, None
+        output_key = self.output_key(self.key, self.log_id)
+
+        pipeline = self.redis.pipeline(transaction=False)
+        if not self.written:
+            # The first write replaces the entry of the previous command
+            data = data or {}
+            if self.previous_output_key:
+                pipeline.delete(self.previous_output_key)
+        if data is not None:
+            pipeline.lset(self.key, -1, self._serialize(data))
+
+        if self.replace_output:
+            pipeline.delete(output_key)
+            self.replace_output = False
+        if self.pending_output:
+            pipeline.append(output_key, "".join(self.pending_output))
+            self.pending_output = []
+
+        pipeline.expire(self.key, self.ttl)
+        pipeline.expire(output_key, self.ttl)
+        if self.job_id:
+            mark_job_changed(self.job_id, self.change, client=pipeline)
+        results = pipeline.execute(raise_on_error=False)
+
+        set_entry = results[1 if not self.written and self.previous_output_key else 0]
+        if data is not None and isinstance(set_entry, redis.exceptions.ResponseError):
+            # No entry yet, or the list expired while the command was running
+            pipeline = self.redis.pipeline(transaction=False)
+            pipeline.rpush(self.key, self._serialize(data))
+            pipeline.expire(self.key, self.ttl)
+            pipeline.execute()
+        self.written = True
+
+    def _serialize(self, data: dict) -> str:
+        data = {key: value for key, value in data.items() if key != "output"}
+        data["output_log"] = self.log_id
+        return json.dumps(data, default=str)
+
+
 class Base:
     if TYPE_CHECKING:
         job_record: Job | None
         step_record: Step | None
 
+    # Maximum bytes read from a subprocess pipe at once
+    output_chunk_size = 64 * 1024
+    # Characters of command output kept in memory, None keeps all of it
+    output_tail_size: int | None = None
+    # Minimum seconds between two writes of a running command's output to redis
+    output_publish_interval: float = 1
+
     def __init__(self):
         self.directory = None
         self.config_file = None
@@ -37,6 +274,8 @@ class Base:
 
         # internal
         self._config_file_lock: filelock.SoftFileLock | None = None
+        self._output_publisher: OutputPublisher | None = None
+        self._previous_output_key: str | None = None
 
     def __repr__(self):
         return f"{self.__class__.__name__}({self.name})"
@@ -49,15 +288,24 @@ class Base:
         skip_output_log=False,
         executable=None,
         non_zero_throw=True,
+        run_subprocess=None,
     ):
         directory = directory or self.directory
+        run_subprocess = run_subprocess or self.run_subprocess
         start = datetime.now()
         self.skip_output_log = skip_output_log
         self.data = get_execution_result(command, directory, start)
+        # Every command replaces the entry of the previous one, with a log of its own
+        if self._output_publisher:
+            self._output_publisher.flush()
+            self._previous_output_key = self._output_publisher.output_key(
+                self._output_publisher.key, self._output_publisher.log_id
+            )
+        self._output_publisher = None
         self.log()
         output = ""
         try:
-            output, returncode = self.run_subprocess(
+            output, returncode = run_subprocess(
                 command,
                 directory,
                 input,
@@ -78,6 +326,7 @@ class Base:
             self.data.update({"status": "Success"})
         finally:
             end = datetime.now()
+            self.data.pop("output_pending", None)
             self.data.update(
                 {
                     "returncode": returncode,
@@ -115,77 +364,93 @@ class Base:
         if not process.stdout:
             return ""
 
-        line = b""
-        lines = []
-        prev_char = None
-        # This is equivalent of remove_crs
-        # Make sure output matches what'll be shown in the terminal
-        # This won't work for top, htop etc, but good enough to handle progress bars
-        for char in iter(partial(process.stdout.read, 1), b""):
-            if char == b"" and process.poll() is not None:
-                break
-            if char == b"\r":
-                prev_char = char
-                continue  # Ignore carriage return; handled in next iteration
-            if char == b"\n":
-                lines.append(line.decode(errors="replace"))
-                line = b""
-                self.publish_lines(lines)
-            elif prev_char == b"\r":
-                self.publish_lines([*lines, line.decode(errors="replace")])
-                line = b""
-                line += char
-            else:
-                line += char
-            prev_char = char
+        reader = OutputReader(tail_size=self.output_tail_size)
+        # read1 returns as soon as some output is available, so progress is published promptly
+        while chunk := process.stdout.read1(self.output_chunk_size):
+            self.publish_output(reader, reader.feed(chunk))
 
-        if line:
-            lines.append(line.decode(errors="replace"))
-        self.publish_lines(lines)
-        return "\n".join(lines)
+        self.publish_output(reader, reader.close())
+        return reader.output
+
+    def parse_finished_output(self, output: str) -> str:
+        """Same as parse_output, for the output of a command that ran elsewhere"""
+        reader = OutputReader(tail_size=self.output_tail_size)
+        self.publish_output(reader, reader.feed(output.encode()))
+        self.publish_output(reader, reader.close())
+        return reader.output
+
+    def publish_output(self, reader: OutputReader, lines: list[str]):
+        """
+        Publishes output of the running command.
 
-    def publish_lines(self, lines: list[str]):
-        output = "\n".join(lines)
-        self.data.update({"output": output})
+        `lines` are the lines completed since the last call,
+        `reader.pending` is the partially written line (progress bars etc.)
+        """
+        if not (publisher := self.output_publisher):
+            return
+
+        publisher.append_output(lines)
+        self.data.update({"output_pending": reader.pending})
         self.update_redis()
 
-    def publish_data(self, data: Any):
+    def publish_data(self, data: Any, force: bool = False):
         if not isinstance(data, str):
             data = json.dumps(data, default=str)
 
         self.data.update({"output": data})
-        self.update_redis()
+        if publisher := self.output_publisher:
+            publisher.set_output(data)
+        self.update_redis(force=force)
 
-    def update_redis(self):
+    def update_redis(self, force: bool = False):
+        if publisher := self.output_publisher:
+            publisher.publish(self.data, force=force)
+
+    @property
+    def output_publisher(self) -> OutputPublisher | None:
         if not (redis_key := self.get_redis_key()):
-            return
+            return None
 
-        value = json.dumps(self.data, default=str)
-        self.push_redis_value(redis_key, value)
-        self.redis.expire(redis_key, 60 * 60 * 6)
+        if not self._output_publisher or self._output_publisher.key != redis_key:
+            if self._output_publisher:
+                self._output_publisher.flush()
+            previous_output_key = self._previous_output_key
+            if not previous_output_key or not previous_output_key.startswith(f"{redis_key}:"):
+                previous_output_key = None
+            job_id, step_id = self.get_job_and_step_ids()
+            self._output_publisher = OutputPublisher(
+                self.redis,
+                redis_key,
+                self.output_publish_interval,
+                job_id=job_id,
+                change=job_change(step_id),
+                previous_output_key=previous_output_key,
+            )
+            self._previous_output_key = None
+        return self._output_publisher
 
-    def push_redis_value(self, key: str, value: str):
-        if "output" not in self.data:
-            self.redis.rpush(key, value)
+    def get_redis_key(self):
+        job_id, step_id = self.get_job_and_step_ids()
+        if not job_id:
+            return None
 
-        try:
-            self.redis.lset(key, -1, value)
-        except redis.exceptions.ResponseError as e:
-            if "no such key" in str(e):
-                self.redis.rpush(key, value)
+        key = f"agent:job:{job_id}"
+        if step_id:
+            return f"{key}:step:{step_id}"
 
-    def get_redis_key(self):
+        return key
+
+    def get_job_and_step_ids(self) -> tuple[int | None, int | None]:
         if not self.job_record:
-            return None
+            return None, None
 
         if not hasattr(self.job_record, "model"):
-            return None
+            return None, None
 
-        key = f"agent:job:{self.job_record.model.id}"
         if self.step_record and hasattr(self.step_record, "model"):
-            return f"{key}:step:{self.step_record.model.id}"
+            return self.job_record.model.id, self.step_record.model.id
 
-        return key
+        return self.job_record.model.id, None
 
     @property
     def redis(self):
@@ -196,6 +461,8 @@ class Base:
         """
         This should be used where we know that,
         the config file isn't going to be frequently updated.
+
+        The config is cached until the file changes and shared, don't modify it.
         """
         return self.get_config()
 
@@ -209,8 +476,7 @@ class Base:
                 self._config_file_lock = filelock.SoftFileLock(self.config_file + ".lock")
             self._config_file_lock.acquire()
 
-        with open(self.config_file, "r") as f:
-            return json.load(f)
+        return read_json_file(self.config_file, cached=not for_update)
 
     def set_config(self, value: dict, indent=1, release_lock: bool = True):
         """
@@ -246,7 +512,7 @@ class Base:
         if self.skip_output_log:
             data.update({"output": ""})
         print(json.dumps(data, default=str))
-        self.update_redis()
+        self.update_redis(force=True)
 
     @property
     def logs(self):
@@ -5,7 +5,11 @@ import json
 import os
 import shutil
 import string
+import subprocess
+import sys
 import tempfile
+import threading
+import time
 import traceback
 from contextlib import suppress
 from datetime import datetime, timedelta
@@ -18,12 +22,22 @@ from typing import TYPE_CHECKING, TypedDict
 
 import requests
 
+from agent import bench_helper
 from agent.app import App
 from agent.base import AgentException, Base
 from agent.exceptions import InvalidSiteConfigException, SiteNotExistsException
 from agent.job import job, step
-from agent.site import Site
-from agent.utils import download_file, end_execution, get_execution_result, get_size
+from agent.site import SITE_INFO_FIELDS, Site
+from agent.usage_history import get_usage
+from agent.utils import (
+    download_file,
+    end_execution,
+    get_execution_result,
+    get_size,
+    is_valid_directory_name,
+    read_json_file,
+    run_concurrently,
+)
 
 if TYPE_CHECKING:
     from agent.server import Server
@@ -40,6 +54,32 @@ if TYPE_CHECKING:
         migrate_sites: bool
 
 
+# Commands that change the code or schema a site runs with, they need a fresh process
+HELPER_EXCLUDED_COMMANDS = ("migrate", "install-app", "reinstall")
+HELPER_START_INTERVAL = 60
+
+SITES_ANALYTICS_MARKER = "analytics-result:"
+# The marker is split, so the console echoing the script doesn't print it
+SITES_ANALYTICS_SCRIPT = """import json, time
+import frappe.utils
+def collect_site_analytics(site):
+    start = time.monotonic()
+    try:
+        frappe.destroy()
+        frappe.init(site=site)
+        frappe.connect()
+        result = {{"analytics": frappe.utils.get_site_info()}}
+    except Exception:
+        result = {{"error": frappe.get_traceback()}}
+    result["duration"] = round(time.monotonic() - start, 3)
+    print("analytics" + "-result:" + json.dumps({{site: result}}, default=str))
+
+for site in {sites}:
+    collect_site_analytics(site)
+
+"""
+
+
 class Bench(Base):
     def __init__(self, name: str, server: Server, mounts=None):
         super().__init__()
@@ -54,6 +94,7 @@ class Bench(Base):
         self.bench_config_file = os.path.join(self.directory, "config.json")
         self.config_file = os.path.join(self.directory, "sites", "common_site_config.json")
         self.host = self.config.get("db_host", "localhost")
+        self.port = self.config.get("db_port", 3306)
         self.docker_image = self.bench_config.get("docker_image")
         self.mounts = mounts
         if not (
@@ -90,78 +131,89 @@ class Bench(Base):
                 print(f"Deleting {file} as it's older than {max_retention_time}")
                 os.remove(file)
 
-    def fetch_sites_info(self, since=None):
+    def fetch_sites_info(self, since=None, fields=None):
+        return dict(self.iter_sites_info(since=since, fields=fields))
+
+    def iter_sites_info(self, since=None, fields=None):
+        """
+        Yields (site name, info) one site at a time, so the response can be streamed.
+
+        Only the given `fields` of SITE_INFO_FIELDS are computed.
+        """
+        fields = SITE_INFO_FIELDS if fields is None else fields
         max_retention_time = (datetime.utcnow() - timedelta(days=7)).timestamp()
         self._delete_older_usage_files(max_retention_time)
 
         if not since:
             since = max_retention_time
+        since = datetime.utcfromtimestamp(float(since))
 
-        info = {}
-        usage_data = []
-        log_files = glob(
-            os.path.join(
-                self.server.directory,
-                "logs",
-                f"{self.server.name}-usage-*.json.log",
-            )
-        )
+        sites = list(self.sites.values())
+        for index in range(0, len(sites), 100):
+            chunk = sites[index : index + 100]
+            # Timezone is taken from the latest sample, before asking the database
+            usage = {site.name: [] for site in chunk}
+            if "usage" in fields or "timezone" in fields:
+                usage = get_usage([site.name for site in chunk], since)
 
-        for file in log_files:
-            # Only load files that are newer than the since timestamp
-            if os.stat(file).st_mtime <= since:
-                continue
+            for site in chunk:
+                yield site.name, self._site_info(site, usage[site.name], fields)
 
-            with open(file) as f:
-                try:
-                    usage_data.extend(json.load(f))
-                except json.decoder.JSONDecodeError:
-                    print(f"Error loading JSON from {file}")
+    def _site_info(self, site: Site, samples: list, fields) -> dict:
+        info = {}
+        if "config" in fields:
+            info["config"] = site.config
+        if "usage" in fields:
+            info["usage"] = [
+                {
+                    "database": sample.database,
+                    "public": sample.public,
+                    "private": sample.private,
+                    "backups": sample.backups,
+                    "timestamp": str(sample.timestamp),
+                }
+                for sample in samples
+            ]
+        if "timezone" in fields:
+            # Samples are latest first
+            timezone = samples[0].timezone if samples else None
+            info["timezone"] = timezone or site.timezone
+        return info
 
-        usage_data.sort(
-            key=lambda x: datetime.fromisoformat(x["timestamp"]),
-            reverse=True,
+    def fetch_sites_analytics(self):
+        analytics = {}
+        results = run_concurrently(
+            lambda site: site.fetch_site_analytics(),
+            self.sites.values(),
+            max_workers=self.site_concurrency,
         )
+        for result in results:
+            if result.error:
+                sys.stderr.write(result.traceback)
+            else:
+                analytics[result.item.name] = result.result
+        return analytics
 
-        for site in self.sites.values():
-            try:
-                timezone_data = {d["timestamp"]: d["timezone"] for d in usage_data if d["site"] == site.name}
-                timezone = timezone_data[max(timezone_data)]
-            except Exception:
-                timezone = None
-
-            if not (usage_data and timezone):
-                timezone = site.timezone
-
-            info[site.name] = {
-                "config": site.config,
-                "usage": [
-                    {
-                        "database": d["database"],
-                        "public": d["public"],
-                        "private": d["private"],
-                        "backups": d["backups"],
-                        "timestamp": d["timestamp"],
-                    }
-                    for d in usage_data
-                    if d["site"] == site.name
-                ],
-                "timezone": timezone,
-            }
+    def get_sites_analytics(self, sites: list[str]) -> dict[str, dict]:
+        """
+        Collects analytics of `sites` in one Frappe process, instead of booting Frappe for each.
 
-        return info
+        Returns {"analytics": ..., "duration": seconds} or {"error": traceback} by site.
+        """
+        script = SITES_ANALYTICS_SCRIPT.format(sites=json.dumps(sites))
+        output = self.site_execute(sites[0], "console", input=script)["output"]
 
-    def fetch_sites_analytics(self):
         analytics = {}
-        for site in self.sites.values():
-            try:
-                analytics[site.name] = site.fetch_site_analytics()
-            except Exception:
-                import traceback
-
-                traceback.print_exc()
+        for line in output.splitlines():
+            if line.startswith(SITES_ANALYTICS_MARKER):
+                analytics.update(json.loads(line[len(SITES_ANALYTICS_MARKER) :]))
         return analytics
 
+    @property
+    def site_concurrency(self) -> int:
+        """Number of sites on this bench that can be worked on at once."""
+        return self.server.config.get("max_concurrent_sites_per_bench", 4)
+
     def execute(self, command, input=None, non_zero_throw=True):
         return super().execute(
             command,
@@ -170,8 +222,18 @@ class Bench(Base):
             non_zero_throw=non_zero_throw,
         )
 
-    def docker_execute(self, command, input=None, subdir=None, non_zero_throw=True, as_root: bool = False):
+    def docker_execute(
+        self,
+        command,
+        input=None,
+        subdir=None,
+        non_zero_throw=True,
+        as_root: bool = False,
+        detach: bool = False,
+    ):
         interactive = "-i" if input else ""
+        if detach:
+            interactive = "-d"
         as_root = "-u root" if as_root else ""
         workdir = "/home/frappe/frappe-bench"
         if subdir:
@@ -188,6 +250,62 @@ class Bench(Base):
 
         return self.execute(command, input=input, non_zero_throw=non_zero_throw)
 
+    def site_execute(self, site: str, command: str, input=None):
+        """Runs `bench --site <site> <command>` in the bench's helper if it's running, or with docker exec."""
+        use_helper = command.split(maxsplit=1)[0] not in HELPER_EXCLUDED_COMMANDS
+        command = f"bench --site {site} {command}"
+        if use_helper and (helper := self.helper):
+            run = partial(self.run_in_helper, helper)
+            return super().execute(command, directory=self.directory, input=input, run_subprocess=run)
+        if use_helper and self.server.config.get("bench_helper"):
+            self.start_helper()
+        return self.docker_execute(command, input=input)
+
+    def run_in_helper(self, helper, command, directory, input, executable, non_zero_throw=True):
+        """Same as run_subprocess, with the output published once the helper returns it"""
+        output, returncode = helper.run(command, directory, input, executable, non_zero_throw=False)
+        output = self.parse_finished_output(output)
+        if non_zero_throw and returncode:
+            raise subprocess.CalledProcessError(returncode, command, output=output)
+        return output, returncode
+
+    @property
+    def helper(self) -> bench_helper.BenchHelperClient | None:
+        """Client for the bench's helper, if it's enabled with bench_helper in config.json and running."""
+        if not self.server.config.get("bench_helper"):
+            return None
+
+        helper = bench_helper.BenchHelperClient(
+            os.path.join(self.sites_directory, bench_helper.SOCKET_NAME),
+            timeout=self.server.config.get("bench_helper_timeout", bench_helper.COMMAND_TIMEOUT),
+        )
+        return helper if helper.is_running() else None
+
+    def start_helper(self):
+        """
+        Starts the helper in the background, commands use docker exec until it's listening.
+
+        Only one start is attempted per HELPER_START_INTERVAL, so concurrent
+        commands don't start a helper each.
+        """
+        marker = os.path.join(self.sites_directory, bench_helper.START_MARKER_NAME)
+        with suppress(FileNotFoundError):
+            if time.time() - os.stat(marker).st_mtime > HELPER_START_INTERVAL:
+                os.remove(marker)
+        try:
+            os.close(os.open(marker, os.O_CREAT | os.O_EXCL))
+        except FileExistsError:
+            return None
+
+        shutil.copy(bench_helper.__file__, os.path.join(self.sites_directory, bench_helper.SCRIPT_NAME))
+        return self.docker_execute(f"env/bin/python sites/{bench_helper.SCRIPT_NAME}", detach=True)
+
+    def stop_helper(self):
+        """Stops the helper, so the next command starts one importing the current apps."""
+        bench_helper.BenchHelperClient(os.path.join(self.sites_directory, bench_helper.SOCKET_NAME)).stop()
+        with suppress(FileNotFoundError):
+            os.remove(os.path.join(self.sites_directory, bench_helper.START_MARKER_NAME))
+
     @step("New Site")
     def bench_new_site(self, name, mariadb_root_password, admin_password):
         site_database, temp_user, temp_password = self.create_mariadb_user(name, mariadb_root_password)
@@ -580,7 +698,7 @@ class Bench(Base):
             self.set_config(new_common_site_config)
 
         if bench_config:
-            new_bench_config = self.bench_config
+            new_bench_config = read_json_file(self.bench_config_file, cached=False)
             new_bench_config.update(bench_config)
             self.set_bench_config(new_bench_config)
 
@@ -631,8 +749,7 @@ class Bench(Base):
 
     @step("Generate Docker Compose File")
     def generate_docker_compose_file(self):
-        config = self.bench_config
-        config.update({"directory": self.directory})
+        config = {**self.bench_config, "directory": self.directory}
         docker_compose = os.path.join(self.directory, "docker-compose.yml")
         self.server._render_template("bench/docker-compose.yml.jinja2", config, docker_compose)
 
@@ -728,12 +845,7 @@ class Bench(Base):
             ssh_ip = secondary_server_private_ip or self.bench_config.get("private_ip", "127.0.0.1")
 
             rq_port = self.bench_config.get("rq_port")
-            rq_cache_port = self.bench_config.get("rq_cache_port")
-
-            if not rq_cache_port:
-                # [Auto Scaling] We need to expose this when we restart the container regardless
-                offset = 18000 - self.bench_config["web_port"]
-                rq_cache_port = 13000 + offset
+            rq_cache_port = self.rq_cache_port
 
             rq_port_mapping = f"-p 0.0.0.0:{rq_port}:11000 "  # need to expose to secondary server
 
@@ -764,6 +876,19 @@ class Bench(Base):
             )
         return self.execute(command)
 
+    @property
+    def rq_cache_port(self) -> int | None:
+        """Port of the bench's cache Redis on the host, only exposed by single container benches."""
+        if not self.bench_config.get("single_container"):
+            return None
+
+        rq_cache_port = self.bench_config.get("rq_cache_port")
+        if not rq_cache_port:
+            # [Auto Scaling] We need to expose this when we restart the container regardless
+            offset = 18000 - self.bench_config["web_port"]
+            rq_cache_port = 13000 + offset
+        return rq_cache_port
+
     def stop(self):
         if self.bench_config.get("single_container"):
             self.execute(f"docker stop {self.name}")
@@ -834,25 +959,31 @@ class Bench(Base):
             try:
                 sites[directory] = Site(directory, self)
             except json.decoder.JSONDecodeError as jde:
-                output = self.readable_jde_err(f"Error parsing JSON in {directory}", jde)
-                try:
-                    self.execute(
-                        f"echo '{output}';exit {int(validate_configs)}",
-                    )  # exit 1 to make sure the job fails and shows output
-                except AgentException as e:
-                    raise InvalidSiteConfigException(e.data, directory) from e
+                self._log_invalid_site_config(directory, jde, validate_configs)
             except Exception:
                 pass
         return sites
 
+    def _log_invalid_site_config(self, directory, jde, fail=False):
+        output = self.readable_jde_err(f"Error parsing JSON in {directory}", jde)
+        try:
+            self.execute(
+                f"echo '{output}';exit {int(fail)}",
+            )  # exit 1 to make sure the job fails and shows output
+        except AgentException as e:
+            raise InvalidSiteConfigException(e.data, directory) from e
+
     def get_site(self, site):
+        """Builds only the named site, instead of every site like `sites`."""
+        if not is_valid_directory_name(site):
+            raise SiteNotExistsException(site, self.name)
+
         try:
-            return self.valid_sites[site]
-        except KeyError as e:
+            return Site(site, self)
+        except json.decoder.JSONDecodeError as jde:
+            self._log_invalid_site_config(site, jde, fail=True)
+        except Exception as e:
             raise SiteNotExistsException(site, self.name) from e
-        except InvalidSiteConfigException as e:
-            if e.site == site:
-                raise
 
     @property
     def step_record(self):
@@ -863,15 +994,20 @@ class Bench(Base):
         self.server.step_record = value
 
     def get_usage(self):
+        results = run_concurrently(
+            lambda site: site.get_database_size(),
+            self.sites.values(),
+            max_workers=self.site_concurrency,
+        )
         return {
             "storage": get_size(self.directory),
-            "database": sum([site.get_database_size() for site in self.sites.values()]),
+            "database": sum(result.unwrap() for result in results),
         }
 
     @property
     def bench_config(self) -> dict:
-        with open(self.bench_config_file, "r") as f:
-            return json.load(f)
+        """Cached until the file changes and shared, don't modify it."""
+        return read_json_file(self.bench_config_file)
 
     def set_bench_config(self, value, indent=1):
         """
@@ -904,6 +1040,7 @@ class Bench(Base):
     ):
         patch_container_path = self.prepare_app_patch(app, patch, filename)
         self.git_apply(app, revert, patch_container_path)
+        self.stop_helper()
 
         if build_assets:
             self.rebuild()
@@ -963,12 +1100,15 @@ class Bench(Base):
         if not (diff_dict := self.pull_app_changes(apps).get("diff")):
             return
 
+        # The helper has the old apps imported
+        self.stop_helper()
         should_run = get_should_run_update_phase(diff_dict)
 
         node = should_run["setup_requirements_node"]
         python = should_run["setup_requirements_python"]
         if node or python:
             self.setup_requirements(node, python)
+            self.stop_helper()
 
         if should_run["migrate_sites"]:
             self.migrate_sites(sites)
@@ -1085,12 +1225,7 @@ class Bench(Base):
         res = get_execution_result()
         outputs: list[str] = []
 
-        for site_name in sites:
-            migrate_res = self.migrate_site(
-                self.sites[site_name],
-                skip_search_index,
-                skip_failing_patches,
-            )
+        for site_name, migrate_res in self._migrate_sites(sites, skip_search_index, skip_failing_patches):
             output = "\n".join(
                 [
                     site_name,
@@ -1104,6 +1239,39 @@ class Bench(Base):
             "\n\n".join(outputs),
         )
 
+    def _migrate_sites(self, sites: list[str], skip_search_index: bool, skip_failing_patches: bool):
+        """
+        Yields sites and their migration results in the order of `sites`, raising the first failure.
+
+        Sites are migrated one at a time, unless max_concurrent_migrations in
+        config.json allows more. No migration starts after one has failed.
+        """
+        concurrency = self.server.config.get("max_concurrent_migrations", 1)
+        if concurrency <= 1:
+            for site_name in sites:
+                yield (
+                    site_name,
+                    self.migrate_site(self.get_site(site_name), skip_search_index, skip_failing_patches),
+                )
+            return
+
+        failed = threading.Event()
+
+        def migrate(site_name):
+            if failed.is_set():
+                return None
+            # Commands can't run concurrently on the same Bench, give every site its own
+            bench = Bench(self.name, self.server, mounts=self.mounts)
+            try:
+                return self.migrate_site(bench.get_site(site_name), skip_search_index, skip_failing_patches)
+            except Exception:
+                failed.set()
+                raise
+
+        # Sites start in order, so a failure comes before the sites skipped after it
+        for result in run_concurrently(migrate, sites, max_workers=concurrency):
+            yield result.item, result.unwrap()
+
     def migrate_site(
         self,
         site: Site,
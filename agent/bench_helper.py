@@ -0,0 +1,200 @@
+"""
+Runs `bench` commands inside a bench container without starting Python and
+importing Frappe for every command.
+
+This file is copied into the bench's sites directory and started in the
+container by Bench.start_helper. It only depends on the standard library, Frappe
+is imported when the server starts. Every connection is handled in a process
+forked from the server, so commands start with Frappe and app commands already
+imported, and anything a command changes is thrown away with its process.
+
+The agent connects through the socket in the sites directory, which is mounted
+from the host. A request is one JSON line with `args` (after
+`bench`), optional `input` and `timeout`, the response is one JSON line with
+`output` and `returncode`.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import shlex
+import signal
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from contextlib import suppress
+
+SOCKET_NAME = ".bench_helper.sock"
+SCRIPT_NAME = ".bench_helper.py"
+START_MARKER_NAME = ".bench_helper.start"
+
+# Restart now and then to pick up changes to apps and their commands
+MAX_IDLE_TIME = 10 * 60
+MAX_AGE = 60 * 60
+# Commands running longer than this are killed, overridden by bench_helper_timeout in config.json
+COMMAND_TIMEOUT = 60 * 60
+# Time the helper gets to answer after killing a command, before the agent gives up on it
+RESPONSE_GRACE_TIME = 10
+
+
+class BenchHelperClient:
+    """Runs commands in the helper listening on `path`, used by the agent on the host."""
+
+    def __init__(self, path: str, timeout: float = COMMAND_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+
+    def is_running(self) -> bool:
+        try:
+            self._connect().close()
+            return True
+        except OSError:
+            return False
+
+    def run(self, command, directory=None, input=None, executable=None, non_zero_throw=True):
+        """
+        Same as Base.run_subprocess, `command` is a `bench` command line.
+
+        Commands are killed after `timeout` seconds. If the helper doesn't answer
+        at all, it's stopped so the next command starts a new one.
+        """
+        args = shlex.split(command)[1:]
+        request = json.dumps({"args": args, "input": input, "timeout": self.timeout}).encode() + b"\n"
+        with self._connect() as connection, connection.makefile("rb") as response:
+            connection.settimeout(self.timeout + RESPONSE_GRACE_TIME)
+            connection.sendall(request)
+            try:
+                line = response.readline()
+            except socket.timeout:
+                self.stop()
+                line = b""
+
+        if line:
+            result = json.loads(line)
+            output, returncode = result["output"], result["returncode"]
+        else:
+            # The command was killed, or the helper exited while running it
+            output, returncode = f"Bench helper gave no result in {self.timeout}s", -signal.SIGKILL
+        if non_zero_throw and returncode:
+            raise subprocess.CalledProcessError(returncode, command, output=output)
+        return output, returncode
+
+    def stop(self):
+        """Removes the socket, the helper stops taking requests and exits once it notices"""
+        with suppress(FileNotFoundError):
+            os.unlink(self.path)
+
+    def _connect(self) -> socket.socket:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(self.path)
+        except OSError:
+            connection.close()
+            raise
+        return connection
+
+
+class BenchHelperServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    timeout = 60
+
+    def __init__(self, path: str):
+        super().__init__(path, BenchHelperHandler)
+        self.started = self.last_request = time.monotonic()
+        self.inode = os.stat(path).st_ino
+
+    def process_request(self, request, client_address):
+        self.last_request = time.monotonic()
+        super().process_request(request, client_address)
+
+    @property
+    def expired(self) -> bool:
+        now = time.monotonic()
+        return now - self.last_request > MAX_IDLE_TIME or now - self.started > MAX_AGE or not self.owns_socket
+
+    @property
+    def owns_socket(self) -> bool:
+        """False once the socket is removed by BenchHelperClient.stop, or replaced by another helper"""
+        try:
+            return os.stat(self.server_address).st_ino == self.inode
+        except OSError:
+            return False
+
+
+class BenchHelperHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # Connection only checked if the helper is running
+            return
+
+        request = json.loads(line)
+        # A thread, so nothing the command does can cancel it, unlike an alarm
+        watchdog = threading.Timer(
+            request.get("timeout") or COMMAND_TIMEOUT, os.kill, (os.getpid(), signal.SIGKILL)
+        )
+        watchdog.daemon = True
+        watchdog.start()
+        result = run_bench_command(request["args"], request.get("input"))
+        self.wfile.write(json.dumps(result).encode() + b"\n")
+
+
+def run_bench_command(args: list[str], input: str | None = None) -> dict:
+    """Runs a Frappe command like `bench <args>` does, in this process"""
+    from frappe.utils import bench_helper
+
+    with tempfile.TemporaryFile() as stdin, tempfile.TemporaryFile() as output:
+        stdin.write((input or "").encode())
+        stdin.seek(0)
+        os.dup2(stdin.fileno(), 0)
+        os.dup2(output.fileno(), 1)
+        os.dup2(output.fileno(), 2)
+
+        sys.argv = ["bench", "frappe", *args]
+        returncode = 0
+        try:
+            bench_helper.main()
+        except SystemExit as e:
+            returncode = e.code if isinstance(e.code, int) else int(bool(e.code))
+        except BaseException:
+            traceback.print_exc()
+            returncode = 1
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        output.seek(0)
+        return {"output": output.read().decode(errors="replace"), "returncode": returncode}
+
+
+def serve(sites_directory: str):
+    os.chdir(sites_directory)
+    path = os.path.join(sites_directory, SOCKET_NAME)
+    if BenchHelperClient(path).is_running():
+        return
+    if os.path.exists(path):
+        os.unlink(path)
+
+    # Imports Frappe and commands of all installed apps, forked processes reuse them
+    from frappe.utils import bench_helper
+
+    bench_helper.get_app_groups()
+
+    old_umask = os.umask(0o077)
+    server = BenchHelperServer(path)
+    os.umask(old_umask)
+    try:
+        while not server.expired:
+            server.handle_request()
+    finally:
+        if server.owns_socket:
+            os.unlink(path)
+        server.server_close()
+
+
+if __name__ == "__main__":
+    serve(os.path.dirname(os.path.abspath(__file__)))
@@ -4,7 +4,6 @@ import os
 import shlex
 import subprocess
 import time
-from datetime import datetime
 from subprocess import Popen
 from typing import TYPE_CHECKING
 
@@ -51,7 +50,6 @@ class ImageBuilder(Base):
         )
         self.no_cache = no_cache
         self.no_push = no_push
-        self.last_published = datetime.now()
         self.build_failed = False
 
         cwd = os.getcwd()
@@ -195,16 +193,9 @@ class ImageBuilder(Base):
             self._publish_throttled_output(False)
 
     def _publish_throttled_output(self, flush: bool):
-        if flush:
-            self.publish_data(self.output)
-            return
-
-        now = datetime.now()
-        if (now - self.last_published).total_seconds() <= 1:
-            return
-
-        self.last_published = now
-        self.publish_data(self.output)
+        # Check before serializing the output, it grows with every line
+        if flush or ((publisher := self.output_publisher) and publisher.due):
+            self.publish_data(self.output, force=True)
 
     def _get_image_name(self):
         return f"{self.image_repository}:{self.image_tag}"
@@ -182,8 +182,8 @@ def site_analytics():
     if command in str(cron):
         cron.remove_all(command=command)
 
+    # Every hour, analytics.py spreads sites across the day
     job = cron.new(command=command)
-    job.hour.on(23)
     job.minute.on(0)
     cron.write()
 
@@ -209,6 +209,14 @@ def usage():
         cron.write()
 
 
+@setup.command()
+def prune_jobs():
+    from agent.job_retention import schedule_pruning
+
+    script_directory = os.path.dirname(__file__)
+    schedule_pruning(os.path.dirname(os.path.dirname(script_directory)))
+
+
 @setup.command()
 def registry():
     Server().setup_registry()
@@ -246,6 +254,36 @@ def proxysql(password):
     Server().setup_proxysql(password)
 
 
+@cli.group()
+def jobs():
+    pass
+
+
+@jobs.command()
+@click.option("--dry-run", is_flag=True, help="Only count jobs that would be archived.")
+@click.option(
+    "--full-vacuum",
+    is_flag=True,
+    help="Enable incremental vacuum with a full VACUUM first, blocks the jobs database while it runs.",
+)
+def prune(dry_run, full_vacuum):
+    retention = Server().job_retention
+    archived = retention.archive(dry_run=dry_run)
+    if dry_run:
+        print(f"Would archive {archived['jobs']} jobs")
+        return
+
+    print(f"Archived {archived['jobs']} jobs to {len(archived['files'])} files")
+
+    if full_vacuum:
+        retention.enable_incremental_vacuum()
+
+    vacuum = retention.vacuum()
+    if not vacuum["incremental"]:
+        print("Skipping vacuum, incremental auto vacuum isn't enabled. Run with --full-vacuum once.")
+    print(f"Reclaimed {vacuum['reclaimed']} bytes, {vacuum['size_after']} bytes in use")
+
+
 @cli.group()
 def run():
     pass
@@ -298,7 +336,7 @@ def start(bench: tuple[str]):
 
     if bench:
         for b in bench:
-            server.benches[b].start()
+            server.get_bench(b).start()
     else:
         server.start_all_benches()
 
@@ -307,7 +345,7 @@ def start(bench: tuple[str]):
 @click.argument("bench", required=False)
 def stop(bench):
     if bench:
-        return Server().benches[bench].stop()
+        return Server().get_bench(bench).stop()
     return Server().stop_all_benches()
 
 
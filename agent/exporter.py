@@ -1,9 +1,11 @@
-from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily, HistogramMetricFamily
 from prometheus_client.registry import Collector
 from redis import Redis
 from rq import Queue, Worker
 from rq.job import JobStatus
 
+from agent.job import connection
+
 
 def get_metrics(name: str, port: int):
     from prometheus_client.exposition import generate_latest
@@ -11,6 +13,12 @@ def get_metrics(name: str, port: int):
     return generate_latest(RQCollector(name, port))
 
 
+def get_nginx_reload_metrics(manager):
+    from prometheus_client.exposition import generate_latest
+
+    return generate_latest(NginxReloadCollector(manager))
+
+
 def get_workers_stats(connection: Redis):
     workers = Worker.all(connection=connection)
 
@@ -45,7 +53,7 @@ class RQCollector(Collector):
     def __init__(self, name: str, port: int):
         self.name = name
         self.port = port
-        self.conn = Redis(port=port)
+        self.conn = connection(port)
         super().__init__()
 
     def collect(self):
@@ -107,3 +115,33 @@ class RQCollector(Collector):
                 rq_jobs.add_metric([self.name, queue_name, status], count)
 
         yield rq_jobs
+
+
+class NginxReloadCollector(Collector):
+    def __init__(self, manager):
+        self.manager = manager
+        super().__init__()
+
+    def collect(self):
+        nginx_reloads = CounterMetricFamily(
+            "nginx_reloads",
+            "NGINX reloads by result, skipped when the proxy config didn't change",
+            labels=["result"],
+        )
+        for result, count in self.manager.get_reload_counters().items():
+            nginx_reloads.add_metric([result], count)
+
+        yield nginx_reloads
+
+        buckets, total = self.manager.get_reload_wait_histogram()
+        yield HistogramMetricFamily(
+            "nginx_reload_wait_seconds",
+            "Seconds from requesting a reload until it's done",
+            buckets=buckets,
+            sum_value=total,
+        )
+        yield GaugeMetricFamily(
+            "nginx_reload_latency_slo_seconds",
+            "Seconds reload requests should be done within",
+            value=self.manager.reload_latency_slo,
+        )
@@ -4,6 +4,8 @@ import datetime
 import json
 import os
 import traceback
+import zlib
+from functools import lru_cache
 from typing import TYPE_CHECKING
 
 import wrapt
@@ -17,7 +19,7 @@ from peewee import (
     TextField,
     TimeField,
 )
-from redis import Redis
+from redis import ConnectionPool, Redis
 from rq import Queue, get_current_job
 from rq.command import send_stop_job_command
 from rq.job import Job as RQJob
@@ -41,6 +43,8 @@ agent_database = SqliteDatabase(
     "jobs.sqlite3",
     timeout=15,
     pragmas={
+        # Only applies to new databases, and has to be set before WAL mode
+        "auto_vacuum": "incremental",
         "journal_mode": "wal",
         "synchronous": "normal",
         "mmap_size": 2**32 - 1,
@@ -49,21 +53,84 @@ agent_database = SqliteDatabase(
 )
 
 
-def connection():
+# Connection pools shared by every Redis client in this process, keyed by (port, decode_responses)
+# Pools reset themselves after a fork, so RQ work horses don't share sockets with their parent
+redis_connection_pools: dict[tuple[int, bool], ConnectionPool] = {}
+
+
+@lru_cache(maxsize=None)
+def get_redis_port() -> int:
     from agent.server import Server
 
-    port = Server().config["redis_port"]
-    return Redis(port=port)
+    return Server().config["redis_port"]
+
+
+def connection(port: int | None = None, decode_responses: bool = False) -> Redis:
+    """Returns a Redis client backed by a process wide connection pool
+
+    Defaults to the agent's own Redis server.
+    """
+    if port is None:
+        port = get_redis_port()
+
+    key = (port, decode_responses)
+    pool = redis_connection_pools.get(key)
+    if pool is None:
+        pool = redis_connection_pools.setdefault(
+            key, ConnectionPool(port=port, decode_responses=decode_responses)
+        )
+    return Redis(connection_pool=pool)
 
 
 def queue(name):
     return Queue(name, connection=connection())
 
 
+# Every change to a job, its steps or their commands bumps the job's version.
+# The changes sorted set maps what changed ("job" or "step:<id>") to the version it last changed in.
+JOB_VERSION_KEY = "agent:job:{}:version"
+JOB_CHANGES_KEY = "agent:job:{}:changes"
+JOB_CHANGES_TTL = 60 * 60 * 6
+JOB_UPDATES_CHANNEL = "agent:job:{}:updates"
+MARK_JOB_CHANGED_SCRIPT = """
+local version = redis.call("INCR", KEYS[1])
+redis.call("ZADD", KEYS[2], version, ARGV[1])
+redis.call("EXPIRE", KEYS[1], ARGV[2])
+redis.call("EXPIRE", KEYS[2], ARGV[2])
+redis.call("PUBLISH", KEYS[3], version .. " " .. ARGV[1])
+return version
+"""
+
+
+def job_change(step_id=None) -> str:
+    return f"step:{step_id}" if step_id else "job"
+
+
+def mark_job_changed(job_id, change: str, client=None):
+    """
+    Bumps the version of the job, records `change` against it and publishes
+    "<version> <change>" on the job's updates channel.
+
+    Pass a pipeline as `client` to send this along with other commands. The
+    script is sent with EVAL, a registered Script would check it exists with
+    an extra round trip on every pipeline execute.
+    """
+    return (client or connection()).eval(
+        MARK_JOB_CHANGED_SCRIPT,
+        3,
+        JOB_VERSION_KEY.format(job_id),
+        JOB_CHANGES_KEY.format(job_id),
+        JOB_UPDATES_CHANNEL.format(job_id),
+        change,
+        JOB_CHANGES_TTL,
+    )
+
+
 @wrapt.decorator
 def save(wrapped, instance: Action, args, kwargs):
     wrapped(*args, **kwargs)
     instance.model.save()
+    instance.mark_changed()
 
 
 class Action:
@@ -85,6 +152,9 @@ class Action:
         self.model.end = datetime.datetime.now()
         self.model.duration = self.model.end - self.model.start
 
+    def mark_changed(self):
+        """Bumps the version of the job this belongs to, see `mark_job_changed`. A no-op by default."""
+
 
 class Step(Action):
     if TYPE_CHECKING:
@@ -98,6 +168,9 @@ class Step(Action):
         self.model.start = datetime.datetime.now()
         self.model.status = "Running"
 
+    def mark_changed(self):
+        mark_job_changed(self.model.job_id, job_change(self.model.id))
+
 
 class Job(Action):
     if TYPE_CHECKING:
@@ -152,6 +225,9 @@ class Job(Action):
         else:
             self.cancel()
 
+    def mark_changed(self):
+        mark_job_changed(self.model.id, job_change())
+
 
 def step(name):
     @wrapt.decorator
@@ -217,6 +293,39 @@ def get_agent_job_id():
     return request.headers.get("X-Agent-Job-Id")
 
 
+# Data longer than this is stored zlib compressed, as a blob starting with the prefix
+COMPRESSED_DATA_PREFIX = b"zlib:"
+COMPRESS_DATA_ABOVE = 4 * 1024
+
+
+class CompressedTextField(TextField):
+    """
+    TextField that compresses long values.
+
+    Values are decompressed when read, leave the field out of queries that don't
+    need it. Rows saved before compression was added are plain text and read as is.
+    """
+
+    def db_value(self, value):
+        if value is None:
+            return value
+        value = self.adapt(value)
+        if len(value) > COMPRESS_DATA_ABOVE:
+            return COMPRESSED_DATA_PREFIX + zlib.compress(value.encode())
+        return value
+
+    def python_value(self, value):
+        return decompress_data(value)
+
+
+def decompress_data(value: str | bytes | None) -> str | None:
+    if isinstance(value, bytes):
+        if value.startswith(COMPRESSED_DATA_PREFIX):
+            return zlib.decompress(value[len(COMPRESSED_DATA_PREFIX) :]).decode()
+        return value.decode()
+    return value
+
+
 class JobModel(Model):
     name = CharField()
     status = CharField(
@@ -228,7 +337,7 @@ class JobModel(Model):
         ]
     )
     agent_job_id = CharField(null=True)
-    data = TextField(null=True, default="{}")
+    data = CompressedTextField(null=True, default="{}")
 
     enqueue = DateTimeField(default=datetime.datetime.now)
 
@@ -238,13 +347,18 @@ class JobModel(Model):
 
     class Meta:
         database = agent_database
+        # Existing databases get these from the add_composite_indexes_on_job_models patch
+        indexes = (
+            (("status", "id"), False),
+            (("agent_job_id", "id"), False),
+        )
 
 
 class StepModel(Model):
     name = CharField()
     job = ForeignKeyField(JobModel, backref="steps", lazy_load=False)
     status = CharField(choices=[(1, "Running"), (2, "Success"), (3, "Failure")])
-    data = TextField(null=True, default="{}")
+    data = CompressedTextField(null=True, default="{}")
 
     start = DateTimeField()
     end = DateTimeField(null=True)
@@ -252,6 +366,7 @@ class StepModel(Model):
 
     class Meta:
         database = agent_database
+        indexes = ((("job", "id"), False),)
 
 
 class PatchLogModel(Model):
@@ -0,0 +1,152 @@
+from __future__ import annotations
+
+import gzip
+import json
+import os
+import sys
+from datetime import datetime, timedelta
+
+from playhouse.shortcuts import model_to_dict
+
+from agent.job import JobModel, StepModel, agent_database
+
+# Days to keep jobs for, by status. Statuses not listed here are never pruned.
+# Overridden by "job_retention_days" in config.json
+DEFAULT_RETENTION_DAYS = {
+    "Success": 30,
+    "Failure": 90,
+}
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+
+def schedule_pruning(agent_directory: str):
+    """
+    Runs `agent jobs prune` from cron every night, set up by `agent setup prune-jobs`
+    on new servers and by the schedule_job_pruning patch on existing ones.
+    """
+    from crontab import CronTab
+
+    executable = os.path.join(os.path.dirname(sys.executable), "agent")
+    logs_directory = os.path.join(agent_directory, "logs")
+    stdout = os.path.join(logs_directory, "prune.log")
+    stderr = os.path.join(logs_directory, "prune.error.log")
+
+    cron = CronTab(user=True)
+    command = f"cd {agent_directory} && {executable} jobs prune 1>> {stdout} 2>> {stderr}"
+
+    if command not in str(cron):
+        # Archiving and vacuuming are incremental, keep them away from busy hours
+        job = cron.new(command=command)
+        job.hour.on(3)
+        job.minute.on(15)
+        cron.write()
+
+
+class JobRetention:
+    """
+    Moves jobs past their retention period out of jobs.sqlite3 into gzipped
+    JSON lines files, and gives the freed pages back to the filesystem.
+    """
+
+    batch_size = 500
+    vacuum_pages = 1024
+
+    def __init__(self, archive_directory: str, retention_days: dict[str, int] | None = None):
+        self.archive_directory = archive_directory
+        self.retention_days = retention_days or DEFAULT_RETENTION_DAYS
+
+    def expired_jobs(self, now: datetime | None = None):
+        now = now or datetime.now()
+        condition = None
+        for status, days in self.retention_days.items():
+            expired = (JobModel.status == status) & (JobModel.enqueue < now - timedelta(days=days))
+            condition = expired if condition is None else (condition | expired)
+
+        if condition is None:
+            return JobModel.select().where(JobModel.id << [])
+        return JobModel.select().where(condition).order_by(JobModel.id)
+
+    def archive(self, dry_run: bool = False) -> dict:
+        """Archives expired jobs in batches, one archive file per batch."""
+        query = self.expired_jobs()
+        if dry_run:
+            return {"jobs": query.count(), "files": []}
+
+        os.makedirs(self.archive_directory, exist_ok=True)
+        archived, files = 0, []
+        while True:
+            # Archived jobs are deleted, so the next batch always starts at the top
+            jobs = list(query.limit(self.batch_size))
+            if not jobs:
+                break
+
+            files.append(self.archive_batch(jobs))
+            archived += len(jobs)
+        return {"jobs": archived, "files": files}
+
+    def archive_batch(self, jobs: list[JobModel]) -> str:
+        ids = [job.id for job in jobs]
+        steps = {}
+        for step in StepModel.select().where(StepModel.job << ids).order_by(StepModel.id):
+            step = model_to_dict(step, recurse=False)
+            steps.setdefault(step["job"], []).append(step)
+
+        path = os.path.join(self.archive_directory, f"jobs-{ids[0]}-{ids[-1]}.jsonl.gz")
+        # Write the archive completely before deleting anything it holds
+        with gzip.open(f"{path}.tmp", "wt") as f:
+            for job in jobs:
+                record = model_to_dict(job)
+                record["steps"] = steps.get(job.id, [])
+                f.write(json.dumps(record, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(f"{path}.tmp", path)
+
+        with agent_database.atomic():
+            StepModel.delete().where(StepModel.job << ids).execute()
+            JobModel.delete().where(JobModel.id << ids).execute()
+        return path
+
+    def vacuum(self) -> dict:
+        """
+        Releases free pages with incremental vacuum, a few at a time so writers
+        aren't blocked for long. Needs auto_vacuum to be set to incremental.
+        """
+        before = self.size()
+        page_size = self.pragma("page_size")
+        free_pages = self.pragma("freelist_count")
+        incremental = self.pragma("auto_vacuum") == AUTO_VACUUM_INCREMENTAL
+        if incremental:
+            while self.pragma("freelist_count"):
+                agent_database.execute_sql(f"PRAGMA incremental_vacuum({self.vacuum_pages})").fetchall()
+            # Freed pages only leave the main file once the WAL is checkpointed
+            agent_database.execute_sql("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+        after = self.size()
+        return {
+            "incremental": incremental,
+            "free_pages": free_pages,
+            "free_size": free_pages * page_size,
+            "size_before": before,
+            "size_after": after,
+            "reclaimed": before - after,
+        }
+
+    def enable_incremental_vacuum(self):
+        """
+        Switches the database to incremental auto vacuum. Rewrites the whole file
+        with a full VACUUM, which blocks writers until it's done.
+        """
+        agent_database.execute_sql("PRAGMA auto_vacuum = INCREMENTAL")
+        agent_database.execute_sql("VACUUM")
+
+    def pragma(self, name: str) -> int:
+        return agent_database.execute_sql(f"PRAGMA {name}").fetchone()[0]
+
+    def size(self) -> int:
+        return sum(
+            os.path.getsize(path)
+            for path in (agent_database.database, f"{agent_database.database}-wal")
+            if os.path.exists(path)
+        )
@@ -1,22 +1,34 @@
 from __future__ import annotations
 
-import contextlib
-import glob
 import json
 import os
-import re
 import signal
 import subprocess
 import time
 import traceback
 from datetime import datetime
 from enum import Enum, auto
+from typing import TYPE_CHECKING
 
-import redis
+from agent.job import connection
+
+if TYPE_CHECKING:
+    from agent.proxy import ProxyConfigUpdate
 
 PENDING_QUEUE = "nginx||pending_queue"
 PROCESSING_QUEUE = "nginx||processing_queue"
 RELOAD_REQUEST_STATUS_FORMAT = "nginx_reload_status||{}"
+# Hash of the proxy config NGINX was last reloaded with, see Proxy.get_proxy_config_hash
+RELOADED_CONFIG_HASH = "nginx||reloaded_config_hash"
+RELOAD_COUNTERS = "nginx||reload_counters"
+# Unix time every queued request was made at, to measure how long it waited
+RELOAD_REQUESTED_AT = "nginx||reload_requested_at"
+# Hosts and upstreams every queued request changed, see ProxyIndex.updated_units
+RELOAD_REQUEST_UNITS = "nginx||reload_request_units"
+RELOAD_WAIT_HISTOGRAM = "nginx||reload_wait_histogram"
+RELOAD_WAIT_BUCKETS = (1, 2, 5, 10, 15, 30, 60, 120, 300, 600)
+# Weight of the latest observation in the moving averages of drain and reload times
+MOVING_AVERAGE_WEIGHT = 0.3
 
 
 class ReloadStatus(Enum):
@@ -37,20 +49,34 @@ class ManagerState(Enum):
 
 
 class NginxReloadManager:
-    redis_instance = None
     batch_size = 1000
 
     def __init__(self, directory=None, debug=False):
         self.directory = directory or os.getcwd()
         self.config_file = os.path.join(self.directory, "config.json")
         self.last_reload_at: datetime = None
+        # Old workers finish their connections after a reload, every reload while
+        # they do adds another generation. Seconds since the reload and estimates
+        # of drain and reload times are kept to schedule reloads around them.
+        self.draining_since: float | None = None
+        self.drain_time: float | None = None
+        self.reload_time: float | None = None
+        self.oldest_requested_at: float | None = None
+        self.job_ids = []
+        self.proxy_config_update: ProxyConfigUpdate | None = None
+        self.deferred = False
         self.exit_requested = False
         self.debug = debug
         self.state = ManagerState.INIT
 
-    def request_reload(self, request_id: str):
-        self.redis.rpush(PENDING_QUEUE, request_id)
-        self.redis.set(RELOAD_REQUEST_STATUS_FORMAT.format(request_id), ReloadStatus.Queued.value)
+    def request_reload(self, request_id: str, units: list[str] | None = None):
+        pipeline = self.redis.pipeline()
+        pipeline.hset(RELOAD_REQUESTED_AT, request_id, time.time())
+        if units:
+            pipeline.hset(RELOAD_REQUEST_UNITS, request_id, json.dumps(units))
+        pipeline.rpush(PENDING_QUEUE, request_id)
+        pipeline.set(RELOAD_REQUEST_STATUS_FORMAT.format(request_id), ReloadStatus.Queued.value)
+        pipeline.execute()
 
     def get_status(self, request_id: str, not_found_status: ReloadStatus) -> ReloadStatus | None:
         status = self.redis.get(RELOAD_REQUEST_STATUS_FORMAT.format(request_id))
@@ -79,7 +105,9 @@ class NginxReloadManager:
     def _process_state(self):  # noqa: C901
         if self.state == ManagerState.FETCH_JOBS:
             self.start_time = datetime.now()
+            self.deferred = False
             self.job_ids = self._dequeue_jobs()
+            self.oldest_requested_at = self._get_oldest_requested_at(self.job_ids)
             if self.job_ids or self.is_mandatory_reload_required:
                 self.state = ManagerState.RELOAD_PENDING
                 return
@@ -87,7 +115,8 @@ class NginxReloadManager:
             self.state = ManagerState.WAIT
 
         elif self.state == ManagerState.RELOAD_PENDING:
-            if self._should_skip_nginx_reload():
+            self.deferred = self._should_defer_reload()
+            if self.deferred:
                 self.state = ManagerState.WAIT
                 return
 
@@ -100,8 +129,17 @@ class NginxReloadManager:
             )
 
         elif self.state == ManagerState.RELOAD_SUCCESS:
-            self._update_status_and_cleanup(self.job_ids, ReloadStatus.Success)
-            self.last_reload_at = datetime.now()
+            update = self.proxy_config_update
+            if update and update.unchecked:
+                # Requests are done once every change is applied or quarantined, checked on the next reload
+                self.log(f"Keeping {len(self.job_ids)} requests queued until changes are validated")
+                self.state = ManagerState.WAIT
+                return
+
+            failed = self._get_quarantined_requests(self.job_ids, update.quarantined if update else {})
+            if failed:
+                self.log(f"Failing {len(failed)} requests with quarantined changes", print_always=True)
+            self._update_status_and_cleanup(self.job_ids, ReloadStatus.Success, failed)
             self.state = ManagerState.WAIT
 
         elif self.state == ManagerState.RELOAD_FAILURE:
@@ -109,18 +147,19 @@ class NginxReloadManager:
             self.state = ManagerState.WAIT
 
         elif self.state == ManagerState.AUTO_FIX_CONFIG:
-            if isinstance(self.error, subprocess.CalledProcessError):
-                error_msg = self.error.stderr or ""
-                domain = self._find_conflicting_domain_from_error_message(error_msg)
-                if domain and self._fix_conflicting_domain_in_config(domain):
-                    self.state = ManagerState.RELOAD_PENDING
-                    return
+            if isinstance(self.error, subprocess.CalledProcessError) and self._fix_conflicting_domain(
+                self.error.stderr or ""
+            ):
+                self.state = ManagerState.RELOAD_PENDING
+                return
 
             self.state = ManagerState.RELOAD_FAILURE
 
         elif self.state == ManagerState.WAIT:
-            elapsed_time = datetime.now() - self.start_time
-            if (sleep_time := self.max_permissible_wait_time - elapsed_time.total_seconds()) > 0:
+            if self.draining_since is not None:
+                # Sampled on every tick, so time spent idle after the drain isn't counted as drain
+                self._get_nginx_workers()
+            if (sleep_time := self._get_wait_time()) > 0:
                 self.log(f"Waiting for {sleep_time:.2f} seconds before next check")
                 time.sleep(sleep_time)
 
@@ -130,10 +169,24 @@ class NginxReloadManager:
     def _reload_nginx(self) -> ReloadStatus:
         from agent.proxy import Proxy
 
+        self.proxy_config_update = None
         try:
             proxy = Proxy()
 
-            proxy._generate_proxy_config()
+            update = proxy._generate_proxy_config(validate=self.config.get("validate_proxy_config", True))
+            self.proxy_config_update = update
+            for message in update.messages:
+                self.log(message, print_always=True)
+
+            config_hash = proxy.get_proxy_config_hash()
+            if config_hash == self.redis.get(RELOADED_CONFIG_HASH):
+                self.log("Proxy config unchanged, skipping reload")
+                self.redis.hincrby(RELOAD_COUNTERS, "skipped")
+                # NGINX already runs this config, same as right after a reload
+                self.last_reload_at = datetime.now()
+                return ReloadStatus.Success
+
+            reload_started_at = time.monotonic()
             subprocess.run(
                 "sudo nginx -s reload",
                 shell=True,
@@ -141,69 +194,104 @@ class NginxReloadManager:
                 capture_output=True,
                 text=True,
             )
+            self.draining_since = time.monotonic()
+            self.reload_time = moving_average(self.reload_time, self.draining_since - reload_started_at)
 
+            self.redis.set(RELOADED_CONFIG_HASH, config_hash)
+            self.redis.hincrby(RELOAD_COUNTERS, "performed")
             self.last_reload_at = datetime.now()
             return ReloadStatus.Success
         except Exception as e:
             self.error = e
+            self.redis.hincrby(RELOAD_COUNTERS, "failed")
 
             traceback.print_exc()
             self.log(f"Error while reloading nginx : {e!s}")
             return ReloadStatus.Failure
 
-    def _should_skip_nginx_reload(self):
+    def get_reload_counters(self) -> dict[str, int]:
+        """Reloads performed, skipped because nothing changed, and failed since counting started."""
+        counters = self.redis.hgetall(RELOAD_COUNTERS)
+        return {result: int(counters.get(result, 0)) for result in ("performed", "skipped", "failed")}
+
+    def get_reload_wait_histogram(self) -> tuple[list[tuple[str, int]], float]:
+        """Cumulative counts of requests by seconds waited until their reload, and the sum of waits."""
+        histogram = self.redis.hgetall(RELOAD_WAIT_HISTOGRAM)
+        buckets, count = [], 0
+        for bound in [*map(str, RELOAD_WAIT_BUCKETS), "+Inf"]:
+            count += int(histogram.get(bound, 0))
+            buckets.append((bound, count))
+        return buckets, float(histogram.get("sum", 0))
+
+    def _should_defer_reload(self) -> bool:
         """
-        ├─983331 nginx: worker process is shutting down
-        ├─983332 nginx: worker process is shutting down
-        ├─983333 nginx: worker process is shutting down
-        ├─983334 nginx: worker process is shutting down
-        ├─983361 nginx: worker process
-        ├─983362 nginx: worker process
-        ├─983363 nginx: worker process
-        ├─983364 nginx: worker process
-        └─983369 nginx: cache manager process
+        Defers the reload while old workers are still shutting down.
+
+        Not for longer than the oldest request can wait within the latency SLO,
+        less the more requests are queued, and not when that's shorter than a
+        check. Too many old workers always defer, each of them holds on to its
+        connections and memory.
         """
-        try:
-            status = subprocess.run(
-                "sudo systemctl status nginx", capture_output=True, shell=True
-            ).stdout.decode("utf-8")
-            total_workers = status.count("nginx: worker process") + status.count("nginx: master process")
-            dying_workers = status.count("nginx: worker process is shutting down")
-            active_workers = max(1, total_workers - dying_workers)
-            return dying_workers >= active_workers or dying_workers >= 4
-        except Exception as e:
-            self.log(f"Failed to check nginx status : {e!s}")
+        workers = self._get_nginx_workers()
+        if not workers:
             return False
+        active, shutting_down = workers
+        if shutting_down >= max(active, 1) * self.max_draining_generations:
+            self.log(f"Deferring reload | {shutting_down} workers shutting down", print_always=True)
+            return True
+        if not shutting_down:
+            return False
+        return self._get_defer_budget() > self.max_permissible_wait_time
 
-    def _find_conflicting_domain_from_error_message(self, error_message: str) -> str | None:
-        match = re.search(r'conflicting parameter "(.*?)"', error_message)
-        if not match:
-            return None
-        return match.group(1)
-
-    def _fix_conflicting_domain_in_config(self, domain: str) -> bool:
-        self.log(f"Domain {domain} is conflicting, attempting auto fix", print_always=True)
+    def _get_wait_time(self) -> float:
+        """
+        Seconds until the next check.
 
-        # Find the paths
-        paths = glob.glob(os.path.join(self.directory, f"nginx/upstreams/*/{domain}"))
-        paths.sort(key=lambda x: os.path.getmtime(x))
+        Reloads are at least `60 / max_reloads_per_minute` seconds apart. A
+        deferred reload waits until old workers are expected to be done, but
+        not past what's left of its deferral budget.
+        """
+        wait_time = self.max_permissible_wait_time - (datetime.now() - self.start_time).total_seconds()
+        if self.deferred and self.draining_since is not None:
+            drain_time = self.drain_time or self.max_permissible_wait_time
+            drain_left = drain_time - (time.monotonic() - self.draining_since)
+            wait_time = max(wait_time, min(drain_left, self._get_defer_budget()))
+        return wait_time
+
+    def _get_defer_budget(self) -> float:
+        """Seconds a reload can be deferred: the latency budget, scaled down to none for a full batch."""
+        queued = min(len(self.job_ids), self.batch_size)
+        if queued == self.batch_size:
+            return 0
+        return self._get_latency_budget() * (1 - queued / self.batch_size)
+
+    def _get_latency_budget(self) -> float:
+        """Seconds the oldest request can still wait and be done within the latency SLO."""
+        if self.oldest_requested_at is None:
+            return float("inf") if not self.job_ids else 0
+        waited = time.time() - self.oldest_requested_at
+        return self.reload_latency_slo - waited - (self.reload_time or 0)
+
+    def _get_nginx_workers(self) -> tuple[int, int] | None:
+        try:
+            active, shutting_down = get_nginx_workers(self.nginx_pid_file)
+        except Exception as e:
+            self.log(f"Failed to check nginx workers : {e!s}")
+            return None
 
-        if len(paths) < 2:
-            self.log(f"Not able to auto fix the issue for domain : {domain!s}", print_always=True)
-            return False
+        # First check without workers shutting down since the reload ends its drain
+        if self.draining_since is not None and not shutting_down:
+            self.drain_time = moving_average(self.drain_time, time.monotonic() - self.draining_since)
+            self.draining_since = None
+        return active, shutting_down
 
-        # Keep newest file and delete the rest
-        to_keep = paths[-1]
-        self.log(f"Keeping {to_keep}", print_always=True)
-        to_delete = paths[:-1]
-        for path in to_delete:
-            with contextlib.suppress(FileNotFoundError):
-                # In case RQ worker removed the file
-                # before we could delete it
-                os.remove(path)
-            self.log(f"Deleted {path}", print_always=True)
+    def _fix_conflicting_domain(self, error: str) -> bool:
+        from agent.proxy import Proxy
 
-        return True
+        removed = Proxy()._fix_conflicting_domain(error)
+        for path in removed:
+            self.log(f"Deleted conflicting site file {path}", print_always=True)
+        return bool(removed)
 
     def _dequeue_jobs(self) -> list[str]:
         # Fetch up to 10000 jobs, which might not be hit ever
@@ -221,10 +309,39 @@ class NginxReloadManager:
         self.log(f"Dequeued {len(job_ids)} jobs")
         return jobs
 
-    def _update_status_and_cleanup(self, job_ids: list[str], status: ReloadStatus):
-        for job_id in job_ids:
-            self.redis.set(RELOAD_REQUEST_STATUS_FORMAT.format(job_id), status.value)
-        self.redis.ltrim(PROCESSING_QUEUE, len(job_ids), -1)
+    def _get_oldest_requested_at(self, job_ids: list[str]) -> float | None:
+        # Requests are processed in order, the first one waited the longest
+        if not job_ids:
+            return None
+        requested_at = self.redis.hget(RELOAD_REQUESTED_AT, job_ids[0])
+        return float(requested_at) if requested_at else None
+
+    def _get_quarantined_requests(self, job_ids: list[str], quarantined: dict[str, str]) -> set[str]:
+        """Requests that changed a host or upstream whose changes are quarantined"""
+        if not job_ids or not quarantined:
+            return set()
+        units = self.redis.hmget(RELOAD_REQUEST_UNITS, job_ids)
+        return {
+            job_id
+            for job_id, job_units in zip(job_ids, units)
+            if job_units and not quarantined.keys().isdisjoint(json.loads(job_units))
+        }
+
+    def _update_status_and_cleanup(self, job_ids: list[str], status: ReloadStatus, failed=()):
+        requested_at = self.redis.hmget(RELOAD_REQUESTED_AT, job_ids) if job_ids else []
+        now = time.time()
+
+        pipeline = self.redis.pipeline()
+        for job_id, job_requested_at in zip(job_ids, requested_at):
+            job_status = ReloadStatus.Failure if job_id in failed else status
+            pipeline.set(RELOAD_REQUEST_STATUS_FORMAT.format(job_id), job_status.value)
+            if job_requested_at:
+                observe_wait_time(pipeline, now - float(job_requested_at))
+        if job_ids:
+            pipeline.hdel(RELOAD_REQUESTED_AT, *job_ids)
+            pipeline.hdel(RELOAD_REQUEST_UNITS, *job_ids)
+        pipeline.ltrim(PROCESSING_QUEUE, len(job_ids), -1)
+        pipeline.execute()
 
     def exit_gracefully(self, signum, frame):
         if self.exit_requested:
@@ -242,12 +359,7 @@ class NginxReloadManager:
     # Properties
     @property
     def redis(self):
-        if not self.redis_instance:
-            self.redis_instance = redis.Redis(
-                port=self.config.get("redis_port", 25025),
-                decode_responses=True,
-            )
-        return self.redis_instance
+        return connection(port=self.config.get("redis_port", 25025), decode_responses=True)
 
     @property
     def config(self) -> dict:
@@ -269,6 +381,20 @@ class NginxReloadManager:
         """Maximum allowed minutes without a reload before forcing a voluntary reload."""
         return self.config.get("max_interval_without_reload_minutes", 10)
 
+    @property
+    def reload_latency_slo(self) -> float:
+        """Seconds a reload request should take until it's done, the scheduler defers reloads within this."""
+        return self.config.get("nginx_reload_latency_slo", 30)
+
+    @property
+    def max_draining_generations(self) -> int:
+        """Generations of old workers that may be shutting down before reloads wait regardless."""
+        return self.config.get("nginx_max_draining_generations", 3)
+
+    @property
+    def nginx_pid_file(self) -> str:
+        return self.config.get("nginx_pid_file", "/run/nginx.pid")
+
     @property
     def is_mandatory_reload_required(self) -> bool:
         """Check if a mandatory reload is required."""
@@ -279,6 +405,52 @@ class NginxReloadManager:
         )
 
 
+def get_nginx_workers(pid_file: str, proc_directory: str = "/proc") -> tuple[int, int]:
+    """
+    Returns counts of active and shutting down workers of the NGINX master.
+
+    Workers are the master's children in /proc, NGINX sets their command line
+    to "nginx: worker process" or "nginx: worker process is shutting down".
+    """
+    with open(pid_file) as f:
+        master = f.read().strip()
+
+    active = shutting_down = 0
+    for pid in os.listdir(proc_directory):
+        if not pid.isdigit():
+            continue
+        try:
+            with open(os.path.join(proc_directory, pid, "stat")) as f:
+                stat = f.read()
+            # Fields after the command name, which is in parentheses and may have spaces
+            if stat[stat.rindex(")") + 2 :].split()[1] != master:
+                continue
+            with open(os.path.join(proc_directory, pid, "cmdline"), "rb") as f:
+                cmdline = f.read().replace(b"\0", b" ").decode(errors="replace")
+        except (FileNotFoundError, ProcessLookupError, PermissionError, ValueError, IndexError):
+            # Process exited while being read
+            continue
+
+        if "shutting down" in cmdline:
+            shutting_down += 1
+        elif "worker process" in cmdline:
+            active += 1
+    return active, shutting_down
+
+
+def observe_wait_time(pipeline, seconds: float):
+    """Adds a request's wait to the histogram, in the bucket of the smallest bound above it"""
+    bucket = next((str(bound) for bound in RELOAD_WAIT_BUCKETS if seconds <= bound), "+Inf")
+    pipeline.hincrby(RELOAD_WAIT_HISTOGRAM, bucket)
+    pipeline.hincrbyfloat(RELOAD_WAIT_HISTOGRAM, "sum", seconds)
+
+
+def moving_average(average: float | None, value: float) -> float:
+    if average is None:
+        return value
+    return (1 - MOVING_AVERAGE_WEIGHT) * average + MOVING_AVERAGE_WEIGHT * value
+
+
 if __name__ == "__main__":
     manager = NginxReloadManager()
     manager.process_requests()
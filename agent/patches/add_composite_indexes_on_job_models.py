@@ -0,0 +1,13 @@
+from __future__ import annotations
+
+
+def execute():
+    """add composite indexes used by job listing endpoints on JobModel and StepModel"""
+    from agent.job import agent_database as database
+
+    database.execute_sql('CREATE INDEX IF NOT EXISTS "jobmodel_status_id" ON "jobmodel" ("status", "id")')
+    database.execute_sql(
+        'CREATE INDEX IF NOT EXISTS "jobmodel_agent_job_id_id" ON "jobmodel" ("agent_job_id", "id")'
+    )
+    database.execute_sql('CREATE INDEX IF NOT EXISTS "stepmodel_job_id_id" ON "stepmodel" ("job_id", "id")')
+    database.execute_sql("ANALYZE")
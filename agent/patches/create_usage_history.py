@@ -0,0 +1,11 @@
+from __future__ import annotations
+
+import os
+
+
+def execute():
+    """create the usage history table, with samples from the usage JSON logs"""
+    from agent.server import Server
+    from agent.usage_history import create_usage_history
+
+    create_usage_history(os.path.join(os.getcwd(), "logs"), Server().name)
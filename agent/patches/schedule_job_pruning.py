@@ -0,0 +1,10 @@
+from __future__ import annotations
+
+import os
+
+
+def execute():
+    """schedule a nightly `agent jobs prune` so jobs.sqlite3 stops growing"""
+    from agent.job_retention import schedule_pruning
+
+    schedule_pruning(os.getcwd())
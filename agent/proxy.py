@@ -2,18 +2,45 @@ from __future__ import annotations
 
 import json
 import os
+import re
 import shutil
 from collections import defaultdict
-from contextlib import contextmanager
+from contextlib import contextmanager, suppress
+from dataclasses import dataclass, field
+from datetime import datetime
 from functools import wraps
 from hashlib import sha512 as sha
 from pathlib import Path
 
 import filelock
+from jinja2 import Environment, PackageLoader
 
 from agent.job import job, step
+from agent.proxy_index import ProxyIndex
+from agent.proxy_validation import (
+    ProxyConfigValidationError,
+    ProxyConfigValidator,
+    get_change_fingerprint,
+    get_unit,
+)
 from agent.server import Server
 
+CERTIFICATE_FILES = ("fullchain.pem", "privkey.pem", "chain.pem")
+CERTIFICATE_DIRECTIVE = re.compile(r"^\s*ssl_(?:trusted_)?certificate(?:_key)? (\S+);", re.M)
+CONFLICTING_DOMAIN_ERROR = re.compile(r'conflicting parameter "(.*?)"')
+
+
+@dataclass
+class ProxyConfigUpdate:
+    """Outcome of generating the proxy config, for the NGINX reload manager to act on"""
+
+    changed: list[str] = field(default_factory=list)
+    # Hosts and upstreams whose changes failed validation, with their errors
+    quarantined: dict[str, str] = field(default_factory=dict)
+    # Hosts and upstreams whose changes are kept back until they're validated
+    unchecked: list[str] = field(default_factory=list)
+    messages: list[str] = field(default_factory=list)
+
 
 def with_proxy_config_lock():
     def decorator(func):
@@ -39,6 +66,7 @@ class Proxy(Server):
         self.hosts_directory = os.path.join(self.nginx_directory, "hosts")
         self.error_pages_directory = os.path.join(self.directory, "repo", "agent", "pages")
         self._proxy_config_modification_lock = None
+        self._index = None
         self.job = None
         self.step = None
 
@@ -65,6 +93,7 @@ class Proxy(Server):
         for key, value in certificate.items():
             with open(os.path.join(host_directory, key), "w") as f:
                 f.write(value)
+        self.index.update_host(host)
 
     @job("Add Wildcard Hosts to Proxy")
     def add_wildcard_hosts_job(self, wildcards):
@@ -88,6 +117,7 @@ class Proxy(Server):
                     f.write(value)
             if wildcard.get("code_server"):
                 Path(os.path.join(host_directory, "codeserver")).touch()
+            self.index.update_host(host)
 
     def add_site_domain_to_upstream(self, upstream, site):
         with self.proxy_config_modification_lock:
@@ -111,6 +141,7 @@ class Proxy(Server):
             conflict = os.path.join(self.upstreams_directory, upstream, site)
             if os.path.exists(conflict):
                 os.remove(conflict)
+                self.index.update_site(upstream, site)
 
     @step("Add Site File to Upstream Directory")
     @with_proxy_config_lock()
@@ -119,6 +150,7 @@ class Proxy(Server):
         os.makedirs(upstream_directory, exist_ok=True)
         site_file = os.path.join(upstream_directory, site)
         Path(site_file).touch()
+        self.index.update_site(upstream, site)
 
     @job("Add Upstream to Proxy")
     def add_upstream_job(self, upstream):
@@ -130,6 +162,7 @@ class Proxy(Server):
     def add_upstream(self, upstream):
         upstream_directory = os.path.join(self.upstreams_directory, upstream)
         os.makedirs(upstream_directory, exist_ok=True)
+        self.index.update_upstream(upstream)
 
     @job("Rename Upstream")
     def rename_upstream_job(self, old, new):
@@ -142,6 +175,8 @@ class Proxy(Server):
         old_upstream_directory = os.path.join(self.upstreams_directory, old)
         new_upstream_directory = os.path.join(self.upstreams_directory, new)
         shutil.move(old_upstream_directory, new_upstream_directory)
+        self.index.update_upstream(old)
+        self.index.update_upstream(new)
 
     @job("Remove Host from Proxy")
     def remove_host_job(self, host):
@@ -153,6 +188,7 @@ class Proxy(Server):
         host_directory = os.path.join(self.hosts_directory, host)
         if os.path.exists(host_directory):
             shutil.rmtree(host_directory)
+        self.index.update_host(host)
 
     @job("Remove Site from Upstream")
     def remove_site_from_upstream_job(self, upstream, site, extra_domains=None):
@@ -175,6 +211,8 @@ class Proxy(Server):
     @with_proxy_config_lock()
     def remove_site_from_upstream(self, site_file):
         os.remove(site_file)
+        upstream_directory, site = os.path.split(site_file)
+        self.index.update_site(os.path.basename(upstream_directory), site)
 
     @job("Rename Site on Upstream")
     def rename_site_on_upstream_job(
@@ -210,6 +248,8 @@ class Proxy(Server):
         old_host_dir = os.path.join(self.hosts_directory, old_name)
         new_host_dir = os.path.join(self.hosts_directory, new_name)
         os.rename(old_host_dir, new_host_dir)
+        self.index.update_host(old_name)
+        self.index.update_host(new_name)
 
     @step("Rename Site in Host Directory")
     @with_proxy_config_lock()
@@ -223,6 +263,7 @@ class Proxy(Server):
         redirect_file = os.path.join(host_directory, "redirect.json")
         if os.path.exists(redirect_file):
             self.replace_str_in_json(redirect_file, old_name, new_name)
+        self.index.update_host(host)
 
     @step("Rename Site File in Upstream Directory")
     @with_proxy_config_lock()
@@ -233,6 +274,8 @@ class Proxy(Server):
         if not os.path.exists(old_site_file) and os.path.exists(new_site_file):
             return
         os.rename(old_site_file, new_site_file)
+        self.index.update_site(upstream, site)
+        self.index.update_site(upstream, new_name)
 
     @job("Update Site Status")
     def update_site_status_job(self, upstream, site, status, extra_domains=None, skip_reload=False):
@@ -251,6 +294,7 @@ class Proxy(Server):
         site_file = os.path.join(upstream_directory, site)
         with open(site_file, "w") as f:
             f.write(status)
+        self.index.update_site(upstream, site)
 
     @job("Setup Redirects on Hosts")
     def setup_redirects_job(self, hosts, target):
@@ -276,6 +320,7 @@ class Proxy(Server):
         redirects[host] = target
         with open(redirect_file, "w") as r:
             json.dump(redirects, r, indent=4)
+        self.index.update_host(host)
 
     @job("Remove Redirects on Hosts")
     def remove_redirects_job(self, hosts):
@@ -293,6 +338,7 @@ class Proxy(Server):
         if host.endswith("." + self.domain):
             # default domain
             os.rmdir(host_directory)
+        self.index.update_host(host)
 
     @step("Reload NGINX")
     def reload_nginx(self):
@@ -302,26 +348,269 @@ class Proxy(Server):
     def reload_nginx_job(self):
         return self.reload_nginx()
 
-    def _generate_proxy_config(self):
-        proxy_config_file = os.path.join(self.nginx_directory, "proxy.conf")
+    def _generate_proxy_config(self, validate: bool = False) -> ProxyConfigUpdate:
+        """
+        Writes proxy.conf and its include files from the index of hosts and upstreams.
+
+        Every upstream and host gets its own include files under proxy.d. Files
+        are rendered into a candidate directory first, and only files whose
+        content changed are copied over. Returns the changed files, along with
+        the hosts and upstreams whose changes were kept back.
+        """
         config = self.get_config()
         with self.proxy_config_modification_lock:
-            data = {
-                "hosts": self.hosts,
-                "upstreams": self.upstreams,
-                "domain": config["domain"],
-                "wildcards": sorted(self.wildcards, key=lambda x: len(x)),
-                "nginx_directory": config["nginx_directory"],
-                "error_pages_directory": self.error_pages_directory,
-                "tls_protocols": config.get("tls_protocols"),
-                "custom_directives": self.config.get("custom_proxy_directives", []),
+            self.index.sync()
+            hosts = self.index.hosts()
+            upstreams = self.index.upstreams()
+            wildcards = sorted(self.index.wildcards(), key=lambda x: len(x))
+            # Copied under the lock, add_host writes certificate files in place
+            certificates = {
+                certificate_host: self._get_certificate_paths(certificate_host)
+                for certificate_host in {get_certificate_host(host, wildcards) for host in hosts}
             }
 
-        self._render_template(
+        files = ProxyConfigFiles(self.proxy_candidate_directory)
+        for name, upstream in upstreams.items():
+            upstream_hash = upstream["hash"]
+            # Only the server of an upstream goes in its block, site changes leave it as is
+            files.render(
+                f"upstreams/{upstream_hash}.conf",
+                "proxy/upstream.conf.jinja2",
+                name=name,
+                upstream={"hash": upstream_hash},
+            )
+            files.render(
+                f"upstream-sites/{upstream_hash}.conf", "proxy/upstream_sites.conf.jinja2", upstream=upstream
+            )
+
+        host_context = {
+            "domain": config["domain"],
+            "nginx_directory": config["nginx_directory"],
+            "error_pages_directory": self.error_pages_directory,
+            "tls_protocols": config.get("tls_protocols"),
+            "custom_directives": self.config.get("custom_proxy_directives", []),
+        }
+        for host, options in hosts.items():
+            name = host.replace("*", "_")
+            files.render(f"host-maps/{name}.conf", "proxy/host_map.conf.jinja2", host_options=options)
+            # A renewed certificate has new paths, so it's a change to the host, validated as one
+            context = {
+                "host": host,
+                "host_options": options,
+                "certificates": certificates[get_certificate_host(host, wildcards)],
+                **host_context,
+            }
+            files.render(f"hosts/{name}.conf", "proxy/host.conf.jinja2", **context)
+
+        proxy_config_context = {
+            "domain": config["domain"],
+            "error_pages_directory": self.error_pages_directory,
+        }
+        files.render(
+            "proxy.conf",
             "proxy/nginx.conf.jinja2",
-            data,
-            proxy_config_file,
+            proxy_config_directory=self.proxy_config_directory,
+            **proxy_config_context,
         )
+        files.save()
+
+        validator = None
+        if validate:
+            validation_directory = os.path.join(self.nginx_directory, "proxy-validation")
+            validator = ProxyConfigValidator(self, validation_directory, proxy_config_context)
+        update = self._swap_proxy_config(files, validator)
+
+        host_config_directory = os.path.join(self.proxy_config_directory, "hosts")
+        if any(path.startswith(host_config_directory) for path in update.changed):
+            self._remove_unused_certificates(files, certificates)
+        return update
+
+    def _get_certificate_paths(self, certificate_host: str) -> dict[str, str]:
+        """
+        Copies of a host's certificate files, by their modification time.
+
+        Host configs use the copies, so a renewed certificate gets new paths,
+        and the last working config keeps loading the previous certificate.
+        """
+        source_directory = os.path.join(self.hosts_directory, certificate_host)
+        directory = os.path.join(self.certificates_directory, certificate_host.replace("*", "_"))
+        paths = {}
+        for file in CERTIFICATE_FILES:
+            source = os.path.join(source_directory, file)
+            try:
+                stat = os.stat(source)
+            except FileNotFoundError:
+                # NGINX reports the missing file
+                paths[file] = source
+                continue
+
+            name, extension = os.path.splitext(file)
+            path = os.path.join(directory, f"{name}-{stat.st_mtime_ns}{extension}")
+            if not os.path.exists(path):
+                os.makedirs(directory, exist_ok=True)
+                shutil.copy(source, f"{path}.tmp")
+                os.rename(f"{path}.tmp", path)
+            paths[file] = path
+        return paths
+
+    def _remove_unused_certificates(self, candidate: ProxyConfigFiles, certificates: dict[str, dict]):
+        """Removes certificate copies used by neither the candidate nor the live host configs"""
+        used = {path for paths in certificates.values() for path in paths.values()}
+        # Quarantined hosts and ones left to validate keep their live config
+        live = ProxyConfigFiles(self.proxy_config_directory)
+        for file, fingerprint in live.manifest.items():
+            if file.startswith("hosts/") and candidate.files.get(file) != fingerprint:
+                with suppress(FileNotFoundError), open(self._get_live_config_path(file)) as f:
+                    used.update(CERTIFICATE_DIRECTIVE.findall(f.read()))
+
+        for root, _, names in os.walk(self.certificates_directory, topdown=False):
+            for name in names:
+                if (path := os.path.join(root, name)) not in used:
+                    os.remove(path)
+            with suppress(OSError):
+                os.rmdir(root)
+
+    def _swap_proxy_config(
+        self, candidate: ProxyConfigFiles, validator: ProxyConfigValidator | None
+    ) -> ProxyConfigUpdate:
+        """
+        Copies changed files of the candidate config to the config NGINX uses.
+
+        With a validator, changes are checked with `nginx -t` first. Hosts and
+        upstreams whose changes fail are quarantined, their last working files
+        are kept until their changes change again. Changes left unchecked, once
+        the validator gives up, are kept back for the next reload.
+        """
+        update = ProxyConfigUpdate()
+        live = ProxyConfigFiles(self.proxy_config_directory)
+        changes = self._get_proxy_config_changes(live, candidate)
+
+        quarantine = self._read_proxy_config_quarantine()
+        for unit in list(quarantine):
+            if quarantine[unit]["fingerprint"] != get_change_fingerprint(changes.get(unit)):
+                del quarantine[unit]
+
+        # Only hosts and upstreams are validated, proxy.conf itself only changes with the agent
+        units = {unit: change for unit, change in changes.items() if unit and unit not in quarantine}
+        if validator and units:
+            base = {file: self._get_live_config_path(file) for file in live.manifest if get_unit(file)}
+            sources = {
+                unit: {file: fingerprint and candidate.path(file) for file, fingerprint in change.items()}
+                for unit, change in units.items()
+            }
+            try:
+                invalid, valid = validator.check_changes(base, sources)
+            except ProxyConfigValidationError as e:
+                # The live config is broken already, the changes may fix it
+                update.messages.append(f"Proxy config changes not validated: {e}")
+                invalid, valid = {}, list(sources)
+            fixed = []
+            for unit, error in invalid.items():
+                removed = self._fix_conflicting_domain(error)
+                if removed:
+                    # Checked again on the next reload, along with the removals
+                    update.messages.append(f"Removed conflicting site files for {unit}: {', '.join(removed)}")
+                    fixed.append(unit)
+                    continue
+                update.messages.append(f"Quarantined {unit}: {error}")
+                quarantine[unit] = {
+                    "fingerprint": get_change_fingerprint(changes[unit]),
+                    "error": error,
+                    "quarantined_at": str(datetime.now()),
+                }
+            # Changes that weren't checked stay in the candidate, they're checked on the next reload
+            update.unchecked = sorted((set(units) - set(invalid) - set(valid)) | set(fixed))
+            if update.unchecked:
+                update.messages.append(f"Proxy config changes left to validate: {len(update.unchecked)}")
+
+        kept_back = {*quarantine, *update.unchecked}
+        update.changed = self._apply_proxy_config_changes(
+            live,
+            candidate,
+            [change for unit, change in changes.items() if unit not in kept_back],
+        )
+        write_json_atomically(self.proxy_config_quarantine_file, quarantine)
+        update.quarantined = {unit: entry["error"] for unit, entry in quarantine.items()}
+        return update
+
+    def _fix_conflicting_domain(self, error: str) -> list[str]:
+        """
+        Removes all but the newest site file of a domain on several upstreams.
+
+        NGINX fails with a conflicting parameter when a domain is in the upstream
+        map twice. Returns the removed files, none if the error is another one.
+        """
+        match = CONFLICTING_DOMAIN_ERROR.search(error)
+        if not match:
+            return []
+
+        domain = match.group(1)
+        with self.proxy_config_modification_lock:
+            paths = [
+                os.path.join(self.upstreams_directory, upstream, domain)
+                for upstream in self.upstreams
+                if os.path.exists(os.path.join(self.upstreams_directory, upstream, domain))
+            ]
+            paths.sort(key=os.path.getmtime)
+            for path in paths[:-1]:
+                with suppress(FileNotFoundError):
+                    os.remove(path)
+                self.index.update_site(os.path.basename(os.path.dirname(path)), domain)
+        return paths[:-1]
+
+    def _get_proxy_config_changes(self, live: ProxyConfigFiles, candidate: ProxyConfigFiles):
+        """Returns changed files and their new hashes by host or upstream, None for proxy.conf"""
+        changes: dict[str | None, dict[str, str | None]] = defaultdict(dict)
+        for file in set(live.manifest) | set(candidate.files):
+            fingerprint = candidate.files.get(file)
+            live_path = self._get_live_config_path(file)
+            if live.manifest.get(file) != fingerprint or (fingerprint and not os.path.exists(live_path)):
+                changes[get_unit(file)][file] = fingerprint
+        return changes
+
+    def _apply_proxy_config_changes(self, live: ProxyConfigFiles, candidate: ProxyConfigFiles, changes):
+        manifest, changed = dict(live.manifest), []
+        files = [(file, fingerprint) for change in changes for file, fingerprint in change.items()]
+        # Removals first, a removed file can have the same path as a new one
+        for file, fingerprint in sorted(files, key=lambda item: item[1] is not None):
+            path = self._get_live_config_path(file)
+            if fingerprint:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                shutil.copyfile(candidate.path(file), f"{path}.tmp")
+                os.rename(f"{path}.tmp", path)
+                manifest[file] = fingerprint
+            else:
+                with suppress(FileNotFoundError):
+                    os.remove(path)
+                manifest.pop(file, None)
+            changed.append(path)
+
+        live.files = manifest
+        live.write_manifest()
+        return changed
+
+    def _get_live_config_path(self, file: str) -> str:
+        if file == "proxy.conf":
+            return os.path.join(self.nginx_directory, file)
+        return os.path.normpath(os.path.join(self.proxy_config_directory, file))
+
+    def _read_proxy_config_quarantine(self) -> dict[str, dict]:
+        try:
+            with open(self.proxy_config_quarantine_file) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def get_proxy_config_hash(self) -> str:
+        """
+        Hash of the generated proxy config.
+
+        Generated files are covered by their hashes in the manifest. Host configs
+        use copies of certificates by their modification times, so a renewed
+        certificate changes the manifest too.
+        """
+        manifest = ProxyConfigFiles(self.proxy_config_directory).manifest
+        return sha(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
 
     def _reload_nginx(self):
         from agent.nginx_reload_manager import NginxReloadManager
@@ -329,7 +618,9 @@ class Proxy(Server):
         if not self.job:
             raise Exception("NGINX Reload should be trigerred by a job")
 
-        return NginxReloadManager().request_reload(request_id=self.job_record.model.agent_job_id)
+        # The manager fails requests whose hosts or upstreams end up quarantined
+        units = sorted(self._index.updated_units) if self._index else []
+        return NginxReloadManager().request_reload(request_id=self.job_record.model.agent_job_id, units=units)
 
     def _create_default_host(self):
         default_host = f"*.{self.config['domain']}"
@@ -346,6 +637,7 @@ class Proxy(Server):
             if os.path.exists(destination):
                 os.remove(destination)
             os.symlink(source, destination)
+        self.index.update_host(default_host)
 
     @property
     def upstreams(self):
@@ -402,6 +694,28 @@ class Proxy(Server):
                 wildcards.append(host.strip("*."))
         return wildcards
 
+    @property
+    def proxy_config_directory(self) -> str:
+        return os.path.join(self.nginx_directory, "proxy.d")
+
+    @property
+    def proxy_candidate_directory(self) -> str:
+        return os.path.join(self.nginx_directory, "proxy-candidate")
+
+    @property
+    def certificates_directory(self) -> str:
+        return os.path.join(self.nginx_directory, "certificates")
+
+    @property
+    def proxy_config_quarantine_file(self) -> str:
+        return os.path.join(self.nginx_directory, "proxy-quarantine.json")
+
+    @property
+    def index(self) -> ProxyIndex:
+        if self._index is None:
+            self._index = ProxyIndex(self.nginx_directory)
+        return self._index
+
     @property
     @contextmanager
     def proxy_config_modification_lock(self):
@@ -413,3 +727,88 @@ class Proxy(Server):
 
         with self._proxy_config_modification_lock:
             yield
+
+
+def get_certificate_host(host: str, wildcards: list[str]) -> str:
+    """Hosts under a wildcard domain use the wildcard's certificate, same as in host.conf.jinja2"""
+    certificate_host = host
+    for wildcard in wildcards:
+        if host.endswith("." + wildcard):
+            certificate_host = "*." + wildcard
+    return certificate_host
+
+
+def write_json_atomically(path: str, data):
+    with open(f"{path}.tmp", "w") as f:
+        json.dump(data, f)
+    os.rename(f"{path}.tmp", path)
+
+
+class ProxyConfigFiles:
+    """
+    Renders include files of the proxy config, skipping ones that haven't changed.
+
+    A manifest in the directory keeps a hash of every file's template source
+    and context. Files are only rendered and written, through a temporary
+    file and a rename, when that hash changes.
+    Files left over from hosts and upstreams that are gone are removed.
+    """
+
+    environment = None
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.manifest_file = os.path.join(directory, "manifest.json")
+        try:
+            with open(self.manifest_file) as f:
+                self.manifest: dict[str, str] = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.manifest = {}
+        self.files: dict[str, str] = {}
+        self.changed: list[str] = []
+        self.template_hashes: dict[str, str] = {}
+
+        if ProxyConfigFiles.environment is None:
+            ProxyConfigFiles.environment = Environment(loader=PackageLoader("agent", "templates"))
+
+    def render(self, file: str, template: str, **context):
+        key = json.dumps([self.get_template_hash(template), context], sort_keys=True, default=str)
+        fingerprint = sha(key.encode()).hexdigest()
+
+        path = self.path(file)
+        self.files[file] = fingerprint
+        if self.manifest.get(file) == fingerprint and os.path.exists(path):
+            return
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.tmp", "w") as f:
+            f.write(self.environment.get_template(template).render(**context))
+        os.rename(f"{path}.tmp", path)
+        self.changed.append(path)
+
+    def get_template_hash(self, template: str) -> str:
+        """Hash of the template's source, so files are rendered again when the template is edited"""
+        if template not in self.template_hashes:
+            source, _, _ = self.environment.loader.get_source(self.environment, template)
+            self.template_hashes[template] = sha(source.encode()).hexdigest()
+        return self.template_hashes[template]
+
+    def save(self) -> list[str]:
+        """Removes files that weren't rendered this time, and returns every changed file."""
+        for file in set(self.manifest) - set(self.files):
+            path = self.path(file)
+            with suppress(FileNotFoundError):
+                os.remove(path)
+            self.changed.append(path)
+
+        if self.changed or self.files != self.manifest:
+            self.write_manifest()
+        return self.changed
+
+    def write_manifest(self):
+        os.makedirs(self.directory, exist_ok=True)
+        write_json_atomically(self.manifest_file, self.files)
+        self.manifest = dict(self.files)
+
+    def path(self, file: str) -> str:
+        return os.path.normpath(os.path.join(self.directory, file))
@@ -0,0 +1,233 @@
+from __future__ import annotations
+
+import json
+import os
+from collections import defaultdict
+from hashlib import sha512 as sha
+
+from peewee import BigIntegerField, BooleanField, CharField, Model, SqliteDatabase, TextField
+
+# Statuses that send a site to one of the error page upstreams instead of its server
+INACTIVE_SITE_STATUSES = ("deactivated", "suspended", "suspended_saas")
+
+proxy_index_database = SqliteDatabase(
+    None,
+    timeout=15,
+    pragmas={
+        "journal_mode": "wal",
+        "synchronous": "normal",
+    },
+)
+
+
+class UpstreamModel(Model):
+    name = CharField(primary_key=True)
+    mtime_ns = BigIntegerField()
+
+    class Meta:
+        database = proxy_index_database
+
+
+class UpstreamSiteModel(Model):
+    upstream = CharField()
+    name = CharField()
+    status = TextField()
+
+    class Meta:
+        database = proxy_index_database
+        indexes = (
+            (("upstream", "name"), True),
+            (("name",), False),
+        )
+
+
+class HostModel(Model):
+    name = CharField(primary_key=True)
+    map = TextField(null=True)
+    redirects = TextField(null=True)
+    codeserver = BooleanField(default=False)
+    mtime_ns = BigIntegerField()
+
+    class Meta:
+        database = proxy_index_database
+
+
+MODELS = [UpstreamModel, UpstreamSiteModel, HostModel]
+
+
+class ProxyIndex:
+    """
+    Hosts, upstreams and site statuses of the proxy, kept in SQLite next to the
+    NGINX config so the config can be generated without reading every file.
+
+    The files under hosts/ and upstreams/ stay the source of truth. Proxy updates
+    the entries it changes, and `sync` picks up entries added or removed by anyone
+    else by comparing directory modification times.
+    """
+
+    def __init__(self, nginx_directory: str):
+        self.upstreams_directory = os.path.join(nginx_directory, "upstreams")
+        self.hosts_directory = os.path.join(nginx_directory, "hosts")
+        proxy_index_database.init(os.path.join(nginx_directory, "proxy-index.sqlite3"))
+        proxy_index_database.create_tables(MODELS)
+        # Hosts and upstreams updated through this index, named like their config units
+        self.updated_units: set[str] = set()
+
+    def sync(self):
+        """Updates entries whose directories changed since they were last read."""
+        with proxy_index_database.atomic():
+            self._sync_upstreams()
+            self._sync_hosts()
+
+    def _sync_upstreams(self):
+        known = dict(UpstreamModel.select(UpstreamModel.name, UpstreamModel.mtime_ns).tuples())
+        found = set()
+        for entry in _scandir(self.upstreams_directory):
+            if not entry.is_dir():
+                continue
+            found.add(entry.name)
+            mtime_ns = entry.stat().st_mtime_ns
+            if known.get(entry.name) != mtime_ns:
+                self._sync_upstream_sites(entry.name, mtime_ns)
+
+        for name in set(known) - found:
+            self._delete_upstream(name)
+
+    def _sync_upstream_sites(self, upstream: str, mtime_ns: int):
+        # Statuses of existing sites are only rewritten in place by Proxy, which
+        # updates them itself, so only added and removed sites are read here
+        directory = os.path.join(self.upstreams_directory, upstream)
+        sites = set(os.listdir(directory))
+        query = UpstreamSiteModel.select(UpstreamSiteModel.name).where(UpstreamSiteModel.upstream == upstream)
+        known = {name for (name,) in query.tuples()}
+        for site in sites - known:
+            self._save_site(upstream, site)
+        if known - sites:
+            UpstreamSiteModel.delete().where(
+                (UpstreamSiteModel.upstream == upstream) & (UpstreamSiteModel.name << list(known - sites))
+            ).execute()
+        UpstreamModel.replace(name=upstream, mtime_ns=mtime_ns).execute()
+
+    def _sync_hosts(self):
+        known = dict(HostModel.select(HostModel.name, HostModel.mtime_ns).tuples())
+        found = set()
+        for entry in _scandir(self.hosts_directory):
+            found.add(entry.name)
+            if known.get(entry.name) != entry.stat().st_mtime_ns:
+                self._update_host(entry.name)
+
+        if set(known) - found:
+            HostModel.delete().where(HostModel.name << list(set(known) - found)).execute()
+
+    def update_upstream(self, upstream: str):
+        """Reads an upstream and all of its sites again, or removes it if it's gone."""
+        self.updated_units.add(f"upstream:{get_upstream_hash(upstream)}")
+        directory = os.path.join(self.upstreams_directory, upstream)
+        with proxy_index_database.atomic():
+            self._delete_upstream(upstream)
+            if os.path.isdir(directory):
+                self._sync_upstream_sites(upstream, os.stat(directory).st_mtime_ns)
+
+    def update_site(self, upstream: str, site: str):
+        """Reads the status of a site on an upstream again, or removes it if it's gone."""
+        if not UpstreamModel.select().where(UpstreamModel.name == upstream).exists():
+            self.update_upstream(upstream)
+            return
+        self.updated_units.add(f"upstream:{get_upstream_hash(upstream)}")
+        self._save_site(upstream, site)
+
+    def update_host(self, host: str):
+        """Reads a host's map, redirects and code server flag again, or removes it if it's gone."""
+        self.updated_units.add(f"host:{host.replace('*', '_')}")
+        self._update_host(host)
+
+    def _update_host(self, host: str):
+        directory = os.path.join(self.hosts_directory, host)
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except FileNotFoundError:
+            HostModel.delete().where(HostModel.name == host).execute()
+            return
+
+        HostModel.replace(
+            name=host,
+            map=_read(os.path.join(directory, "map.json")),
+            redirects=_read(os.path.join(directory, "redirect.json")),
+            codeserver=os.path.exists(os.path.join(directory, "codeserver")),
+            mtime_ns=mtime_ns,
+        ).execute()
+
+    def site_upstreams(self, site: str) -> list[str]:
+        """Returns upstreams the site is on, usually one."""
+        query = UpstreamSiteModel.select(UpstreamSiteModel.upstream).where(UpstreamSiteModel.name == site)
+        return [upstream for (upstream,) in query.tuples()]
+
+    def upstreams(self) -> dict[str, dict]:
+        """Same as Proxy.upstreams, sorted by upstream and site."""
+        upstreams = {}
+        for (name,) in UpstreamModel.select(UpstreamModel.name).order_by(UpstreamModel.name).tuples():
+            upstreams[name] = {"sites": [], "hash": get_upstream_hash(name)}
+
+        # Rows are read as tuples, building models for every site is most of the cost
+        site = UpstreamSiteModel
+        query = site.select(site.upstream, site.name, site.status).order_by(site.upstream, site.name).tuples()
+        for upstream_name, name, status in query:
+            upstream = upstreams.get(upstream_name)
+            if upstream is None:
+                continue
+            actual_upstream = status if status in INACTIVE_SITE_STATUSES else upstream["hash"]
+            upstream["sites"].append({"name": name, "upstream": actual_upstream})
+        return upstreams
+
+    def hosts(self) -> dict[str, dict[str, str]]:
+        """Same as Proxy.hosts, with host directories read in sorted order."""
+        hosts = defaultdict(lambda: defaultdict(str))
+        query = HostModel.select(HostModel.name, HostModel.map, HostModel.redirects, HostModel.codeserver)
+        for name, map, redirects, codeserver in query.order_by(HostModel.name).tuples():
+            if map is not None:
+                hosts[name] = json.loads(map)
+
+            if redirects is not None:
+                for _from, to in json.loads(redirects).items():
+                    if "*" in name:
+                        hosts[_from] = {_from: _from}
+                    hosts[_from]["redirect"] = to
+            hosts[name]["codeserver"] = bool(codeserver)
+        return hosts
+
+    def wildcards(self) -> list[str]:
+        query = HostModel.select(HostModel.name).where(HostModel.name.contains("*")).order_by(HostModel.name)
+        return [name.strip("*.") for (name,) in query.tuples()]
+
+    def _save_site(self, upstream: str, site: str):
+        status = _read(os.path.join(self.upstreams_directory, upstream, site))
+        if status is None:
+            UpstreamSiteModel.delete().where(
+                (UpstreamSiteModel.upstream == upstream) & (UpstreamSiteModel.name == site)
+            ).execute()
+            return
+        UpstreamSiteModel.replace(upstream=upstream, name=site, status=status.strip()).execute()
+
+    def _delete_upstream(self, upstream: str):
+        UpstreamSiteModel.delete().where(UpstreamSiteModel.upstream == upstream).execute()
+        UpstreamModel.delete().where(UpstreamModel.name == upstream).execute()
+
+
+def get_upstream_hash(upstream: str) -> str:
+    return sha(upstream.encode()).hexdigest()[:16]
+
+
+def _scandir(directory: str) -> list[os.DirEntry]:
+    try:
+        with os.scandir(directory) as entries:
+            return list(entries)
+    except FileNotFoundError:
+        return []
+
+
+def _read(path: str) -> str | None:
+    try:
+        with open(path) as f:
+            return f.read()
+    except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+        return None
@@ -0,0 +1,144 @@
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import subprocess
+from hashlib import sha512 as sha
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from agent.proxy import Proxy
+
+# Include files of a host or an upstream, changed, validated and quarantined together
+UNIT_DIRECTORIES = {
+    "upstreams": "upstream",
+    "upstream-sites": "upstream",
+    "host-maps": "host",
+    "hosts": "host",
+}
+# NGINX loads every certificate in a check, so a check takes long with many hosts
+MAX_VALIDATION_RUNS = 20
+
+
+class ProxyConfigValidationError(Exception):
+    pass
+
+
+def get_unit(file: str) -> str | None:
+    """Host or upstream an include file belongs to, e.g. host:balu.codes for hosts/balu.codes.conf"""
+    directory, _, name = file.partition("/")
+    kind = UNIT_DIRECTORIES.get(directory)
+    if not kind or not name.endswith(".conf"):
+        return None
+    return f"{kind}:{name[: -len('.conf')]}"
+
+
+def get_change_fingerprint(change: dict[str, str | None] | None) -> str:
+    """Hash of a unit's changed files and their new hashes, to tell if a quarantined change changed"""
+    return sha(json.dumps(change, sort_keys=True).encode()).hexdigest()
+
+
+def apply_changes(base: dict[str, str], changes: dict[str, dict[str, str | None]], units) -> dict[str, str]:
+    """Returns `base` files with files of `units` replaced by their changes, None removes a file"""
+    files = dict(base)
+    for unit in units:
+        for file, source in changes[unit].items():
+            if source is None:
+                files.pop(file, None)
+            else:
+                files[file] = source
+    return files
+
+
+class ProxyConfigValidator:
+    """
+    Checks proxy configs with `nginx -t` in a scratch directory, before NGINX uses them.
+
+    A config to check is a set of include files, by their path under proxy.d
+    and the file to take them from. They are linked into the scratch directory
+    along with a proxy.conf including them, and a main config with the same
+    modules and http settings as the server's.
+    """
+
+    def __init__(self, proxy: Proxy, directory: str, context: dict, max_runs: int = MAX_VALIDATION_RUNS):
+        self.proxy = proxy
+        self.directory = directory
+        # Context of proxy/nginx.conf.jinja2, other than the include directory
+        self.context = context
+        self.max_runs = max_runs
+        self.runs = 0
+
+    def validate(self, files: dict[str, str]) -> str | None:
+        """Returns the error from `nginx -t`, or None if the config is valid."""
+        self.runs += 1
+
+        config_directory = os.path.join(self.directory, "proxy.d")
+        shutil.rmtree(config_directory, ignore_errors=True)
+        for file, source in files.items():
+            destination = os.path.join(config_directory, file)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            try:
+                os.link(source, destination)
+            except OSError:
+                shutil.copyfile(source, destination)
+
+        proxy_config_file = os.path.join(self.directory, "proxy.conf")
+        main_config_file = os.path.join(self.directory, "nginx.conf")
+        self.proxy._render_template(
+            "proxy/nginx.conf.jinja2",
+            {**self.context, "proxy_config_directory": config_directory},
+            proxy_config_file,
+        )
+        self.proxy._render_template(
+            "proxy/validate.conf.jinja2",
+            {**self.proxy._get_nginx_config_context(), "proxy_config_file": proxy_config_file},
+            main_config_file,
+        )
+
+        result = subprocess.run(
+            ["sudo", "nginx", "-t", "-q", "-c", main_config_file], capture_output=True, text=True
+        )
+        if result.returncode == 0:
+            return None
+        return (result.stderr or result.stdout).strip() or f"nginx -t exited with {result.returncode}"
+
+    def check_changes(
+        self, base: dict[str, str], changes: dict[str, dict[str, str | None]]
+    ) -> tuple[dict[str, str], list[str]]:
+        """
+        Returns units whose changes make `base` invalid, with their errors, and
+        units whose changes were checked to work.
+
+        All changes are checked together first. If that fails, changes are
+        split in halves and checked on top of the ones already known to work,
+        down to single units. After `max_runs` checks the rest of the units
+        are left out of both, unchecked.
+        """
+        units = sorted(changes)
+        error = self.validate(apply_changes(base, changes, units))
+        if error is None:
+            return {}, units
+        if (base_error := self.validate(base)) is not None:
+            raise ProxyConfigValidationError(f"Proxy config is invalid without any changes: {base_error}")
+        if len(units) == 1:
+            return {units[0]: error}, []
+
+        invalid, accepted = {}, []
+        middle = len(units) // 2
+        self._bisect(base, changes, units[:middle], accepted, invalid)
+        self._bisect(base, changes, units[middle:], accepted, invalid)
+        return invalid, accepted
+
+    def _bisect(self, base, changes, units: list[str], accepted: list[str], invalid: dict[str, str]):
+        if not units or self.runs >= self.max_runs:
+            return
+        error = self.validate(apply_changes(base, changes, [*accepted, *units]))
+        if error is None:
+            accepted.extend(units)
+        elif len(units) == 1:
+            invalid[units[0]] = error
+        else:
+            middle = len(units) // 2
+            self._bisect(base, changes, units[:middle], accepted, invalid)
+            self._bisect(base, changes, units[middle:], accepted, invalid)
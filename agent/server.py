@@ -7,6 +7,7 @@ import re
 import shutil
 import subprocess
 import tempfile
+import threading
 import time
 from contextlib import suppress
 from datetime import datetime
@@ -26,10 +27,16 @@ from agent.base import AgentException, Base
 from agent.bench import Bench
 from agent.exceptions import BenchNotExistsException, RegistryDownException
 from agent.job import Job, Step, job, step
+from agent.job_retention import JobRetention
 from agent.nfs_handler import NFSHandler
 from agent.patch_handler import run_patches
 from agent.site import Site
-from agent.utils import get_supervisor_processes_status, is_registry_healthy
+from agent.utils import (
+    get_supervisor_processes_status,
+    is_registry_healthy,
+    is_valid_directory_name,
+    run_concurrently,
+)
 
 
 class Server(Base):
@@ -269,8 +276,23 @@ class Server(Base):
         if not is_primary:
             # Don't need to pull images on primary server
             self.docker_login(registry_settings)
-        for _, bench in self.benches.items():
-            bench.start(secondary_server_private_ip=secondary_server_private_ip)
+
+        # Benches restart one at a time, unless max_concurrent_bench_restarts in
+        # config.json allows more. No bench starts after one has failed to.
+        concurrency = self.config.get("max_concurrent_bench_restarts", 1)
+        failed = threading.Event()
+
+        def start(bench: Bench):
+            if failed.is_set():
+                return
+            try:
+                bench.start(secondary_server_private_ip=secondary_server_private_ip)
+            except Exception:
+                failed.set()
+                raise
+
+        for result in run_concurrently(start, self.benches.values(), max_workers=concurrency):
+            result.unwrap()
 
     @job("Stop Bench Workers")
     def stop_bench_workers(self):
@@ -279,8 +301,20 @@ class Server(Base):
     @step("Stop Bench Workers")
     def _stop_bench_workers(self):
         """Stop all workers except redis"""
-        for _, bench in self.benches.items():
-            bench.docker_execute("supervisorctl stop frappe-bench-web: frappe-bench-workers:", as_root=True)
+        results = run_concurrently(
+            lambda bench: bench.docker_execute(
+                "supervisorctl stop frappe-bench-web: frappe-bench-workers:", as_root=True
+            ),
+            self.benches.values(),
+            max_workers=self.bench_concurrency,
+        )
+        for result in results:
+            result.unwrap()
+
+    @property
+    def bench_concurrency(self) -> int:
+        """Number of benches that can be worked on at once."""
+        return self.config.get("max_concurrent_benches", 4)
 
     @job("Start Bench Workers")
     def start_bench_workers(self):
@@ -329,6 +363,26 @@ class Server(Base):
         if force:
             self.remove_archived_sites()
 
+    @job("Prune Jobs", priority="low")
+    def prune_jobs(self):
+        self.archive_old_jobs()
+        self.vacuum_jobs_database()
+
+    @property
+    def job_retention(self) -> JobRetention:
+        return JobRetention(
+            os.path.join(self.directory, "archived-jobs"),
+            self.config.get("job_retention_days"),
+        )
+
+    @step("Archive Old Jobs")
+    def archive_old_jobs(self):
+        return self.job_retention.archive()
+
+    @step("Vacuum Jobs Database")
+    def vacuum_jobs_database(self):
+        return self.job_retention.vacuum()
+
     def remove_benches_without_container(self, benches: list[str]):
         for bench in benches:
             try:
@@ -581,7 +635,7 @@ class Server(Base):
 
     @job("Recover Failed Site Update", priority="high")
     def update_site_recover_job(self, name, bench):
-        site = self.benches[bench].sites[name]
+        site = self.get_bench(bench).get_site(name)
         site.disable_maintenance_mode()
 
     @step("Move Site")
@@ -744,9 +798,13 @@ class Server(Base):
         return benches
 
     def get_bench(self, bench):
+        """Builds only the named bench, instead of every bench like `benches`."""
+        if not is_valid_directory_name(bench):
+            raise BenchNotExistsException(bench)
+
         try:
-            return self.benches[bench]
-        except KeyError as exc:
+            return Bench(bench, self)
+        except Exception as exc:
             raise BenchNotExistsException(bench) from exc
 
     @property
@@ -1044,19 +1102,18 @@ class Server(Base):
             systemd = e.data
         return systemd["output"]
 
+    def _get_nginx_config_context(self) -> dict:
+        return {
+            "proxy_ip": self.config.get("proxy_ip"),
+            "tls_protocols": self.config.get("tls_protocols"),
+            "nginx_vts_module_enabled": self.config.get("nginx_vts_module_enabled", True),
+            "ip_whitelist": self.config.get("ip_whitelist", []),
+            "use_shared": self.config.get("benches_directory") == "/shared",
+        }
+
     def _generate_nginx_config(self):
         nginx_config = os.path.join(self.nginx_directory, "nginx.conf")
-        self._render_template(
-            "nginx/nginx.conf.jinja2",
-            {
-                "proxy_ip": self.config.get("proxy_ip"),
-                "tls_protocols": self.config.get("tls_protocols"),
-                "nginx_vts_module_enabled": self.config.get("nginx_vts_module_enabled", True),
-                "ip_whitelist": self.config.get("ip_whitelist", []),
-                "use_shared": self.config.get("benches_directory") == "/shared",
-            },
-            nginx_config,
-        )
+        self._render_template("nginx/nginx.conf.jinja2", self._get_nginx_config_context(), nginx_config)
 
     def _generate_agent_nginx_config(self):
         agent_nginx_config = os.path.join(self.directory, "nginx.conf")
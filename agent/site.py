@@ -14,11 +14,15 @@ import requests
 
 from agent.base import AgentException, Base
 from agent.database import Database
-from agent.job import job, step
-from agent.utils import b2mb, compute_file_hash, get_size
+from agent.job import connection, job, step
+from agent.utils import b2mb, compute_file_hash, end_execution, get_execution_result, get_size
 
 if TYPE_CHECKING:
     from agent.bench import Bench
+    from agent.utils import DirectorySizeCache
+
+# Fields returned by the site info endpoints, callers can ask for a subset
+SITE_INFO_FIELDS = ("config", "usage", "timezone")
 
 
 class Site(Base):
@@ -48,9 +52,10 @@ class Site(Base):
         self.user = self.config["db_name"]
         self.password = self.config["db_password"]
         self.host = self.config.get("db_host", self.bench.host)
+        self.port = self.config.get("db_port", self.bench.port)
 
     def bench_execute(self, command, input=None):
-        return self.bench.docker_execute(f"bench --site {self.name} {command}", input=input)
+        return self.bench.site_execute(self.name, command, input=input)
 
     def dump(self):
         return {"name": self.name}
@@ -438,6 +443,41 @@ class Site(Base):
 
     @step("Reset Site Usage")
     def reset_site_usage(self):
+        """
+        Deletes the site's rate limit counters from the bench's cache Redis.
+
+        Keys are found with SCAN and read and deleted in pipelines, over the
+        port the bench exposes on the host. Results have the same shape as
+        the redis-cli commands this used to run.
+        """
+        port = self.bench.rq_cache_port
+        if port is None:
+            return self._reset_site_usage_with_redis_cli()
+
+        pattern = f"{self.database}|rate-limit-counter-[0-9]*"
+        redis = connection(port, decode_responses=True)
+        keys = get_execution_result(f"SCAN 0 MATCH {pattern}")
+        matched = list(redis.scan_iter(match=pattern, count=1000))
+        data = {"keys": end_execution(keys, "\n".join(matched)), "get": [], "delete": []}
+
+        for index in range(0, len(matched), 500):
+            chunk = matched[index : index + 500]
+            start = datetime.now()
+            pipeline = redis.pipeline(transaction=False)
+            for key in chunk:
+                pipeline.get(key)
+                pipeline.delete(key)
+            results = pipeline.execute()
+
+            for key, value, deleted in zip(chunk, results[::2], results[1::2]):
+                get = get_execution_result(f"GET {key}", start=start)
+                delete = get_execution_result(f"DEL {key}", start=start)
+                data["get"].append(end_execution(get, value or ""))
+                data["delete"].append(end_execution(delete, str(deleted)))
+        return data
+
+    def _reset_site_usage_with_redis_cli(self):
+        # Benches deployed as stacks don't expose their cache Redis on the host
         pattern = f"{self.database}|rate-limit-counter-[0-9]*"
         keys_command = f"redis-cli --raw -p 13000 KEYS '{pattern}'"
         keys = self.bench.docker_execute(keys_command)
@@ -701,12 +741,17 @@ class Site(Base):
     def get_timezone(self):
         return self.timezone
 
-    def fetch_site_info(self):
-        return {
-            "config": self.config,
-            "timezone": self.get_timezone(),
-            "usage": self.get_usage(),
-        }
+    def fetch_site_info(self, fields=None):
+        """Returns only the given `fields` of SITE_INFO_FIELDS, skipping the work for the rest."""
+        fields = SITE_INFO_FIELDS if fields is None else fields
+        info = {}
+        if "config" in fields:
+            info["config"] = self.config
+        if "timezone" in fields:
+            info["timezone"] = self.get_timezone()
+        if "usage" in fields:
+            info["usage"] = self.get_usage()
+        return info
 
     def fetch_site_analytics(self):
         if not os.path.exists(self.analytics_file):
@@ -841,17 +886,24 @@ print(">>>" + frappe.session.sid + "<<<")
 
     def get_usage(self):
         """Returns Usage in bytes"""
+        return {
+            "database": b2mb(self.get_database_size()),
+            "database_free_tables": self.get_database_free_tables(),
+            "database_free": b2mb(self.get_database_free_size()),
+            **self.get_files_usage(),
+        }
+
+    def get_files_usage(self, cache: DirectorySizeCache | None = None, max_workers: int = 1):
         backup_directory = os.path.join(self.directory, "private", "backups")
         public_directory = os.path.join(self.directory, "public")
         private_directory = os.path.join(self.directory, "private")
 
         return {
-            "database": b2mb(self.get_database_size()),
-            "database_free_tables": self.get_database_free_tables(),
-            "database_free": b2mb(self.get_database_free_size()),
-            "public": b2mb(get_size(public_directory)),
-            "private": b2mb(get_size(private_directory, ignore_dirs=["backups"])),
-            "backups": b2mb(get_size(backup_directory)),
+            "public": b2mb(get_size(public_directory, cache=cache, max_workers=max_workers)),
+            "private": b2mb(
+                get_size(private_directory, ignore_dirs=["backups"], cache=cache, max_workers=max_workers)
+            ),
+            "backups": b2mb(get_size(backup_directory, cache=cache, max_workers=max_workers)),
         }
 
     def get_analytics(self):
@@ -1022,7 +1074,7 @@ print(">>>" + frappe.session.sid + "<<<")
             username = self.user
         if not password:
             password = self.password
-        return Database(self.host, 3306, username, password, self.database)
+        return Database(self.host, self.port, username, password, self.database)
 
     @property
     def job_record(self):
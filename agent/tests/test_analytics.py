@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import json
+import unittest
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from agent.analytics import collect_bench_analytics, get_site_hour, is_due
+from agent.bench import SITES_ANALYTICS_MARKER, Bench
+
+
+class TestAnalyticsSchedule(unittest.TestCase):
+    """Tests for spreading analytics collection across the day."""
+
+    def setUp(self):
+        self.site = SimpleNamespace(name="a.frappe.cloud")
+        hour = get_site_hour(self.site.name)
+        self.now = datetime(2024, 1, 2, hour, 0)
+        self.other_hour = self.now.replace(hour=(hour + 1) % 24)
+
+    def _previous(self, age: timedelta) -> dict:
+        return {"timestamp": str(self.now - age)}
+
+    def test_site_is_due_once_a_day_in_its_hour(self):
+        self.assertTrue(is_due(self.site, {}, self.other_hour))
+        self.assertTrue(is_due(self.site, self._previous(timedelta(days=1)), self.now))
+        self.assertFalse(is_due(self.site, self._previous(timedelta(hours=1)), self.now))
+        self.assertFalse(is_due(self.site, self._previous(timedelta(days=1)), self.other_hour))
+
+    def test_bench_sites_are_collected_in_batches(self):
+        bench, sites = SimpleNamespace(name="bench"), list(range(5))
+        with patch("agent.analytics.get_due_sites", return_value=sites), patch(
+            "agent.analytics.collect_analytics"
+        ) as collect_analytics:
+            collect_bench_analytics(bench, self.now, 2)
+        self.assertEqual(
+            [call.args for call in collect_analytics.call_args_list],
+            [(bench, [0, 1]), (bench, [2, 3]), (bench, [4])],
+        )
+
+    def test_overdue_site_is_due_in_any_hour(self):
+        self.assertTrue(is_due(self.site, self._previous(timedelta(days=3)), self.other_hour))
+
+
+class TestSitesAnalytics(unittest.TestCase):
+    """Tests for collecting analytics of several sites in one process."""
+
+    def test_results_are_parsed_from_console_output(self):
+        bench = Bench.__new__(Bench)
+        results = {
+            "a.frappe.cloud": {"analytics": {"users": 1}, "duration": 0.5},
+            "b.frappe.cloud": {"error": "Traceback", "duration": 0.1},
+        }
+        lines = [f"{SITES_ANALYTICS_MARKER}{json.dumps({site: result})}" for site, result in results.items()]
+        output = "\n".join(["In [1]: ...", *lines])
+        with patch.object(Bench, "site_execute", return_value={"output": output}) as site_execute:
+            self.assertEqual(bench.get_sites_analytics(list(results)), results)
+
+        script = site_execute.call_args[1]["input"]
+        self.assertEqual(site_execute.call_args[0], ("a.frappe.cloud", "console"))
+        self.assertIn('["a.frappe.cloud", "b.frappe.cloud"]', script)
+        self.assertNotIn(SITES_ANALYTICS_MARKER, script)
@@ -0,0 +1,172 @@
+from __future__ import annotations
+
+import json
+import time
+import unittest
+
+from redis.exceptions import ResponseError
+
+from agent.base import OutputPublisher, OutputReader
+
+
+def read_byte_by_byte(output: bytes) -> str:
+    """Reference implementation, reads output one byte at a time."""
+    line = b""
+    lines = []
+    prev_char = None
+    for char in (output[i : i + 1] for i in range(len(output))):
+        if char == b"\r":
+            prev_char = char
+            continue
+        if char == b"\n":
+            lines.append(line.decode(errors="replace"))
+            line = b""
+        elif prev_char == b"\r":
+            line = char
+        else:
+            line += char
+        prev_char = char
+
+    if line:
+        lines.append(line.decode(errors="replace"))
+    return "\n".join(lines)
+
+
+def read_in_chunks(output: bytes, chunk_size: int, tail_size: int | None = None) -> OutputReader:
+    reader = OutputReader(tail_size=tail_size)
+    for i in range(0, len(output), chunk_size):
+        reader.feed(output[i : i + chunk_size])
+    reader.close()
+    return reader
+
+
+class TestOutputReader(unittest.TestCase):
+    """Tests for OutputReader."""
+
+    outputs = (
+        b"",
+        b"hello\nworld\n",
+        b"no trailing newline",
+        b"windows\r\nline endings\r\n",
+        b"progress 10%\rprogress 50%\rprogress 100%\ndone\n",
+        b"trailing carriage return\r",
+        b"double\r\rcarriage\r\r\nreturns\n",
+        b"\n\nempty lines\n\n",
+        "multibyte ✓ characters\n".encode() * 3,
+    )
+
+    def test_output_matches_byte_by_byte_reader(self):
+        """Ensure chunked reads produce the same output for any chunk size."""
+        for output in self.outputs:
+            for chunk_size in (1, 2, 3, 7, 64 * 1024):
+                with self.subTest(output=output, chunk_size=chunk_size):
+                    reader = read_in_chunks(output, chunk_size)
+                    self.assertEqual(reader.output, read_byte_by_byte(output))
+
+    def test_feed_returns_completed_lines(self):
+        """Ensure feed only returns lines terminated by a newline."""
+        reader = OutputReader()
+        self.assertEqual(reader.feed(b"first\nsec"), ["first"])
+        self.assertEqual(reader.pending, "sec")
+        self.assertEqual(reader.feed(b"ond\rthird\n"), ["third"])
+        self.assertEqual(reader.feed(b"last"), [])
+        self.assertEqual(reader.close(), ["last"])
+
+    def test_tail_size_bounds_kept_output(self):
+        """Ensure only the tail of the output is kept when tail_size is set."""
+        output = b"".join(f"line {i}\n".encode() for i in range(1000))
+        reader = read_in_chunks(output, 100, tail_size=70)
+        self.assertLessEqual(reader.size, 70)
+        self.assertTrue(reader.output.startswith("... "))
+        self.assertTrue(reader.output.endswith("line 999"))
+
+
+class TestOutputPublisher(unittest.TestCase):
+    """Tests for the output log format of OutputPublisher."""
+
+    def test_assembled_output_matches_reader_output(self):
+        """Ensure output rebuilt from the log and pending line matches the reader's."""
+        for output in TestOutputReader.outputs:
+            for chunk_size in (1, 5, 64 * 1024):
+                with self.subTest(output=output, chunk_size=chunk_size):
+                    reader = OutputReader()
+                    publisher = OutputPublisher(redis=None, key="agent:job:1", interval=1)
+                    for i in range(0, len(output), chunk_size):
+                        publisher.append_output(reader.feed(output[i : i + chunk_size]))
+                        log = "".join(publisher.pending_output)
+                        self.assertEqual(OutputPublisher.assemble_output(log, reader.pending), reader.output)
+
+                    publisher.append_output(reader.close())
+                    log = "".join(publisher.pending_output)
+                    self.assertEqual(OutputPublisher.assemble_output(log), reader.output)
+
+    def test_one_entry_per_key(self):
+        """Ensure a new command replaces the entry of the previous one, with a log of its own."""
+        redis = FakeRedis()
+        first = OutputPublisher(redis, "agent:job:1:step:1", interval=0)
+        first.append_output(["first"])
+        first.publish({"command": "first"}, force=True)
+        first_log = OutputPublisher.output_key(first.key, first.log_id)
+
+        second = OutputPublisher(redis, first.key, interval=0, previous_output_key=first_log)
+        second.append_output(["second"])
+        second.publish({"command": "second"}, force=True)
+
+        entries = [json.loads(entry) for entry in redis.data[first.key]]
+        self.assertEqual([entry["command"] for entry in entries], ["second"])
+        second_log = OutputPublisher.output_key(first.key, entries[0]["output_log"])
+        self.assertEqual(redis.data[second_log], "second\n")
+        self.assertNotIn(first_log, redis.data)
+
+    def test_deferred_updates_are_flushed_after_interval(self):
+        redis = FakeRedis()
+        publisher = OutputPublisher(redis, "agent:job:1", interval=0.05)
+        publisher.publish({"command": "a", "status": "Running"})
+        publisher.append_output(["last line before a silent stretch"])
+        publisher.publish({"command": "a", "status": "Running"})
+        self.assertNotIn(OutputPublisher.output_key(publisher.key, publisher.log_id), redis.data)
+
+        time.sleep(0.2)
+        log = redis.data[OutputPublisher.output_key(publisher.key, publisher.log_id)]
+        self.assertEqual(log, "last line before a silent stretch\n")
+
+
+class FakeRedis:
+    """Runs the pipeline commands OutputPublisher uses on a dict."""
+
+    def __init__(self):
+        self.data = {}
+        self.commands = []
+
+    def pipeline(self, transaction=True):
+        self.commands = []
+        return self
+
+    def lset(self, key, index, value):
+        self.commands.append(lambda: self._lset(key, index, value))
+
+    def _lset(self, key, index, value):
+        if key not in self.data:
+            raise ResponseError("no such key")
+        self.data[key][index] = value
+
+    def rpush(self, key, *values):
+        self.commands.append(lambda: self.data.setdefault(key, []).extend(values))
+
+    def append(self, key, value):
+        self.commands.append(lambda: self.data.__setitem__(key, self.data.get(key, "") + value))
+
+    def delete(self, key):
+        self.commands.append(lambda: self.data.pop(key, None))
+
+    def expire(self, key, ttl):
+        self.commands.append(lambda: None)
+
+    def execute(self, raise_on_error=True):
+        results = []
+        for command in self.commands:
+            try:
+                results.append(command())
+            except ResponseError as e:
+                results.append(e)
+        return results
@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from agent import bench_helper
+from agent.bench import Bench
+from agent.bench_helper import BenchHelperClient
+
+FAKE_FRAPPE_BENCH_HELPER = """
+import sys
+
+
+def get_app_groups():
+    return {}
+
+
+def main():
+    args = sys.argv[2:]
+    print("args", args)
+    print("input", sys.stdin.read())
+    if "fail" in args:
+        raise SystemExit(3)
+    if "hang" in args:
+        import time
+
+        time.sleep(60)
+"""
+
+
+class TestBenchHelper(unittest.TestCase):
+    """Tests for running bench commands through the helper, with a fake Frappe."""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.sites_directory = os.path.join(self.test_dir, "sites")
+        frappe_utils = os.path.join(self.test_dir, "lib", "frappe", "utils")
+        os.makedirs(self.sites_directory)
+        os.makedirs(frappe_utils)
+        for path in ("__init__.py", "utils/__init__.py"):
+            open(os.path.join(self.test_dir, "lib", "frappe", path), "w").close()
+        with open(os.path.join(frappe_utils, "bench_helper.py"), "w") as f:
+            f.write(FAKE_FRAPPE_BENCH_HELPER)
+
+        script = os.path.join(self.sites_directory, bench_helper.SCRIPT_NAME)
+        shutil.copy(bench_helper.__file__, script)
+        self.process = subprocess.Popen(
+            [sys.executable, script], env={**os.environ, "PYTHONPATH": os.path.join(self.test_dir, "lib")}
+        )
+        self.helper = BenchHelperClient(os.path.join(self.sites_directory, bench_helper.SOCKET_NAME))
+        for _ in range(100):
+            if self.helper.is_running():
+                break
+            time.sleep(0.05)
+
+    def tearDown(self):
+        self.process.terminate()
+        self.process.wait()
+        shutil.rmtree(self.test_dir)
+
+    def test_command_output_and_input(self):
+        output, returncode = self.helper.run("bench --site a.frappe.cloud console", input="print(1)")
+        self.assertEqual(returncode, 0)
+        self.assertIn("args ['--site', 'a.frappe.cloud', 'console']", output)
+        self.assertIn("input print(1)", output)
+
+    def test_quoted_arguments(self):
+        output, _ = self.helper.run("bench --site a.frappe.cloud remove-from-installed-apps 'some app'")
+        self.assertIn("'some app'", output)
+
+    def test_failing_command_raises(self):
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            self.helper.run("bench --site a.frappe.cloud fail")
+        self.assertEqual(context.exception.returncode, 3)
+        self.assertEqual(self.helper.run("bench fail", non_zero_throw=False)[1], 3)
+
+    def test_hanging_command_is_killed(self):
+        helper = BenchHelperClient(self.helper.path, timeout=0.5)
+        with self.assertRaises(subprocess.CalledProcessError) as context:
+            helper.run("bench --site a.frappe.cloud hang")
+        self.assertEqual(context.exception.returncode, -signal.SIGKILL)
+        # Only the command is killed, the helper keeps taking requests
+        self.assertEqual(self.helper.run("bench --site a.frappe.cloud list-apps")[1], 0)
+
+    def test_not_running(self):
+        self.assertFalse(BenchHelperClient(os.path.join(self.test_dir, "missing.sock")).is_running())
+
+    def test_stopped_helper_takes_no_requests(self):
+        self.helper.stop()
+        self.assertFalse(self.helper.is_running())
+        self.assertFalse(os.path.exists(self.helper.path))
+
+    def test_site_commands_use_helper(self):
+        bench = Bench.__new__(Bench)
+        bench._output_publisher = bench._previous_output_key = None
+        bench.directory = self.test_dir
+        bench.sites_directory = self.sites_directory
+        bench.server = SimpleNamespace(config={"bench_helper": True})
+        with patch.object(Bench, "get_redis_key", return_value=None), patch.object(
+            Bench, "publish_output"
+        ) as publish_output, patch.object(Bench, "docker_execute") as docker_execute:
+            result = bench.site_execute("a.frappe.cloud", "list-apps")
+            bench.site_execute("a.frappe.cloud", "migrate")
+
+        self.assertIn("args ['--site', 'a.frappe.cloud', 'list-apps']", result["output"])
+        self.assertTrue(publish_output.called)
+        docker_execute.assert_called_once_with("bench --site a.frappe.cloud migrate", input=None)
@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from agent.job import COMPRESSED_DATA_PREFIX, JobModel, StepModel, agent_database
+
+
+class TestCompressedData(unittest.TestCase):
+    """Tests for compressed storage of job data."""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        agent_database.init(os.path.join(self.test_dir, "jobs.sqlite3"))
+        agent_database.create_tables([JobModel, StepModel])
+
+    def tearDown(self):
+        agent_database.close()
+        shutil.rmtree(self.test_dir)
+
+    def _stored_data(self, job: JobModel):
+        return agent_database.execute_sql("SELECT data FROM jobmodel WHERE id = ?", (job.id,)).fetchone()[0]
+
+    def test_long_data_is_compressed(self):
+        """Ensure long data is stored compressed and decompresses to the original."""
+        data = json.dumps({"output": "line\n" * 10000})
+        job = JobModel.create(name="Test", status="Success", data=data)
+
+        self.assertTrue(self._stored_data(job).startswith(COMPRESSED_DATA_PREFIX))
+        self.assertEqual(JobModel.get_by_id(job.id).data, data)
+
+    def test_short_and_old_data_read_as_text(self):
+        """Ensure short data and rows saved before compression are read as is."""
+        job = JobModel.create(name="Test", status="Success", data='{"short": true}')
+        self.assertEqual(self._stored_data(job), '{"short": true}')
+        self.assertEqual(JobModel.get_by_id(job.id).data, '{"short": true}')
+
+    def test_saving_read_model_keeps_data(self):
+        """Ensure saving a model with compressed data doesn't compress it twice."""
+        data = json.dumps({"output": "line\n" * 10000})
+        job = JobModel.create(name="Test", status="Running", data=data)
+
+        job = JobModel.get_by_id(job.id)
+        job.status = "Failure"
+        job.save()
+
+        self.assertEqual(JobModel.get_by_id(job.id).data, data)
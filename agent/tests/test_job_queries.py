@@ -0,0 +1,124 @@
+from __future__ import annotations
+
+import os
+import shutil
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+from agent import web
+from agent.job import JobModel, StepModel, agent_database
+from agent.patches import add_composite_indexes_on_job_models
+
+INDEXED_ACCESS = ("USING INDEX", "USING COVERING INDEX", "USING INTEGER PRIMARY KEY", "USING ROWID")
+
+
+class FakePipeline:
+    """Answers every lookup jobs_to_dict queues as if redis had nothing for the job."""
+
+    def __init__(self):
+        self.results = {"hget": None, "get": None, "lrange": [], "zrange": [], "getrange": b""}
+        self.queued = []
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.queued.append(self.results[name])
+
+    def execute(self):
+        queued, self.queued = self.queued, []
+        return queued
+
+
+class TestJobQueriesUseIndexes(unittest.TestCase):
+    """Ensure queries made by job endpoints in web.py don't scan the jobs tables."""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        agent_database.init(os.path.join(self.test_dir, "jobs.sqlite3"))
+        agent_database.create_tables([JobModel, StepModel])
+        add_composite_indexes_on_job_models.execute()
+
+        for i in range(10):
+            job = JobModel.create(name="Test", status="Success", agent_job_id=str(i))
+            StepModel.create(job=job, name="Step", status="Success", start=job.enqueue)
+
+    def tearDown(self):
+        agent_database.close()
+        shutil.rmtree(self.test_dir)
+
+    def _capture_queries(self, function, *args, query_string=None, **kwargs) -> list[tuple[str, tuple]]:
+        queries = []
+        execute_sql = agent_database.execute_sql
+
+        def capture(sql, params=None, **kwargs):
+            queries.append((sql, tuple(params or ())))
+            return execute_sql(sql, params, **kwargs)
+
+        redis = MagicMock()
+        redis.pipeline.side_effect = lambda **kwargs: FakePipeline()
+        with web.application.test_request_context(query_string=query_string), patch.object(
+            agent_database, "execute_sql", side_effect=capture
+        ), patch.object(web, "connection", return_value=redis):
+            function(*args, **kwargs)
+        return queries
+
+    def assertUsesIndexes(self, queries: list[tuple[str, tuple]]):
+        self.assertTrue(queries)
+        for sql, params in queries:
+            plan = [row[-1] for row in agent_database.execute_sql(f"EXPLAIN QUERY PLAN {sql}", params)]
+            with self.subTest(sql=sql, plan=plan):
+                self.assertFalse([detail for detail in plan if "TEMP B-TREE" in detail])
+                for detail in plan:
+                    if detail.startswith("SCAN") and "ORDER BY" in sql and "LIMIT" in sql:
+                        # Walking the primary key in order, stops at the limit
+                        continue
+                    if detail.startswith(("SEARCH", "SCAN")):
+                        self.assertTrue(any(access in detail for access in INDEXED_ACCESS))
+
+    def assertStepsUseIndex(self, queries: list[tuple[str, tuple]]):
+        steps = [(sql, params) for sql, params in queries if 'FROM "stepmodel"' in sql]
+        self.assertTrue(steps)
+        for sql, params in steps:
+            plan = [row[-1] for row in agent_database.execute_sql(f"EXPLAIN QUERY PLAN {sql}", params)]
+            with self.subTest(sql=sql, plan=plan):
+                self.assertTrue([detail for detail in plan if "USING INDEX stepmodel_job_id" in detail])
+                # Step data is only read with ?data=1
+                self.assertNotIn('"data"', sql)
+
+    def test_jobs(self):
+        self.assertUsesIndexes(self._capture_queries(web.jobs))
+
+    def test_jobs_by_id(self):
+        queries = self._capture_queries(web.jobs, id=1)
+        self.assertUsesIndexes(queries)
+        self.assertStepsUseIndex(queries)
+
+    def test_jobs_by_ids(self):
+        queries = self._capture_queries(web.jobs, ids="1,2,3")
+        self.assertUsesIndexes(queries)
+        self.assertStepsUseIndex(queries)
+
+    def test_jobs_by_ids_with_data(self):
+        queries = self._capture_queries(web.jobs, ids="1,2,3", query_string={"data": 1})
+        self.assertUsesIndexes(queries)
+        steps = [sql for sql, _ in queries if 'FROM "stepmodel"' in sql]
+        self.assertTrue(steps)
+        self.assertTrue(all('"data"' in sql for sql in steps))
+
+    def test_jobs_by_status(self):
+        self.assertUsesIndexes(self._capture_queries(web.jobs, status="Success"))
+
+    def test_agent_jobs(self):
+        self.assertUsesIndexes(self._capture_queries(web.agent_jobs))
+
+    def test_agent_jobs_by_id(self):
+        queries = self._capture_queries(web.agent_jobs, id=1)
+        self.assertUsesIndexes(queries)
+        self.assertStepsUseIndex(queries)
+
+    def test_agent_jobs_by_ids(self):
+        queries = self._capture_queries(web.agent_jobs, ids="1,2,3")
+        self.assertUsesIndexes(queries)
+        self.assertStepsUseIndex(queries)
+
+    def test_job_updates(self):
+        self.assertUsesIndexes(self._capture_queries(web.job_updates, id=1))
@@ -0,0 +1,76 @@
+from __future__ import annotations
+
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from agent.job import JobModel, StepModel, agent_database
+from agent.job_retention import JobRetention
+
+
+class TestJobRetention(unittest.TestCase):
+    """Tests for archiving and vacuuming the jobs database."""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        agent_database.init(os.path.join(self.test_dir, "jobs.sqlite3"))
+        agent_database.create_tables([JobModel, StepModel])
+        self.retention = JobRetention(os.path.join(self.test_dir, "archived-jobs"), {"Success": 30})
+
+    def tearDown(self):
+        agent_database.close()
+        shutil.rmtree(self.test_dir)
+
+    def _create_job(self, status: str, age: int) -> JobModel:
+        enqueue = datetime.now() - timedelta(days=age)
+        job = JobModel.create(name="Test", status=status, enqueue=enqueue, data=json.dumps({"x": "y" * 4096}))
+        StepModel.create(job=job, name="Step", status=status, start=enqueue, data="{}")
+        return job
+
+    def test_archives_only_expired_jobs(self):
+        """Ensure only jobs past their status' retention are archived, with their steps."""
+        old = self._create_job("Success", age=31)
+        recent = self._create_job("Success", age=1)
+        failed = self._create_job("Failure", age=365)
+
+        archived = self.retention.archive()
+
+        self.assertEqual(archived["jobs"], 1)
+        self.assertEqual([job.id for job in JobModel.select()], [recent.id, failed.id])
+        self.assertFalse(StepModel.select().where(StepModel.job == old.id).exists())
+        with gzip.open(archived["files"][0], "rt") as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([record["id"] for record in records], [old.id])
+        self.assertEqual(len(records[0]["steps"]), 1)
+
+    def test_dry_run_keeps_jobs(self):
+        """Ensure a dry run only counts expired jobs."""
+        self._create_job("Success", age=31)
+        self.assertEqual(self.retention.archive(dry_run=True), {"jobs": 1, "files": []})
+        self.assertEqual(JobModel.select().count(), 1)
+
+    def test_vacuum_reclaims_archived_space(self):
+        """Ensure space freed by archived jobs is given back."""
+        for _ in range(200):
+            self._create_job("Success", age=31)
+        agent_database.execute_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+
+        self.retention.archive()
+        vacuum = self.retention.vacuum()
+
+        self.assertTrue(vacuum["incremental"])
+        self.assertGreater(vacuum["reclaimed"], 0)
+        self.assertEqual(self.retention.pragma("freelist_count"), 0)
+
+    def test_full_vacuum_enables_incremental_vacuum(self):
+        """Ensure databases created without incremental auto vacuum can be switched."""
+        agent_database.execute_sql("PRAGMA auto_vacuum = NONE")
+        agent_database.execute_sql("VACUUM")
+        self.assertFalse(self.retention.vacuum()["incremental"])
+
+        self.retention.enable_incremental_vacuum()
+        self.assertTrue(self.retention.vacuum()["incremental"])
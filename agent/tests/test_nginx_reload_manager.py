@@ -0,0 +1,207 @@
+from __future__ import annotations
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from datetime import datetime
+from unittest.mock import MagicMock, patch
+
+from agent.nginx_reload_manager import (
+    PROCESSING_QUEUE,
+    RELOAD_REQUEST_STATUS_FORMAT,
+    RELOADED_CONFIG_HASH,
+    ManagerState,
+    NginxReloadManager,
+    ReloadStatus,
+    get_nginx_workers,
+)
+from agent.proxy import ProxyConfigUpdate
+
+
+class FakeRedis:
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+    def hset(self, key, field, value):
+        self.data.setdefault(key, {})[field] = str(value)
+
+    def hget(self, key, field):
+        return self.data.get(key, {}).get(field)
+
+    def hmget(self, key, fields):
+        return [self.hget(key, field) for field in fields]
+
+    def hdel(self, key, *fields):
+        for field in fields:
+            self.data.get(key, {}).pop(field, None)
+
+    def hincrby(self, key, field, amount=1):
+        counters = self.data.setdefault(key, {})
+        counters[field] = str(int(counters.get(field, 0)) + amount)
+
+    def hincrbyfloat(self, key, field, amount):
+        counters = self.data.setdefault(key, {})
+        counters[field] = str(float(counters.get(field, 0)) + amount)
+
+    def hgetall(self, key):
+        return self.data.get(key, {})
+
+    def rpush(self, key, *values):
+        self.data.setdefault(key, []).extend(values)
+
+    def ltrim(self, key, start, end):
+        self.data[key] = self.data.get(key, [])[start:]
+
+    def pipeline(self):
+        return self
+
+    def execute(self):
+        pass
+
+
+class TestNginxReloadManager(unittest.TestCase):
+    """Tests for skipping reloads when the proxy config didn't change."""
+
+    def setUp(self):
+        self.manager = NginxReloadManager(directory="/tmp")
+        self.manager._config = {}
+        self.redis = FakeRedis()
+        self.proxy = MagicMock()
+        self.proxy.get_proxy_config_hash.return_value = "a"
+        self.proxy._generate_proxy_config.return_value = ProxyConfigUpdate()
+
+    def _reload(self) -> tuple[ReloadStatus, bool]:
+        with patch.object(NginxReloadManager, "redis", new=self.redis), patch(
+            "agent.proxy.Proxy", return_value=self.proxy
+        ), patch("agent.nginx_reload_manager.subprocess.run") as run:
+            return self.manager._reload_nginx(), run.called
+
+    def _counters(self) -> dict[str, int]:
+        with patch.object(NginxReloadManager, "redis", new=self.redis):
+            return self.manager.get_reload_counters()
+
+    def test_unchanged_config_is_not_reloaded(self):
+        self.assertEqual(self._reload(), (ReloadStatus.Success, True))
+        self.assertEqual(self.redis.get(RELOADED_CONFIG_HASH), "a")
+        self.assertEqual(self._reload(), (ReloadStatus.Success, False))
+        self.assertEqual(self._counters(), {"performed": 1, "skipped": 1, "failed": 0})
+
+        self.proxy.get_proxy_config_hash.return_value = "b"
+        self.assertEqual(self._reload(), (ReloadStatus.Success, True))
+        self.assertEqual(self._counters(), {"performed": 2, "skipped": 1, "failed": 0})
+
+    def test_failed_reload_is_retried(self):
+        self.proxy._generate_proxy_config.side_effect = Exception("Broken config")
+        self.assertEqual(self._reload(), (ReloadStatus.Failure, False))
+
+        self.proxy._generate_proxy_config.side_effect = None
+        self.assertEqual(self._reload(), (ReloadStatus.Success, True))
+        self.assertEqual(self._counters(), {"performed": 1, "skipped": 0, "failed": 1})
+
+    def _finish_reload(self, update: ProxyConfigUpdate) -> dict[str, str]:
+        self.proxy._generate_proxy_config.return_value = update
+        with patch.object(NginxReloadManager, "redis", new=self.redis):
+            self.manager.request_reload("a", units=["host:a.frappe.cloud"])
+            self.manager.request_reload("b", units=["host:b.frappe.cloud"])
+            self.redis.rpush(PROCESSING_QUEUE, "a", "b")
+            self.manager.job_ids = ["a", "b"]
+            self._reload()
+            self.manager.state = ManagerState.RELOAD_SUCCESS
+            self.manager._process_state()
+        return {job_id: self.redis.get(RELOAD_REQUEST_STATUS_FORMAT.format(job_id)) for job_id in ("a", "b")}
+
+    def test_requests_with_quarantined_changes_fail(self):
+        statuses = self._finish_reload(ProxyConfigUpdate(quarantined={"host:a.frappe.cloud": "invalid"}))
+        self.assertEqual(statuses, {"a": "Failure", "b": "Success"})
+        self.assertEqual(self.redis.get(PROCESSING_QUEUE), [])
+
+    def test_requests_wait_for_unchecked_changes(self):
+        statuses = self._finish_reload(ProxyConfigUpdate(unchecked=["host:b.frappe.cloud"]))
+        self.assertEqual(statuses, {"a": "Queued", "b": "Queued"})
+        self.assertEqual(self.redis.get(PROCESSING_QUEUE), ["a", "b"])
+        self.assertEqual(self.manager.state, ManagerState.WAIT)
+
+
+class TestNginxReloadScheduling(unittest.TestCase):
+    """Tests for scheduling reloads around old workers shutting down, within the latency SLO."""
+
+    def setUp(self):
+        self.manager = NginxReloadManager(directory="/tmp")
+        self.manager._config = {"nginx_reload_latency_slo": 30}
+        self.manager.start_time = self.manager.last_reload_at = None
+        self.redis = FakeRedis()
+        self.test_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _add_process(self, pid: int, ppid: int, cmdline: str):
+        directory = os.path.join(self.test_dir, str(pid))
+        os.makedirs(directory)
+        with open(os.path.join(directory, "stat"), "w") as f:
+            f.write(f"{pid} (nginx: worker) S {ppid} {pid} {pid} 0 -1")
+        with open(os.path.join(directory, "cmdline"), "wb") as f:
+            f.write(cmdline.encode() + b"\0")
+
+    def _should_defer(self, workers: tuple[int, int], waited: float, job_ids: int = 1) -> bool:
+        self.manager.job_ids = [str(i) for i in range(job_ids)]
+        self.manager.oldest_requested_at = time.time() - waited
+        with patch("agent.nginx_reload_manager.get_nginx_workers", return_value=workers):
+            return self.manager._should_defer_reload()
+
+    def test_workers_are_read_from_proc(self):
+        pid_file = os.path.join(self.test_dir, "nginx.pid")
+        with open(pid_file, "w") as f:
+            f.write("100\n")
+        self._add_process(100, 1, "nginx: master process /usr/sbin/nginx")
+        self._add_process(101, 100, "nginx: worker process")
+        self._add_process(102, 100, "nginx: worker process is shutting down")
+        self._add_process(103, 100, "nginx: cache manager process")
+        self._add_process(201, 200, "nginx: worker process")
+        self.assertEqual(get_nginx_workers(pid_file, self.test_dir), (1, 1))
+
+    def test_reload_is_deferred_within_latency_slo(self):
+        self.assertFalse(self._should_defer((4, 0), waited=1))
+        self.assertTrue(self._should_defer((4, 4), waited=1))
+        self.assertFalse(self._should_defer((4, 4), waited=40))
+        self.assertFalse(self._should_defer((4, 4), waited=1, job_ids=NginxReloadManager.batch_size))
+        self.assertTrue(self._should_defer((4, 12), waited=40))
+
+    def test_deferral_shrinks_with_queue_length(self):
+        self.assertTrue(self._should_defer((4, 4), waited=1, job_ids=100))
+        self.assertFalse(self._should_defer((4, 4), waited=1, job_ids=950))
+        self.assertFalse(self._should_defer((4, 4), waited=29))
+
+    def test_drain_ends_on_idle_ticks(self):
+        self.manager.state = ManagerState.WAIT
+        self.manager.start_time = datetime.now()
+        self.manager.draining_since = time.monotonic() - 1
+        with patch("agent.nginx_reload_manager.get_nginx_workers", return_value=(4, 0)), patch(
+            "agent.nginx_reload_manager.time.sleep"
+        ):
+            self.manager._process_state()
+        self.assertIsNone(self.manager.draining_since)
+        self.assertAlmostEqual(self.manager.drain_time, 1, delta=0.5)
+
+    def test_wait_times_are_observed(self):
+        with patch.object(NginxReloadManager, "redis", new=self.redis):
+            self.manager.request_reload("a")
+            self.manager.request_reload("b")
+            self.redis.hset("nginx||reload_requested_at", "b", time.time() - 20)
+            self.manager._update_status_and_cleanup(["a", "b"], ReloadStatus.Success)
+            buckets, total = self.manager.get_reload_wait_histogram()
+
+        self.assertEqual(dict(buckets)["1"], 1)
+        self.assertEqual(dict(buckets)["15"], 1)
+        self.assertEqual(dict(buckets)["30"], 2)
+        self.assertEqual(dict(buckets)["+Inf"], 2)
+        self.assertGreaterEqual(total, 20)
+        self.assertEqual(self.redis.hgetall("nginx||reload_requested_at"), {})
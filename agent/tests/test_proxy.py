@@ -2,11 +2,17 @@ from __future__ import annotations
 
 import json
 import os
+import re
 import shutil
+import subprocess
+import tempfile
 import unittest
+from functools import partial
+from pathlib import Path
 from unittest.mock import patch
 
-from agent.proxy import Proxy
+from agent.proxy import CERTIFICATE_DIRECTIVE, CERTIFICATE_FILES, Proxy, ProxyConfigFiles, ProxyConfigUpdate
+from agent.proxy_validation import ProxyConfigValidator
 
 
 class TestProxy(unittest.TestCase):
@@ -55,6 +61,7 @@ class TestProxy(unittest.TestCase):
         proxy.hosts_directory = self.hosts_directory
         proxy.nginx_directory = os.path.join(self.test_dir, "nginx")
         proxy._proxy_config_modification_lock = None
+        proxy._index = None
         return proxy
 
     def test_hosts_redirects_default_domain(self):
@@ -271,3 +278,289 @@ class TestProxy(unittest.TestCase):
         map_file = os.path.join(host_dir, "map.json")
         with open(map_file) as m:
             self.assertDictEqual(json.load(m), {self.domain_1: "yyy.frappe.cloud"})
+
+
+class TestProxyIndex(unittest.TestCase):
+    """Tests for the index of hosts and upstreams used to generate the proxy config."""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.nginx_directory = os.path.join(self.test_dir, "nginx")
+        self.upstreams_directory = os.path.join(self.nginx_directory, "upstreams")
+        self.hosts_directory = os.path.join(self.nginx_directory, "hosts")
+        for upstream in ("10.0.0.1", "10.0.0.2"):
+            os.makedirs(os.path.join(self.upstreams_directory, upstream))
+            for site, status in (("a", ""), ("b", "suspended"), ("c", "deactivated\n")):
+                site_file = os.path.join(self.upstreams_directory, upstream, f"{site}-{upstream}.com")
+                with open(site_file, "w") as f:
+                    f.write(status)
+        self._write_host("*.frappe.cloud", {"default": "$host"})
+        self._write_host("balu.codes", {"balu.codes": "a-10.0.0.1.com"})
+        self._write_host("www.balu.codes", redirects={"www.balu.codes": "balu.codes"})
+
+        with patch.object(Proxy, "__init__", new=lambda x: None):
+            self.proxy = Proxy()
+        self.proxy.nginx_directory = self.nginx_directory
+        self.proxy.upstreams_directory = self.upstreams_directory
+        self.proxy.hosts_directory = self.hosts_directory
+        self.proxy._proxy_config_modification_lock = None
+        self.proxy._index = None
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _write_host(self, host, map=None, redirects=None):
+        os.makedirs(os.path.join(self.hosts_directory, host), exist_ok=True)
+        for name, content in (("map.json", map), ("redirect.json", redirects)):
+            if content is not None:
+                with open(os.path.join(self.hosts_directory, host, name), "w") as f:
+                    json.dump(content, f)
+
+    def assertIndexMatchesFiles(self):
+        upstreams = self.proxy.upstreams
+        for upstream in upstreams.values():
+            upstream["sites"].sort(key=lambda site: site["name"])
+        self.assertEqual(self.proxy.index.upstreams(), upstreams)
+        self.assertEqual(dict(self.proxy.index.hosts()), dict(self.proxy.hosts))
+        self.assertEqual(sorted(self.proxy.index.wildcards()), sorted(self.proxy.wildcards))
+
+    def test_index_matches_files(self):
+        self.proxy.index.sync()
+        self.assertIndexMatchesFiles()
+
+    def test_proxy_methods_update_index(self):
+        self.proxy.index.sync()
+        self.assertEqual(self.proxy.index.updated_units, set())
+        Proxy.update_site_status.__wrapped__(self.proxy, "10.0.0.1", "a-10.0.0.1.com", "deactivated")
+        Proxy.add_site_to_upstream.__wrapped__(self.proxy, "10.0.0.3", "d-10.0.0.3.com")
+        Proxy.remove_conflicting_site.__wrapped__(self.proxy, "b-10.0.0.2.com")
+        Proxy.setup_redirect.__wrapped__(self.proxy, "balu.codes", "www.balu.codes")
+        Proxy.rename_site_in_host_dir.__wrapped__(self.proxy, "balu.codes", "a-10.0.0.1.com", "e.com")
+        self.assertIndexMatchesFiles()
+        self.assertEqual(self.proxy.index.site_upstreams("d-10.0.0.3.com"), ["10.0.0.3"])
+        upstreams = self.proxy.index.upstreams()
+        self.assertEqual(
+            self.proxy.index.updated_units,
+            {
+                *(
+                    f"upstream:{upstreams[upstream]['hash']}"
+                    for upstream in ("10.0.0.1", "10.0.0.2", "10.0.0.3")
+                ),
+                "host:balu.codes",
+            },
+        )
+
+    def test_sync_picks_up_other_changes(self):
+        """Ensure files added or removed without Proxy are indexed on the next sync."""
+        self.proxy.index.sync()
+        os.remove(os.path.join(self.upstreams_directory, "10.0.0.2", "c-10.0.0.2.com"))
+        shutil.rmtree(os.path.join(self.upstreams_directory, "10.0.0.1"))
+        shutil.rmtree(os.path.join(self.hosts_directory, "www.balu.codes"))
+        self._write_host("new.balu.codes", {"new.balu.codes": "c-10.0.0.2.com"})
+
+        self.proxy.index.sync()
+        self.assertIndexMatchesFiles()
+
+    def _generate_proxy_config(self, validate: bool = False) -> list[str]:
+        return self._update_proxy_config(validate).changed
+
+    def _update_proxy_config(self, validate: bool = False) -> ProxyConfigUpdate:
+        config = {"domain": "frappe.cloud", "nginx_directory": self.nginx_directory}
+        self.proxy.error_pages_directory = os.path.join(self.test_dir, "pages")
+        with patch.object(Proxy, "get_config", return_value=config), patch.object(Proxy, "config", new={}):
+            return self.proxy._generate_proxy_config(validate=validate)
+
+    def _nginx_test(self, args, **kwargs):
+        """Fails like `nginx -t` when any included file, or certificate, has "invalid" in it."""
+        self.nginx_tests += 1
+        directory = os.path.join(os.path.dirname(args[-1]), "proxy.d")
+        for root, _, files in os.walk(directory):
+            for file in files:
+                with open(os.path.join(root, file)) as f:
+                    content = f.read()
+                for path in [os.path.join(root, file), *CERTIFICATE_DIRECTIVE.findall(content)]:
+                    if os.path.exists(path) and "invalid" in Path(path).read_text():
+                        return subprocess.CompletedProcess(args, 1, "", f"invalid in {path}")
+        return subprocess.CompletedProcess(args, 0, "", "")
+
+    def _write_certificate(self, host, content):
+        for file in CERTIFICATE_FILES:
+            with open(os.path.join(self.hosts_directory, host, file), "w") as f:
+                f.write(content)
+
+    def test_only_changed_config_files_are_written(self):
+        proxy_config_directory = os.path.join(self.nginx_directory, "proxy.d")
+        changed = self._generate_proxy_config()
+        self.assertIn(os.path.join(self.nginx_directory, "proxy.conf"), changed)
+        self.assertIn(os.path.join(proxy_config_directory, "hosts", "_.frappe.cloud.conf"), changed)
+        self.assertEqual(self._generate_proxy_config(), [])
+
+        Proxy.update_site_status.__wrapped__(self.proxy, "10.0.0.1", "a-10.0.0.1.com", "deactivated")
+        shutil.rmtree(os.path.join(self.hosts_directory, "www.balu.codes"))
+        upstream_hash = self.proxy.index.upstreams()["10.0.0.1"]["hash"]
+        self.assertEqual(
+            sorted(self._generate_proxy_config()),
+            [
+                os.path.join(proxy_config_directory, "host-maps", "www.balu.codes.conf"),
+                os.path.join(proxy_config_directory, "hosts", "www.balu.codes.conf"),
+                os.path.join(proxy_config_directory, "upstream-sites", f"{upstream_hash}.conf"),
+            ],
+        )
+        self.assertFalse(os.path.exists(os.path.join(proxy_config_directory, "hosts", "www.balu.codes.conf")))
+        with open(os.path.join(proxy_config_directory, "upstream-sites", f"{upstream_hash}.conf")) as f:
+            self.assertIn("a-10.0.0.1.com http://deactivated;", f.read())
+
+    def test_template_changes_are_written(self):
+        self._generate_proxy_config()
+        with patch.object(ProxyConfigFiles, "get_template_hash", return_value="edited"):
+            changed = self._generate_proxy_config()
+        self.assertIn(os.path.join(self.nginx_directory, "proxy.conf"), changed)
+        self.assertIn(os.path.join(self.nginx_directory, "proxy.d", "hosts", "balu.codes.conf"), changed)
+
+    def test_config_hash_changes_with_config_and_certificates(self):
+        self._generate_proxy_config()
+        config_hash = self.proxy.get_proxy_config_hash()
+        certificate = os.path.join(self.hosts_directory, "balu.codes", "fullchain.pem")
+        with open(certificate, "w") as f:
+            f.write("certificate")
+        self.assertEqual(self.proxy.get_proxy_config_hash(), config_hash)
+        self._generate_proxy_config()
+        self.assertNotEqual(self.proxy.get_proxy_config_hash(), config_hash)
+
+        config_hash = self.proxy.get_proxy_config_hash()
+        Proxy.update_site_status.__wrapped__(self.proxy, "10.0.0.1", "a-10.0.0.1.com", "deactivated")
+        self.assertEqual(self.proxy.get_proxy_config_hash(), config_hash)
+        self._generate_proxy_config()
+        self.assertNotEqual(self.proxy.get_proxy_config_hash(), config_hash)
+
+    def test_invalid_changes_are_quarantined(self):
+        self.nginx_tests = 0
+        quarantine_file = os.path.join(self.nginx_directory, "proxy-quarantine.json")
+        bad_host = os.path.join(self.nginx_directory, "proxy.d", "hosts", "bad.balu.codes.conf")
+        with patch("agent.proxy_validation.subprocess.run", new=self._nginx_test):
+            self._generate_proxy_config(validate=True)
+            self.assertEqual(self.nginx_tests, 1)
+
+            self._write_host("bad.balu.codes", {"bad.balu.codes": "invalid"})
+            Proxy.update_site_status.__wrapped__(self.proxy, "10.0.0.1", "a-10.0.0.1.com", "deactivated")
+            update = self._update_proxy_config(validate=True)
+            changed = update.changed
+            self.assertNotIn(bad_host, changed)
+            self.assertEqual(len(changed), 1)
+            self.assertEqual(list(update.quarantined), ["host:bad.balu.codes"])
+            self.assertEqual(
+                update.messages,
+                [f"Quarantined host:bad.balu.codes: {update.quarantined['host:bad.balu.codes']}"],
+            )
+            self.assertFalse(os.path.exists(bad_host))
+            with open(quarantine_file) as f:
+                self.assertEqual(list(json.load(f)), ["host:bad.balu.codes"])
+
+            # Quarantined changes aren't checked again until they change
+            nginx_tests = self.nginx_tests
+            self.assertEqual(self._generate_proxy_config(validate=True), [])
+            self.assertEqual(self.nginx_tests, nginx_tests)
+
+            self._write_host("bad.balu.codes", {"bad.balu.codes": "a-10.0.0.1.com"})
+            self.proxy.index.update_host("bad.balu.codes")
+            self.assertIn(bad_host, self._generate_proxy_config(validate=True))
+            with open(quarantine_file) as f:
+                self.assertEqual(json.load(f), {})
+
+    def test_invalid_certificates_are_quarantined(self):
+        self.nginx_tests = 0
+        host_config = os.path.join(self.nginx_directory, "proxy.d", "hosts", "balu.codes.conf")
+        certificates_directory = os.path.join(self.nginx_directory, "certificates", "balu.codes")
+        self._write_certificate("balu.codes", "certificate")
+        with patch("agent.proxy_validation.subprocess.run", new=self._nginx_test):
+            self._generate_proxy_config(validate=True)
+            with open(host_config) as f:
+                working = f.read()
+            working_certificates = set(os.listdir(certificates_directory))
+
+            # Renewed in place, the live config keeps loading the previous copies
+            self._write_certificate("balu.codes", "invalid")
+            self.assertEqual(self._generate_proxy_config(validate=True), [])
+            with open(host_config) as f:
+                self.assertEqual(f.read(), working)
+            for path in CERTIFICATE_DIRECTIVE.findall(working):
+                with open(path) as f:
+                    self.assertEqual(f.read(), "certificate")
+
+            self._write_certificate("balu.codes", "renewed")
+            self.assertEqual(self._generate_proxy_config(validate=True), [host_config])
+            self.assertEqual(len(os.listdir(certificates_directory)), len(CERTIFICATE_FILES))
+            self.assertFalse(working_certificates & set(os.listdir(certificates_directory)))
+
+    def test_unchecked_changes_are_kept_back(self):
+        self.nginx_tests = 0
+        hosts = [f"bad-{i}.balu.codes" for i in range(4)]
+        validator = partial(ProxyConfigValidator, max_runs=4)
+        with patch("agent.proxy_validation.subprocess.run", new=self._nginx_test), patch(
+            "agent.proxy.ProxyConfigValidator", new=validator
+        ):
+            self._generate_proxy_config(validate=True)
+            for host in hosts:
+                self._write_host(host, {host: "invalid"})
+            self._write_host("good.balu.codes", {"good.balu.codes": "a-10.0.0.1.com"})
+
+            update = self._update_proxy_config(validate=True)
+            changed = update.changed
+            quarantine_file = os.path.join(self.nginx_directory, "proxy-quarantine.json")
+            with open(quarantine_file) as f:
+                quarantined = set(json.load(f))
+            self.assertTrue(quarantined)
+            self.assertEqual(set(update.quarantined), quarantined)
+            self.assertTrue(update.unchecked)
+            self.assertFalse(any(host in path for path in changed for host in hosts))
+
+            # Checked on later reloads, until every change is quarantined or applied
+            for _ in range(len(hosts)):
+                changed += self._generate_proxy_config(validate=True)
+            with open(quarantine_file) as f:
+                self.assertEqual(set(json.load(f)), {f"host:{host}" for host in hosts})
+            good_host = os.path.join(self.nginx_directory, "proxy.d", "hosts", "good.balu.codes.conf")
+            self.assertIn(good_host, changed)
+
+    def _nginx_test_conflicts(self, args, **kwargs):
+        """Fails like `nginx -t` when a site is in the config of more than one upstream."""
+        directory = os.path.join(os.path.dirname(args[-1]), "proxy.d", "upstream-sites")
+        seen = set()
+        for file in sorted(os.listdir(directory)):
+            with open(os.path.join(directory, file)) as f:
+                for site in re.findall(r"^\s*(\S+\.com) ", f.read(), re.M):
+                    if site in seen:
+                        return subprocess.CompletedProcess(args, 1, "", f'conflicting parameter "{site}"')
+                    seen.add(site)
+        return subprocess.CompletedProcess(args, 0, "", "")
+
+    def test_conflicting_sites_are_fixed(self):
+        older = os.path.join(self.upstreams_directory, "10.0.0.1", "d.com")
+        newer = os.path.join(self.upstreams_directory, "10.0.0.2", "d.com")
+        with patch("agent.proxy_validation.subprocess.run", new=self._nginx_test_conflicts):
+            Proxy.add_site_to_upstream.__wrapped__(self.proxy, "10.0.0.1", "d.com")
+            self._generate_proxy_config(validate=True)
+
+            Proxy.add_site_to_upstream.__wrapped__(self.proxy, "10.0.0.2", "d.com")
+            os.utime(older, (0, 0))
+            update = self._update_proxy_config(validate=True)
+            upstreams = self.proxy.index.upstreams()
+            self.assertEqual(update.quarantined, {})
+            self.assertEqual(update.unchecked, [f"upstream:{upstreams['10.0.0.2']['hash']}"])
+            self.assertEqual(
+                update.messages[0], f"Removed conflicting site files for {update.unchecked[0]}: {older}"
+            )
+            self.assertFalse(os.path.exists(older))
+            self.assertTrue(os.path.exists(newer))
+
+            # The removal and the kept back change are applied together on the next reload
+            update = self._update_proxy_config(validate=True)
+            self.assertEqual((update.quarantined, update.unchecked), ({}, []))
+            upstream_sites_directory = os.path.join(self.nginx_directory, "proxy.d", "upstream-sites")
+            self.assertEqual(
+                sorted(update.changed),
+                sorted(
+                    os.path.join(upstream_sites_directory, f"{upstream['hash']}.conf")
+                    for upstream in upstreams.values()
+                ),
+            )
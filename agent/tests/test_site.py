@@ -4,12 +4,14 @@ import json
 import os
 import shutil
 import unittest
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 from agent.base import AgentException
 from agent.bench import Bench
+from agent.exceptions import BenchNotExistsException, InvalidSiteConfigException, SiteNotExistsException
 from agent.server import Server
 from agent.site import Site
+from agent.web import stream_json_object
 
 
 class TestSite(unittest.TestCase):
@@ -124,3 +126,84 @@ class TestSite(unittest.TestCase):
             bench.valid_sites[site_name]
         except KeyError:
             self.fail("Site not found in bench.sites")
+
+    def test_get_site_builds_only_the_named_site(self):
+        """Ensure get_site finds a site without parsing other site configs."""
+        bench = self._get_test_bench()
+        self._create_test_site("site.frappe.cloud")
+        self._make_site_config("site.frappe.cloud")
+        self._create_test_site("corrupt-site.frappe.cloud")
+        self._make_site_config("corrupt-site.frappe.cloud", content="{")
+
+        self.assertEqual(bench.get_site("site.frappe.cloud").name, "site.frappe.cloud")
+        with self.assertRaises(SiteNotExistsException):
+            bench.get_site("missing-site.frappe.cloud")
+        with self.assertRaises(SiteNotExistsException):
+            bench.get_site("..")
+        with patch.object(Bench, "execute", side_effect=AgentException({})), self.assertRaises(
+            InvalidSiteConfigException
+        ):
+            bench.get_site("corrupt-site.frappe.cloud")
+
+    def test_get_bench_builds_only_the_named_bench(self):
+        """Ensure get_bench finds a bench and raises for missing ones."""
+        server = self._get_test_bench().server
+        self.assertEqual(server.get_bench(self.bench_name).name, self.bench_name)
+        with self.assertRaises(BenchNotExistsException):
+            server.get_bench("missing-bench")
+        with self.assertRaises(BenchNotExistsException):
+            server.get_bench("../benches")
+
+    def test_sites_info_computes_only_requested_fields(self):
+        """Ensure sites info skips usage lookups when only config is asked for, and streams valid JSON."""
+        bench = self._get_test_bench()
+        bench.server.name = "test-server"
+        for site_name in ("a.frappe.cloud", "b.frappe.cloud"):
+            self._create_test_site(site_name)
+            self._make_site_config(site_name)
+
+        with patch("agent.bench.get_usage", side_effect=AssertionError("usage was looked up")):
+            info = bench.fetch_sites_info(fields=("config",))
+        self.assertEqual(sorted(info), ["a.frappe.cloud", "b.frappe.cloud"])
+        self.assertEqual(list(info["a.frappe.cloud"]), ["config"])
+
+        streamed = "".join(stream_json_object(bench.iter_sites_info(fields=("config",))))
+        self.assertEqual(json.loads(streamed), info)
+        self.assertEqual(json.loads("".join(stream_json_object([]))), {})
+
+    def test_stream_json_object_ends_with_error(self):
+        """Ensure a failure while streaming still ends the object, with the error as its last key."""
+
+        def items():
+            yield "a.frappe.cloud", {"timezone": "UTC"}
+            raise ValueError("usage history is locked")
+
+        with self.assertLogs("werkzeug", level="ERROR"):
+            streamed = json.loads("".join(stream_json_object(items())))
+        self.assertEqual(list(streamed), ["a.frappe.cloud", "error"])
+        self.assertIn("ValueError: usage history is locked", streamed["error"])
+
+    def test_reset_site_usage_pipelines_redis_commands(self):
+        """Ensure rate limit counters are scanned, read and deleted over one pipeline."""
+        bench = self._get_test_bench()
+        with open(self.bench_config, "w") as c:
+            json.dump({"docker_image": "fake_img_url", "single_container": True, "web_port": 18001}, c)
+        self._create_test_site("site.frappe.cloud")
+        self._make_site_config("site.frappe.cloud")
+        site = bench.get_site("site.frappe.cloud")
+
+        keys = ["fake_db_name|rate-limit-counter-1", "fake_db_name|rate-limit-counter-2"]
+        redis = MagicMock()
+        redis.scan_iter.return_value = iter(keys)
+        redis.pipeline.return_value.execute.return_value = ["10", 1, None, 0]
+
+        with patch("agent.site.connection", return_value=redis) as connection:
+            data = Site.reset_site_usage.__wrapped__(site)
+
+        connection.assert_called_once_with(12999, decode_responses=True)
+        redis.scan_iter.assert_called_once_with(match="fake_db_name|rate-limit-counter-[0-9]*", count=1000)
+        self.assertEqual(data["keys"]["output"], "\n".join(keys))
+        self.assertEqual([get["output"] for get in data["get"]], ["10", ""])
+        self.assertEqual([delete["command"] for delete in data["delete"]], [f"DEL {key}" for key in keys])
+        self.assertEqual([delete["output"] for delete in data["delete"]], ["1", "0"])
+        self.assertEqual(redis.pipeline.call_count, 1)
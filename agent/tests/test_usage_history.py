@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from agent.usage_history import add_usage, create_usage_history, get_usage, usage_database
+
+
+def make_sample(site: str, age: timedelta, timezone: str = "Asia/Kolkata") -> dict:
+    return {
+        "site": site,
+        "timestamp": str(datetime.utcnow() - age),
+        "timezone": timezone,
+        "database": 10,
+        "database_free_tables": [],
+        "database_free": 1,
+        "public": 2,
+        "private": 3,
+        "backups": 4,
+    }
+
+
+class TestUsageHistory(unittest.TestCase):
+    """Tests for the usage history store."""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        usage_database.init(os.path.join(self.test_dir, "usage.sqlite3"))
+
+    def tearDown(self):
+        usage_database.close()
+        shutil.rmtree(self.test_dir)
+
+    def test_get_usage_returns_samples_since_latest_first(self):
+        """Ensure only samples of the given sites after `since` are returned, latest first."""
+        add_usage(
+            [
+                make_sample("a.frappe.cloud", timedelta(hours=12), timezone="UTC"),
+                make_sample("a.frappe.cloud", timedelta(hours=6)),
+                make_sample("a.frappe.cloud", timedelta(days=2)),
+                make_sample("b.frappe.cloud", timedelta(hours=6)),
+            ]
+        )
+
+        usage = get_usage(["a.frappe.cloud", "c.frappe.cloud"], datetime.utcnow() - timedelta(days=1))
+
+        self.assertEqual(list(usage), ["a.frappe.cloud", "c.frappe.cloud"])
+        self.assertEqual([sample.timezone for sample in usage["a.frappe.cloud"]], ["Asia/Kolkata", "UTC"])
+        self.assertEqual(usage["c.frappe.cloud"], [])
+
+    def test_expired_samples_are_removed(self):
+        """Ensure samples older than the retention period are removed when new ones are added."""
+        add_usage([make_sample("a.frappe.cloud", timedelta(days=8))])
+        add_usage([make_sample("a.frappe.cloud", timedelta(hours=1))])
+
+        usage = get_usage(["a.frappe.cloud"], datetime.utcnow() - timedelta(days=30))
+        self.assertEqual(len(usage["a.frappe.cloud"]), 1)
+
+    def test_get_usage_without_store(self):
+        """Ensure sites have no samples before usage.py has run."""
+        self.assertEqual(get_usage(["a.frappe.cloud"], datetime.utcnow()), {"a.frappe.cloud": []})
+
+    def test_create_usage_history_imports_json_logs(self):
+        """Ensure samples from the JSON logs are imported once, when the table is created."""
+        with open(os.path.join(self.test_dir, "f1-usage-2024.json.log"), "w") as f:
+            json.dump([make_sample("a.frappe.cloud", timedelta(hours=6))], f)
+
+        create_usage_history(self.test_dir, "f1")
+        create_usage_history(self.test_dir, "f1")
+
+        usage = get_usage(["a.frappe.cloud"], datetime.utcnow() - timedelta(days=1))
+        self.assertEqual(len(usage["a.frappe.cloud"]), 1)
+
+    def test_create_usage_history_without_logs(self):
+        """Ensure the table is created even when there are no logs to import."""
+        create_usage_history(self.test_dir, "f1")
+        self.assertTrue(usage_database.table_exists("usagemodel"))
@@ -0,0 +1,141 @@
+from __future__ import annotations
+
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+from agent.utils import DirectorySizeCache, get_size, read_json_file, run_concurrently
+
+
+class TestReadJsonFile(unittest.TestCase):
+    """Tests for the cache of parsed JSON files."""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.test_dir, "config.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _write(self, value: dict, age: int = 60):
+        with open(self.path, "w") as f:
+            json.dump(value, f)
+        mtime = time.time() - age
+        os.utime(self.path, (mtime, mtime))
+
+    def test_unchanged_file_is_parsed_once(self):
+        """Ensure an unchanged file returns the same parsed value."""
+        self._write({"name": "a"})
+        self.assertIs(read_json_file(self.path), read_json_file(self.path))
+
+    def test_changed_file_is_parsed_again(self):
+        """Ensure a change to the file is picked up."""
+        self._write({"name": "a"})
+        self.assertEqual(read_json_file(self.path), {"name": "a"})
+        self._write({"name": "b"}, age=30)
+        self.assertEqual(read_json_file(self.path), {"name": "b"})
+
+    def test_recently_changed_file_is_not_cached(self):
+        """Ensure files that could change again within the same mtime aren't cached."""
+        self._write({"name": "a"}, age=0)
+        self.assertIsNot(read_json_file(self.path), read_json_file(self.path))
+
+    def test_uncached_read_returns_a_copy(self):
+        """Ensure uncached reads can be modified without affecting the cache."""
+        self._write({"name": "a"})
+        read_json_file(self.path)
+        read_json_file(self.path, cached=False)["name"] = "b"
+        self.assertEqual(read_json_file(self.path), {"name": "a"})
+
+
+class TestRunConcurrently(unittest.TestCase):
+    """Tests for the bounded concurrent executor."""
+
+    def test_results_keep_order_and_capture_errors(self):
+        """Ensure results follow the order of items and errors don't stop other items."""
+
+        def function(item):
+            time.sleep(0.01 * (5 - item))
+            if item == 2:
+                raise ValueError(item)
+            return item * 10
+
+        results = run_concurrently(function, range(5))
+
+        self.assertEqual([result.item for result in results], [0, 1, 2, 3, 4])
+        self.assertEqual([result.result for result in results], [0, 10, None, 30, 40])
+        self.assertIsInstance(results[2].error, ValueError)
+        self.assertIn("ValueError", results[2].traceback)
+        with self.assertRaises(ValueError):
+            results[2].unwrap()
+
+
+def get_size_by_listdir(folder, ignore_dirs=None):
+    """Reference implementation, stats every entry separately."""
+    total_size = os.path.getsize(folder)
+    for item in os.listdir(folder):
+        itempath = os.path.join(folder, item)
+        if item in (ignore_dirs or []) or os.path.islink(itempath):
+            continue
+        if os.path.isfile(itempath):
+            total_size += os.path.getsize(itempath)
+        elif os.path.isdir(itempath):
+            total_size += get_size_by_listdir(itempath)
+    return total_size
+
+
+class TestGetSize(unittest.TestCase):
+    """Tests for directory size accounting."""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.test_dir, "private")
+        for directory in ("files", "files/nested", "backups", "empty"):
+            os.makedirs(os.path.join(self.root, directory))
+        for i, path in enumerate(("a.txt", "files/b.txt", "files/nested/c.txt", "backups/d.sql.gz")):
+            with open(os.path.join(self.root, path), "w") as f:
+                f.write("x" * 1000 * (i + 1))
+        os.symlink(os.path.join(self.root, "files"), os.path.join(self.root, "link"))
+        self._age(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def _age(self, folder):
+        mtime = time.time() - 60
+        for directory, _, _ in os.walk(folder):
+            os.utime(directory, (mtime, mtime))
+
+    def _write(self, path, size):
+        with open(os.path.join(self.root, path), "w") as f:
+            f.write("x" * size)
+        self._age(self.root)
+
+    def test_matches_reference_implementation(self):
+        """Ensure sizes match the listdir based walk, with and without workers."""
+        for ignore_dirs in (None, ["backups"]):
+            for max_workers in (1, 4):
+                with self.subTest(ignore_dirs=ignore_dirs, max_workers=max_workers):
+                    self.assertEqual(
+                        get_size(self.root, ignore_dirs=ignore_dirs, max_workers=max_workers),
+                        get_size_by_listdir(self.root, ignore_dirs=ignore_dirs),
+                    )
+
+    def test_cache_is_persisted_and_invalidated_by_directory_changes(self):
+        """Ensure cached sizes are reused across runs until a directory changes."""
+        cache_file = os.path.join(self.test_dir, "cache.json")
+        cache = DirectorySizeCache(cache_file)
+        self.assertEqual(get_size(self.root, cache=cache), get_size_by_listdir(self.root))
+        cache.save()
+
+        cache = DirectorySizeCache(cache_file)
+        self.assertEqual(len(cache.entries), 5)
+        with patch("os.scandir", side_effect=AssertionError("unchanged directory was listed")):
+            self.assertEqual(get_size(self.root, cache=cache), get_size_by_listdir(self.root))
+
+        self._write("files/nested/e.txt", 5000)
+        self.assertEqual(get_size(self.root, cache=cache), get_size_by_listdir(self.root))
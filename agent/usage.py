@@ -1,12 +1,20 @@
 from __future__ import annotations
 
-import json
 import os
 import sys
 import traceback
+from collections import defaultdict
 from datetime import datetime
+from typing import TYPE_CHECKING
+
+from peewee import MySQLDatabase
 
 from agent.server import Server
+from agent.usage_history import add_usage, create_usage_history
+from agent.utils import DirectorySizeCache, b2mb
+
+if TYPE_CHECKING:
+    from agent.site import Site
 
 
 def cstr(text, encoding="utf-8"):
@@ -27,30 +35,117 @@ def get_traceback():
     return "".join(cstr(t) for t in trace_list)
 
 
+def get_sites_by_database_host(server: Server) -> dict[tuple[str, int], list[Site]]:
+    """Returns sites by the host and port of their database server"""
+    sites = defaultdict(list)
+    for bench in server.benches.values():
+        for site in bench.sites.values():
+            sites[(site.host, site.port)].append(site)
+    return sites
+
+
+def connect(host: str, port: int, user: str, password: str) -> MySQLDatabase:
+    # One connection per database server, reused for every query made to it
+    return MySQLDatabase(
+        "information_schema", user=user, password=password, host=host, port=port, connect_timeout=10
+    )
+
+
+def get_databases_usage(database: MySQLDatabase, schemas: list[str]) -> dict[str, dict]:
+    """
+    Returns usage of all `schemas` with a single information_schema query.
+
+    Same as Site.get_database_size, get_database_free_size and
+    get_database_free_tables, by schema.
+    """
+    usage = {schema: {"size": 0, "free": 0, "free_tables": []} for schema in schemas}
+    placeholders = ", ".join(["%s"] * len(schemas))
+    cursor = database.execute_sql(
+        "SELECT `table_schema`, `table_name`, `data_length` + `index_length`, `data_free`"
+        f" FROM information_schema.tables WHERE `table_schema` IN ({placeholders})",
+        schemas,
+    )
+    for schema, table, size, free in cursor.fetchall():
+        schema_usage = usage[schema]
+        schema_usage["size"] += size or 0
+        schema_usage["free"] += free or 0
+        if free is not None and ((size and free / size > 0.2) or free > 100 * 1024 * 1024):
+            schema_usage["free_tables"].append([table, f"{free / 1024 / 1024:.2f}"])
+    return usage
+
+
+def get_timezone(database: MySQLDatabase, site: Site) -> str:
+    try:
+        cursor = database.execute_sql(
+            f"SELECT `defvalue` FROM `{site.database}`.`tabDefaultValue`"
+            " WHERE `defkey` = 'time_zone' AND `parent` = '__default'"
+        )
+        row = cursor.fetchone()
+        return row[0] if row else ""
+    except Exception:
+        return site.timezone
+
+
+def get_host_usage(
+    server: Server, host: str, port: int, sites: list[Site], time: str, size_cache: DirectorySizeCache
+) -> list[dict]:
+    """
+    Returns usage of all sites on a database server.
+
+    With usage_database_user set in config.json, database usage for every site on
+    the server comes from one query. Otherwise every site is queried with its own user.
+    """
+    usage, database = {}, None
+    user, password = server.config.get("usage_database_user"), server.config.get("usage_database_password")
+    if user:
+        try:
+            database = connect(host, port, user, password)
+            usage = get_databases_usage(database, [site.database for site in sites])
+        except Exception:
+            print(f"ERROR [{host}:{port}:{time}]: {get_traceback()}", file=sys.stderr)
+
+    info = []
+    for site in sites:
+        site_database = None
+        try:
+            if site.database not in usage:
+                site_database = connect(host, port, site.user, site.password)
+                usage.update(get_databases_usage(site_database, [site.database]))
+
+            database_usage = usage[site.database]
+            info.append(
+                {
+                    "site": site.name,
+                    "timestamp": str(datetime.utcnow()),
+                    "timezone": get_timezone(site_database or database, site),
+                    "database": b2mb(database_usage["size"]),
+                    "database_free_tables": database_usage["free_tables"],
+                    "database_free": b2mb(database_usage["free"]),
+                    **site.get_files_usage(size_cache, max_workers=4),
+                }
+            )
+        except Exception:
+            error_log = f"ERROR [{site.name}:{time}]: {get_traceback()}"
+            print(error_log, file=sys.stderr)
+        finally:
+            if site_database:
+                site_database.close()
+
+    if database:
+        database.close()
+    return info
+
+
 if __name__ == "__main__":
     info = []
     server = Server()
     time = datetime.utcnow().isoformat()
-    target_file = os.path.join(
-        server.directory,
-        "logs",
-        f"{server.name}-usage-{time}.json.log",
-    )
 
-    for bench in server.benches.values():
-        for site in bench.sites.values():
-            try:
-                info.append(
-                    {
-                        "site": site.name,
-                        "timestamp": str(datetime.utcnow()),
-                        "timezone": site.timezone,
-                        **site.get_usage(),
-                    }
-                )
-            except Exception:
-                error_log = f"ERROR [{site.name}:{time}]: {get_traceback()}"
-                print(error_log, file=sys.stderr)
-
-    with open(target_file, "w") as f:
-        json.dump(info, f, indent=1)
+    create_usage_history(os.path.join(server.directory, "logs"), server.name)
+
+    size_cache = DirectorySizeCache(os.path.join(server.directory, "usage-size-cache.json"))
+    for (host, port), sites in get_sites_by_database_host(server).items():
+        info.extend(get_host_usage(server, host, port, sites, time, size_cache))
+    size_cache.save()
+
+    add_usage(info)
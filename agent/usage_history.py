@@ -0,0 +1,103 @@
+from __future__ import annotations
+
+import json
+import os
+import sys
+import traceback
+from datetime import datetime, timedelta
+from glob import glob
+
+from peewee import CharField, DateTimeField, IntegerField, Model, SqliteDatabase, TextField
+
+# Usage samples collected by usage.py, kept for as long as press may ask for them
+USAGE_RETENTION = timedelta(days=7)
+
+usage_database = SqliteDatabase(
+    "usage.sqlite3",
+    timeout=15,
+    pragmas={
+        "journal_mode": "wal",
+        "synchronous": "normal",
+    },
+)
+
+
+class UsageModel(Model):
+    site = CharField()
+    timestamp = DateTimeField()
+    timezone = CharField(null=True)
+
+    database = IntegerField()
+    database_free = IntegerField(null=True)
+    database_free_tables = TextField(null=True)
+    public = IntegerField()
+    private = IntegerField()
+    backups = IntegerField()
+
+    class Meta:
+        database = usage_database
+        indexes = (
+            (("site", "timestamp"), False),
+            (("timestamp",), False),
+        )
+
+
+def add_usage(samples: list[dict]):
+    """Stores samples in the format written by usage.py, and removes expired ones."""
+    usage_database.create_tables([UsageModel])
+    rows = [
+        {
+            "site": sample["site"],
+            "timestamp": datetime.fromisoformat(sample["timestamp"]),
+            "timezone": sample.get("timezone"),
+            "database": sample["database"],
+            "database_free": sample.get("database_free"),
+            "database_free_tables": json.dumps(sample.get("database_free_tables", [])),
+            "public": sample["public"],
+            "private": sample["private"],
+            "backups": sample["backups"],
+        }
+        for sample in samples
+    ]
+    with usage_database.atomic():
+        for index in range(0, len(rows), 100):
+            UsageModel.insert_many(rows[index : index + 100]).execute()
+        UsageModel.delete().where(UsageModel.timestamp < datetime.utcnow() - USAGE_RETENTION).execute()
+
+
+def get_usage(sites: list[str], since: datetime) -> dict[str, list[UsageModel]]:
+    """Returns samples of `sites` taken after `since`, latest first."""
+    usage = {site: [] for site in sites}
+    if not sites or not usage_database.table_exists(UsageModel._meta.table_name):
+        return usage
+
+    # Stay well under SQLite's limit on query parameters
+    for index in range(0, len(sites), 500):
+        query = (
+            UsageModel.select()
+            .where((UsageModel.site << sites[index : index + 500]) & (UsageModel.timestamp > since))
+            .order_by(UsageModel.site.desc(), UsageModel.timestamp.desc())
+        )
+        for sample in query:
+            usage[sample.site].append(sample)
+    return usage
+
+
+def create_usage_history(logs_directory: str, server_name: str):
+    """
+    Creates the usage table, with samples from JSON logs that usage.py wrote
+    before usage history was kept in SQLite. Does nothing if the table exists.
+    """
+    if usage_database.table_exists(UsageModel._meta.table_name):
+        return
+
+    since = (datetime.utcnow() - USAGE_RETENTION).timestamp()
+    for file in glob(os.path.join(logs_directory, f"{server_name}-usage-*.json.log")):
+        if os.stat(file).st_mtime <= since:
+            continue
+        try:
+            with open(file) as f:
+                add_usage(json.load(f))
+        except Exception:
+            print(f"ERROR [{file}]: {traceback.format_exc()}", file=sys.stderr)
+    usage_database.create_tables([UsageModel])
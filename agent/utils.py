@@ -1,13 +1,19 @@
 from __future__ import annotations
 
 import hashlib
+import json
 import os
 import re
 import subprocess
+import time
+import traceback
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from dataclasses import dataclass
 from datetime import datetime, timedelta
 from math import ceil
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Any, Callable, Iterable
 from urllib.parse import urlparse
 
 import requests
@@ -34,6 +40,39 @@ if TYPE_CHECKING:
         traceback: str | None
 
 
+# Parsed JSON files by path, along with the (inode, size, mtime) they were parsed at
+json_file_cache: dict[str, tuple[tuple[int, int, int], dict]] = {}
+
+# Files modified more recently than this could change again without their mtime changing
+JSON_FILE_CACHE_MIN_AGE = 2
+
+
+def read_json_file(path: str, cached: bool = True) -> dict:
+    """
+    Returns the parsed JSON file, reusing the last parse until the file changes.
+
+    Cached values are shared between callers and must not be modified,
+    pass `cached=False` to get a copy of your own.
+    """
+    stat = os.stat(path)
+    signature = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    entry = json_file_cache.get(path)
+    if cached and entry and entry[0] == signature:
+        return entry[1]
+
+    with open(path, "r") as f:
+        value = json.load(f)
+
+    if cached and time.time() - stat.st_mtime > JSON_FILE_CACHE_MIN_AGE:
+        json_file_cache[path] = (signature, value)
+    return value
+
+
+def is_valid_directory_name(name: str) -> bool:
+    """Checks that `name` can only refer to an entry directly inside a directory."""
+    return bool(name) and name not in (".", "..") and os.sep not in name
+
+
 def format_size(bytes_val):
     thresholds = [(1024**3, "GB"), (1024**2, "MB"), (1024, "KB")]
 
@@ -70,26 +109,92 @@ def download_file(url, prefix):
     return local_filename
 
 
-def get_size(folder, ignore_dirs=None):
-    """Returns the size of the folder in bytes. Ignores symlinks"""
-    total_size = os.path.getsize(folder)
+def get_size(
+    folder,
+    ignore_dirs=None,
+    cache: DirectorySizeCache | None = None,
+    max_workers: int = 1,
+):
+    """Returns the size of the folder in bytes. Ignores symlinks
+
+    Directories that haven't changed since they were put in `cache` aren't listed again.
+    With `max_workers`, top level subdirectories are walked concurrently.
+    """
+    size, subdirectories = _get_directory_entries_size(folder, ignore_dirs, cache)
+    if max_workers > 1 and len(subdirectories) > 1:
+        results = run_concurrently(lambda path: get_size(path, cache=cache), subdirectories, max_workers)
+        return size + sum(result.unwrap() for result in results)
+    return size + sum(get_size(path, cache=cache) for path in subdirectories)
+
+
+def _get_directory_entries_size(folder, ignore_dirs=None, cache: DirectorySizeCache | None = None):
+    """Returns size of the folder and the files directly in it, along with its subdirectories"""
+    stat = os.stat(folder)
+    key = folder
+    if ignore_dirs:
+        key = "\0".join([folder, *sorted(ignore_dirs)])
+
+    if cache and (entry := cache.get(key, stat.st_mtime_ns)):
+        size, names = entry
+        return size, [os.path.join(folder, name) for name in names]
+
+    size, names = stat.st_size, []
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if (ignore_dirs and entry.name in ignore_dirs) or entry.is_symlink():
+                continue
+            if entry.is_file(follow_symlinks=False):
+                size += entry.stat(follow_symlinks=False).st_size
+            elif entry.is_dir(follow_symlinks=False):
+                names.append(entry.name)
 
-    if ignore_dirs is None:
-        ignore_dirs = []
+    if cache:
+        cache.set(key, stat, size, names)
+    return size, [os.path.join(folder, name) for name in names]
 
-    for item in os.listdir(folder):
-        itempath = os.path.join(folder, item)
 
-        if item in ignore_dirs:
-            continue
+class DirectorySizeCache:
+    """
+    Size of every directory's own entries, persisted between runs in a JSON file.
 
-        if not os.path.islink(itempath):
-            if os.path.isfile(itempath):
-                total_size += os.path.getsize(itempath)
-            elif os.path.isdir(itempath):
-                total_size += get_size(itempath)
+    A directory's mtime only changes when entries are added, removed or renamed,
+    so files rewritten in place are only picked up once the entry expires.
+    """
 
-    return total_size
+    max_age = 24 * 60 * 60
+    # Directories modified more recently than this could change again without their mtime changing
+    min_age = 2
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: dict[str, list] = {}
+        self.used: set[str] = set()
+        with suppress(FileNotFoundError, ValueError), open(self.path) as f:
+            self.entries = json.load(f)
+
+    def get(self, key: str, mtime_ns: int) -> tuple[int, list[str]] | None:
+        entry = self.entries.get(key)
+        if not entry:
+            return None
+
+        cached_mtime_ns, cached_at, size, names = entry
+        if cached_mtime_ns != mtime_ns or time.time() - cached_at > self.max_age:
+            return None
+        self.used.add(key)
+        return size, names
+
+    def set(self, key: str, stat: os.stat_result, size: int, names: list[str]):
+        now = time.time()
+        if now - stat.st_mtime > self.min_age:
+            self.entries[key] = [stat.st_mtime_ns, now, size, names]
+            self.used.add(key)
+
+    def save(self):
+        """Writes entries used in this run, directories that are gone are dropped."""
+        entries = {key: entry for key, entry in self.entries.items() if key in self.used}
+        with open(f"{self.path}.tmp", "w") as f:
+            json.dump(entries, f)
+        os.rename(f"{self.path}.tmp", self.path)
 
 
 def is_registry_healthy(url: str, username: str, password: str) -> bool:
@@ -250,3 +355,42 @@ def get_supervisor_processes_status() -> dict[str, str | dict[str, str]]:
         return dict(nested_status)
     except Exception:
         return {}
+
+
+@dataclass
+class ConcurrentResult:
+    item: Any
+    result: Any = None
+    error: Exception | None = None
+    traceback: str | None = None
+
+    def unwrap(self):
+        """Returns the result, or raises the error the call failed with."""
+        if self.error:
+            raise self.error
+        return self.result
+
+
+def run_concurrently(
+    function: Callable[[Any], Any],
+    items: Iterable,
+    max_workers: int = 4,
+) -> list[ConcurrentResult]:
+    """
+    Calls `function` with every item in a pool of threads.
+
+    Results are returned in the order of `items`. Exceptions don't stop other
+    items, they are captured in the item's result instead.
+    """
+    items = list(items)
+
+    def call(item) -> ConcurrentResult:
+        try:
+            return ConcurrentResult(item, result=function(item))
+        except Exception as e:
+            return ConcurrentResult(item, error=e, traceback=traceback.format_exc())
+
+    if not items:
+        return []
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(items))) as executor:
+        return list(executor.map(call, items))
@@ -4,36 +4,48 @@ import json
 import logging
 import os
 import sys
+import time
 import traceback
-from base64 import b64decode
+import uuid
+from base64 import b64decode, urlsafe_b64decode, urlsafe_b64encode
 from functools import wraps
 from typing import TYPE_CHECKING
 
-from flask import Flask, Response, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context
 from passlib.hash import pbkdf2_sha256 as pbkdf2
+from peewee import prefetch
 from playhouse.shortcuts import model_to_dict
 from redis.exceptions import ConnectionError as RedisConnectionError
 from rq.exceptions import NoSuchJobError
 from rq.job import Job as RQJob
 from rq.job import JobStatus
 
-from agent.base import AgentException
+from agent.base import AgentException, OutputPublisher
 from agent.builder import ImageBuilder, get_image_build_context_directory
 from agent.database import JSONEncoderForSQLQueryResult
 from agent.database_physical_backup import DatabasePhysicalBackup
 from agent.database_physical_restore import DatabasePhysicalRestore
 from agent.database_server import DatabaseServer
 from agent.exceptions import BenchNotExistsException, SiteNotExistsException
+from agent.job import (
+    JOB_CHANGES_KEY,
+    JOB_UPDATES_CHANNEL,
+    JOB_VERSION_KEY,
+    JobModel,
+    StepModel,
+    connection,
+    job_change,
+)
 from agent.job import Job as AgentJob
-from agent.job import JobModel, connection
 from agent.minio import Minio
 from agent.monitor import Monitor
-from agent.nginx_reload_manager import NginxReloadManager
+from agent.nginx_reload_manager import RELOAD_REQUEST_STATUS_FORMAT as NGINX_RELOAD_REQUEST_STATUS_FORMAT
 from agent.nginx_reload_manager import ReloadStatus as NginxReloadStatus
 from agent.proxy import Proxy
 from agent.proxysql import ProxySQL
 from agent.security import Security
 from agent.server import Server
+from agent.site import SITE_INFO_FIELDS
 from agent.snapshot_recovery import SnapshotRecovery
 from agent.ssh import SSHProxy
 from agent.utils import check_installed_pyspy
@@ -91,7 +103,7 @@ log.handlers = []
 
 @application.before_request
 def validate_access_token():
-    exempt_endpoints = ["get_metrics"]
+    exempt_endpoints = ["get_metrics", "get_proxy_metrics"]
     if request.endpoint in exempt_endpoints:
         return None
 
@@ -168,9 +180,9 @@ def ping():
 @application.route("/process-snapshot/<string:bench_name>")
 def get_snapshots(bench_name: str):
     server = Server()
-    bench = server.benches.get(bench_name)
-
-    if not bench:
+    try:
+        bench = server.get_bench(bench_name)
+    except BenchNotExistsException:
         return {"message": f"No such bench {bench_name}"}, 400
 
     if not check_installed_pyspy(server.directory):
@@ -264,6 +276,14 @@ def reload_nginx():
     return {"job": job}
 
 
+@application.route("/proxy/metrics")
+def get_proxy_metrics():
+    from agent.exporter import get_nginx_reload_metrics
+    from agent.nginx_reload_manager import NginxReloadManager
+
+    return Response(get_nginx_reload_metrics(NginxReloadManager()), mimetype="text/plain")
+
+
 @application.route("/server/status", methods=["POST"])
 def get_server_status():
     data = request.json
@@ -277,6 +297,12 @@ def cleanup_unused_files():
     return {"job": job}
 
 
+@application.route("/server/prune-jobs", methods=["POST"])
+def prune_jobs():
+    job = Server().prune_jobs()
+    return {"job": job}
+
+
 @application.route("/server/storage-breakdown", methods=["GET"])
 def get_storage_breakdown():
     output = Server().get_storage_breakdown()
@@ -368,77 +394,123 @@ def get_metrics():
 @application.route("/benches/<string:bench>")
 @validate_bench
 def get_bench(bench):
-    return Server().benches[bench].dump()
+    return Server().get_bench(bench).dump()
 
 
 @application.route("/benches/<string:bench>/info", methods=["POST", "GET"])
 @validate_bench
 def fetch_sites_info(bench):
-    data = request.json
-    since = data.get("since") if data else None
-    return Server().benches[bench].fetch_sites_info(since=since)
+    """
+    Streams info of every site on the bench as one JSON object, keyed by site name.
+
+    Sites are encoded as they are computed, instead of building the whole response
+    in memory first. `fields` limits the info to some of config, usage and timezone.
+    """
+    data = request.get_json(silent=True) or {}
+    since = data.get("since")
+    try:
+        fields = get_site_info_fields(data)
+    except ValueError as e:
+        return {"message": str(e)}, 400
+
+    sites_info = Server().get_bench(bench).iter_sites_info(since=since, fields=fields)
+    return Response(stream_with_context(stream_json_object(sites_info)), mimetype="application/json")
+
+
+def get_site_info_fields(data: dict | None = None) -> tuple[str, ...] | None:
+    fields = (data or {}).get("fields") or request.args.get("fields")
+    if not fields:
+        return None
+
+    if isinstance(fields, str):
+        fields = fields.split(",")
+    fields = tuple(field.strip() for field in fields)
+    unknown = set(fields) - set(SITE_INFO_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown fields {', '.join(sorted(unknown))}")
+    return fields
+
+
+def stream_json_object(items):
+    """
+    Encodes (key, value) pairs as a JSON object, one pair at a time.
+
+    The response has already started when `items` fails, so the failure is
+    logged and sent as the object's last key, "error", instead of a 500.
+    """
+    yield "{"
+    separator = ""
+    try:
+        for key, value in items:
+            yield f"{separator}{json.dumps(key)}:{json.dumps(value, default=str)}"
+            separator = ","
+    except Exception:
+        log.exception("Failed to stream JSON object")
+        error = "".join(traceback.format_exception(*sys.exc_info())).splitlines()
+        yield f'{separator}"error":{json.dumps(error)}'
+    yield "}"
 
 
 @application.route("/benches/<string:bench>/analytics", methods=["GET"])
 @validate_bench
 def fetch_sites_analytics(bench):
-    return Server().benches[bench].fetch_sites_analytics()
+    return Server().get_bench(bench).fetch_sites_analytics()
 
 
 @application.route("/benches/<string:bench>/sites")
 @validate_bench
 def get_sites(bench):
-    sites = Server().benches[bench].sites
+    sites = Server().get_bench(bench).sites
     return {name: site.dump() for name, site in sites.items()}
 
 
 @application.route("/benches/<string:bench>/apps")
 @validate_bench
 def get_bench_apps(bench):
-    apps = Server().benches[bench].apps
+    apps = Server().get_bench(bench).apps
     return {name: site.dump() for name, site in apps.items()}
 
 
 @application.route("/benches/<string:bench>/config")
 @validate_bench
 def get_config(bench):
-    return Server().benches[bench].config
+    return Server().get_bench(bench).config
 
 
 @application.route("/benches/<string:bench>/status", methods=["GET"])
 @validate_bench
 def get_bench_status(bench):
-    return Server().benches[bench].status()
+    return Server().get_bench(bench).status()
 
 
 @application.route("/benches/<string:bench>/logs")
 @validate_bench
 def get_bench_logs(bench):
-    return jsonify(Server().benches[bench].logs)
+    return jsonify(Server().get_bench(bench).logs)
 
 
 @application.route("/benches/<string:bench>/logs/<string:log>")
 @validate_bench
 def get_bench_log(bench, log):
-    return {log: Server().benches[bench].retrieve_log(log)}
+    return {log: Server().get_bench(bench).retrieve_log(log)}
 
 
 @application.route("/benches/<string:bench>/sites/<string:site>")
 @validate_bench
 def get_site(bench, site):
-    return Server().benches[bench].sites[site].dump()
+    return Server().get_bench(bench).get_site(site).dump()
 
 
 @application.route("/benches/<string:bench>/sites/<string:site>/logs")
 @validate_bench_and_site
 def get_logs(bench, site):
-    return jsonify(Server().benches[bench].sites[site].logs)
+    return jsonify(Server().get_bench(bench).get_site(site).logs)
 
 
 @application.route("/benches/<string:bench>/sites/<string:site>/logs/<string:log>")
 @validate_bench_and_site
 def get_log(bench, site, log):
-    return {log: Server().benches[bench].sites[site].retrieve_log(log)}
+    return {log: Server().get_bench(bench).get_site(site).retrieve_log(log)}
 
 
 @application.route("/security/ssh_session_logs")
@@ -456,7 +528,7 @@ def retrieve_ssh_session_log(filename):
 def get_site_sid(bench, site):
     data = request.json or {}
     user = data.get("user") or "Administrator"
-    return {"sid": Server().benches[bench].sites[site].sid(user=user)}
+    return {"sid": Server().get_bench(bench).get_site(site).sid(user=user)}
 
 
 @application.route("/benches", methods=["POST"])
@@ -476,20 +548,20 @@ def archive_bench(bench):
 @validate_bench
 def restart_bench(bench):
     data = request.json
-    job = Server().benches[bench].restart_job(**data)
+    job = Server().get_bench(bench).restart_job(**data)
     return {"job": job}
 
 
 @application.route("/benches/<string:bench>/limits", methods=["POST"])
 def update_bench_limits(bench):
     data = request.json
-    job = Server().benches[bench].force_update_limits(**data)
+    job = Server().get_bench(bench).force_update_limits(**data)
     return {"job": job}
 
 
 @application.route("/benches/<string:bench>/rebuild", methods=["POST"])
 def rebuild_bench(bench):
-    job = Server().benches[bench].rebuild_job()
+    job = Server().get_bench(bench).rebuild_job()
     return {"job": job}
 
 
@@ -514,7 +586,7 @@ def new_site(bench):
     data = request.json
     job = (
         Server()
-        .benches[bench]
+        .get_bench(bench)
         .new_site(
             data["name"],
             data["config"],
@@ -534,7 +606,7 @@ def new_site_from_backup(bench):
 
     job = (
         Server()
-        .benches[bench]
+        .get_bench(bench)
         .new_site_from_backup(
             data["name"],
             data["config"],
@@ -558,8 +630,8 @@ def restore_site(bench, site):
 
     job = (
         Server()
-        .benches[bench]
-        .sites[site]
+        .get_bench(bench)
+        .get_site(site)
         .restore_job(
             data["apps"],
             data["mariadb_root_password"],
@@ -579,8 +651,8 @@ def reinstall_site(bench, site):
     data = request.json
     job = (
         Server()
-        .benches[bench]
-        .sites[site]
+        .get_bench(bench)
+        .get_site(site)
         .reinstall_job(data["mariadb_root_password"], data["admin_password"])
     )
     return {"job": job}
@@ -592,7 +664,7 @@ def rename_site(bench, site):
     data = request.json
     job = (
         Server()
-        .benches[bench]
+        .get_bench(bench)
         .rename_site_job(site, data["new_name"], data.get("create_user"), data.get("config"))
     )
     return {"job": job}
@@ -608,7 +680,7 @@ def create_user(bench, site):
     password = data.get("password")
     job = (
         Server()
-        .benches[bench]
+        .get_bench(bench)
         .create_user(
             site,
             email=email,
@@ -627,13 +699,13 @@ def create_user(bench, site):
 @validate_bench_and_site
 def complete_setup_wizard(bench, site):
     data = request.json
-    job = Server().benches[bench].complete_setup_wizard(site, data)
+    job = Server().get_bench(bench).complete_setup_wizard(site, data)
     return {"job": job}
 
 
 @application.route("/benches/<string:bench>/sites/<string:site>/optimize", methods=["POST"])
 def optimize_tables(bench, site):
-    job = Server().benches[bench].sites[site].optimize_tables_job()
+    job = Server().get_bench(bench).get_site(site).optimize_tables_job()
     return {"job": job}
 
 
@@ -641,7 +713,7 @@ def optimize_tables(bench, site):
 @validate_bench_and_site
 def install_app_site(bench, site):
     data = request.json
-    job = Server().benches[bench].sites[site].install_app_job(data["name"])
+    job = Server().get_bench(bench).get_site(site).install_app_job(data["name"])
     return {"job": job}
 
 
@@ -651,7 +723,7 @@ def install_app_site(bench, site):
 )
 @validate_bench_and_site
 def uninstall_app_site(bench, site, app):
-    job = Server().benches[bench].sites[site].uninstall_app_job(app)
+    job = Server().get_bench(bench).get_site(site).uninstall_app_job(app)
     return {"job": job}
 
 
@@ -659,32 +731,36 @@ def uninstall_app_site(bench, site, app):
 @validate_bench_and_site
 def setup_erpnext(bench, site):
     data = request.json
-    job = Server().benches[bench].sites[site].setup_erpnext(data["user"], data["config"])
+    job = Server().get_bench(bench).get_site(site).setup_erpnext(data["user"], data["config"])
     return {"job": job}
 
 
 @application.route("/benches/<string:bench>/monitor", methods=["POST"])
 @validate_bench
 def fetch_monitor_data(bench):
-    return {"data": Server().benches[bench].fetch_monitor_data()}
+    return {"data": Server().get_bench(bench).fetch_monitor_data()}
 
 
 @application.route("/benches/<string:bench>/sites/<string:site>/status", methods=["GET"])
 @validate_bench_and_site
 def fetch_site_status(bench, site):
-    return {"data": Server().benches[bench].sites[site].fetch_site_status()}
+    return {"data": Server().get_bench(bench).get_site(site).fetch_site_status()}
 
 
 @application.route("/benches/<string:bench>/sites/<string:site>/info", methods=["GET"])
 @validate_bench_and_site
 def fetch_site_info(bench, site):
-    return {"data": Server().benches[bench].sites[site].fetch_site_info()}
+    try:
+        fields = get_site_info_fields()
+    except ValueError as e:
+        return {"message": str(e)}, 400
+    return {"data": Server().get_bench(bench).get_site(site).fetch_site_info(fields=fields)}
 
 
 @application.route("/benches/<string:bench>/sites/<string:site>/analytics", methods=["GET"])
 @validate_bench_and_site
 def fetch_site_analytics(bench, site):
-    return {"data": Server().benches[bench].sites[site].fetch_site_analytics()}
+    return {"data": Server().get_bench(bench).get_site(site).fetch_site_analytics()}
 
 
 @application.route("/benches/<string:bench>/sites/<string:site>/backup", methods=["POST"])
@@ -697,8 +773,8 @@ def backup_site(bench, site):
 
     job = (
         Server()
-        .benches[bench]
-        .sites[site]
+        .get_bench(bench)
+        .get_site(site)
         .backup_job(with_files, offsite, keep_files_locally_after_offsite_backup)
     )
     return {"job": job}
@@ -715,8 +791,8 @@ def fetch_database_table_schema(bench, site):
     include_index_info = data.get("include_index_info", False)
     job = (
         Server()
-        .benches[bench]
-        .sites[site]
+        .get_bench(bench)
+        .get_site(site)
         .fetch_database_table_schema(
             include_table_size=include_table_size,
             include_index_info=include_index_info,
@@ -736,7 +812,7 @@ def run_sql(bench, site):
     as_dict = request.json.get("as_dict") or False
     return Response(
         json.dumps(
-            Server().benches[bench].sites[site].run_sql_query(query, commit, as_dict),
+            Server().get_bench(bench).get_site(site).run_sql_query(query, commit, as_dict),
             cls=JSONEncoderForSQLQueryResult,
         ),
         mimetype="application/json",
@@ -751,7 +827,7 @@ def analyze_slow_queries(bench: str, site: str):
     queries = request.json["queries"]
     mariadb_root_password = request.json["mariadb_root_password"]
 
-    job = Server().benches[bench].sites[site].analyze_slow_queries_job(queries, mariadb_root_password)
+    job = Server().get_bench(bench).get_site(site).analyze_slow_queries_job(queries, mariadb_root_password)
     return {"job": job}
 
 
@@ -762,8 +838,8 @@ def database_performance_report(bench, site):
     data = request.json
     result = (
         Server()
-        .benches[bench]
-        .sites[site]
+        .get_bench(bench)
+        .get_site(site)
         .fetch_summarized_database_performance_report(data["mariadb_root_password"])
     )
     return jsonify(json.loads(json.dumps(result, cls=JSONEncoderForSQLQueryResult)))
@@ -773,7 +849,7 @@ def database_performance_report(bench, site):
 def database_process_list(bench, site):
     data = request.json
     return jsonify(
-        Server().benches[bench].sites[site].fetch_database_process_list(data["mariadb_root_password"])
+        Server().get_bench(bench).get_site(site).fetch_database_process_list(data["mariadb_root_password"])
     )
 
 
@@ -782,7 +858,7 @@ def database_process_list(bench, site):
 )
 def database_kill_process(bench, site, pid):
     data = request.json
-    Server().benches[bench].sites[site].kill_database_process(pid, data["mariadb_root_password"])
+    Server().get_bench(bench).get_site(site).kill_database_process(pid, data["mariadb_root_password"])
     return {}
 
 
@@ -792,8 +868,8 @@ def create_database_user(bench, site):
     data = request.json
     job = (
         Server()
-        .benches[bench]
-        .sites[site]
+        .get_bench(bench)
+        .get_site(site)
         .create_database_user_job(data["username"], data["password"], data["mariadb_root_password"])
     )
     return {"job": job}
@@ -806,7 +882,8 @@ def create_database_user(bench, site):
 @validate_bench_and_site
 def remove_database_user(bench, site, db_user):
     data = request.json
-    job = Server().benches[bench].sites[site].remove_database_user_job(db_user, data["mariadb_root_password"])
+    site = Server().get_bench(bench).get_site(site)
+    job = site.remove_database_user_job(db_user, data["mariadb_root_password"])
     return {"job": job}
 
 
@@ -819,8 +896,8 @@ def update_database_permissions(bench, site, db_user):
     data = request.json
     job = (
         Server()
-        .benches[bench]
-        .sites[site]
+        .get_bench(bench)
+        .get_site(site)
         .modify_database_user_permissions_job(
             db_user,
             data["mode"],
@@ -840,8 +917,8 @@ def migrate_site(bench, site):
     data = request.json
     job = (
         Server()
-        .benches[bench]
-        .sites[site]
+        .get_bench(bench)
+        .get_site(site)
         .migrate_job(
             skip_failing_patches=data.get("skip_failing_patches", False),
             activate=data.get("activate", True),
@@ -856,7 +933,7 @@ def migrate_site(bench, site):
 )
 @validate_bench_and_site
 def clear_site_cache(bench, site):
-    job = Server().benches[bench].sites[site].clear_cache_job()
+    job = Server().get_bench(bench).get_site(site).clear_cache_job()
     return {"job": job}
 
 
@@ -932,7 +1009,7 @@ def update_site_recover_migrate(bench, site):
 @validate_bench_and_site
 def restore_site_tables(bench, site):
     data = request.json
-    job = Server().benches[bench].sites[site].restore_site_tables_job(data.get("activate", True))
+    job = Server().get_bench(bench).get_site(site).restore_site_tables_job(data.get("activate", True))
     return {"job": job}
 
 
@@ -961,7 +1038,7 @@ def update_site_recover(bench, site):
 @validate_bench
 def archive_site(bench, site):
     data = request.json
-    job = Server().benches[bench].archive_site(site, data["mariadb_root_password"], data.get("force"))
+    job = Server().get_bench(bench).archive_site(site, data["mariadb_root_password"], data.get("force"))
     return {"job": job}
 
 
@@ -969,14 +1046,14 @@ def archive_site(bench, site):
 @validate_bench_and_site
 def site_update_config(bench, site):
     data = request.json
-    job = Server().benches[bench].sites[site].update_config_job(data["config"], data["remove"])
+    job = Server().get_bench(bench).get_site(site).update_config_job(data["config"], data["remove"])
     return {"job": job}
 
 
 @application.route("/benches/<string:bench>/sites/<string:site>/usage", methods=["DELETE"])
 @validate_bench_and_site
 def reset_site_usage(bench, site):
-    job = Server().benches[bench].sites[site].reset_site_usage_job()
+    job = Server().get_bench(bench).get_site(site).reset_site_usage_job()
     return {"job": job}
 
 
@@ -984,7 +1061,7 @@ def reset_site_usage(bench, site):
 @validate_bench_and_site
 def site_add_domain(bench, site):
     data = request.json
-    job = Server().benches[bench].sites[site].add_domain(data["domain"])
+    job = Server().get_bench(bench).get_site(site).add_domain(data["domain"])
     return {"job": job}
 
 
@@ -994,7 +1071,7 @@ def site_add_domain(bench, site):
 )
 @validate_bench_and_site
 def site_remove_domain(bench, site, domain):
-    job = Server().benches[bench].sites[site].remove_domain(domain)
+    job = Server().get_bench(bench).get_site(site).remove_domain(domain)
     return {"job": job}
 
 
@@ -1007,8 +1084,8 @@ def describe_database_table(bench, site):
     data = request.json
     return {
         "data": Server()
-        .benches[bench]
-        .sites[site]
+        .get_bench(bench)
+        .get_site(site)
         .describe_database_table(data["doctype"], data.get("columns"))
     }
 
@@ -1020,7 +1097,7 @@ def describe_database_table(bench, site):
 @validate_bench_and_site
 def add_database_index(bench, site):
     data = request.json
-    job = Server().benches[bench].sites[site].add_database_index(data["doctype"], data.get("columns"))
+    job = Server().get_bench(bench).get_site(site).add_database_index(data["doctype"], data.get("columns"))
     return {"job": job}
 
 
@@ -1032,8 +1109,8 @@ def add_database_index(bench, site):
 def get_site_apps(bench, site):
     format = request.args.get("format")
     if format == "json":
-        return {"data": Server().benches[bench].sites[site].apps_as_json}
-    return {"data": Server().benches[bench].sites[site].apps}
+        return {"data": Server().get_bench(bench).get_site(site).apps_as_json}
+    return {"data": Server().get_bench(bench).get_site(site).apps}
 
 
 @application.route(
@@ -1045,8 +1122,8 @@ def site_create_database_access_credentials(bench, site):
     data = request.json
     return (
         Server()
-        .benches[bench]
-        .sites[site]
+        .get_bench(bench)
+        .get_site(site)
         .create_database_access_credentials(data["mode"], data["mariadb_root_password"])
     )
 
@@ -1060,8 +1137,8 @@ def site_revoke_database_access_credentials(bench, site):
     data = request.json
     return (
         Server()
-        .benches[bench]
-        .sites[site]
+        .get_bench(bench)
+        .get_site(site)
         .revoke_database_access_credentials(data["user"], data["mariadb_root_password"])
     )
 
@@ -1070,7 +1147,7 @@ def site_revoke_database_access_credentials(bench, site):
 @validate_bench
 def bench_set_config(bench):
     data = request.json
-    job = Server().benches[bench].update_config_job(**data)
+    job = Server().get_bench(bench).update_config_job(**data)
     return {"job": job}
 
 
@@ -1440,17 +1517,19 @@ def proxysql_remove_user(username):
     return {"job": job}
 
 
+RQ_STATUS_MAP = {
+    JobStatus.QUEUED: "Pending",
+    JobStatus.FINISHED: "Success",
+    JobStatus.FAILED: "Failure",
+    JobStatus.STARTED: "Running",
+    JobStatus.DEFERRED: "Pending",
+    JobStatus.SCHEDULED: "Pending",
+    JobStatus.STOPPED: "Failure",
+    JobStatus.CANCELED: "Failure",
+}
+
+
 def get_status_from_rq(job, redis):
-    RQ_STATUS_MAP = {
-        JobStatus.QUEUED: "Pending",
-        JobStatus.FINISHED: "Success",
-        JobStatus.FAILED: "Failure",
-        JobStatus.STARTED: "Running",
-        JobStatus.DEFERRED: "Pending",
-        JobStatus.SCHEDULED: "Pending",
-        JobStatus.STOPPED: "Failure",
-        JobStatus.CANCELED: "Failure",
-    }
     status = None
     try:
         rq_status = RQJob.fetch(str(job["id"]), connection=redis).get_status()
@@ -1461,59 +1540,185 @@ def get_status_from_rq(job, redis):
     return status
 
 
-def to_dict(model):  # noqa: C901
-    redis = connection()
-    nginx_reload_manager = NginxReloadManager()
+def to_dict(model):
     if isinstance(model, JobModel):
-        job = model_to_dict(model, backrefs=True)
-        status_from_rq = get_status_from_rq(job, redis)
-        nginx_reload_status: NginxReloadStatus = None
-        job_status_depends_on_async_nginx_reload = False
-        if status_from_rq:
-            # Override status from JobModel if rq says the job is already ended
-            TERMINAL_STATUSES = ["Success", "Failure"]
-            if job["status"] not in TERMINAL_STATUSES and status_from_rq in TERMINAL_STATUSES:
-                job["status"] = status_from_rq
+        return jobs_to_dict([model])[0]
+    return list(map(model_to_dict, model))
 
-        job["data"] = json.loads(job["data"]) or {}
+
+def select_jobs(condition, data: bool = False) -> list[JobModel]:
+    """
+    Jobs matching `condition`, with their steps prefetched.
+
+    Job and step data is decompressed when read, so it's only selected if `data` is set.
+    """
+    jobs = JobModel.select(*_job_fields(JobModel, data))
+    steps = StepModel.select(*_job_fields(StepModel, data))
+    return prefetch(jobs.where(condition), steps)
+
+
+def _job_fields(model, data: bool) -> list:
+    # Compared by name, fields compared with `==` build an expression instead
+    return [field for field in model._meta.sorted_fields if data or field.name != "data"]
+
+
+def get_job(condition, data: bool = False) -> JobModel:
+    jobs = select_jobs(condition, data)
+    if not jobs:
+        raise JobModel.DoesNotExist
+    return jobs[0]
+
+
+def jobs_to_dict(models, output_offset: int | None = None, data: bool = True) -> list[dict]:
+    """
+    Serialize jobs along with their steps and commands.
+
+    Pass `select_jobs` to avoid a query per job, with the same `data` it was called with.
+    Everything we need from redis (RQ status, job and step commands and the
+    NGINX reload status) is fetched in a single pipelined round trip,
+    command output logs are fetched in one more.
+
+    If `output_offset` is set, only output logged after that many bytes is
+    returned for every command, see `_update_command_outputs`.
+    """
+    exclude = [] if data else [JobModel.data, StepModel.data]
+    jobs = [model_to_dict(model, backrefs=True, exclude=exclude) for model in models]
+    if not jobs:
+        return jobs
+
+    redis = connection()
+    pipeline = redis.pipeline(transaction=False)
+    for job in jobs:
+        _queue_job_lookups(pipeline, job)
+
+    results = iter(pipeline.execute())
+    for job in jobs:
+        _update_job_from_lookups(job, results)
+
+    _update_command_outputs(redis, jobs, output_offset)
+    return jobs
+
+
+def _commands_with_output_log(jobs):
+    for job in jobs:
         job_key = f"agent:job:{job['id']}"
-        job["commands"] = [json.loads(command) for command in redis.lrange(job_key, 0, -1)]
+        for command in job["commands"]:
+            if command.get("output_log"):
+                yield OutputPublisher.output_key(job_key, command["output_log"]), command
         for step in job["steps"]:
-            step["data"] = json.loads(step["data"]) or {}
             step_key = f"{job_key}:step:{step['id']}"
-            step["commands"] = [
-                json.loads(command)
-                for command in redis.lrange(
-                    step_key,
-                    0,
-                    -1,
-                )
-            ]
-            if job["status"] == "Success" and step["name"] == "Reload NGINX" and step["status"] == "Success":
-                # If the `RQ Job` or `RQ Step` has been failed during queuing or at any part
-                # There we dont need to lookup the status of the NGINX reload from redis
-                if not nginx_reload_status:
-                    nginx_reload_status = nginx_reload_manager.get_status(
-                        job["agent_job_id"],
-                        not_found_status=NginxReloadStatus.Success,
-                        # If the job doesn't exist in redis, we assume it was successful
-                    )
-                job_status_depends_on_async_nginx_reload = True
-                if nginx_reload_status in [NginxReloadStatus.Success, NginxReloadStatus.Failure]:
-                    step["status"] = nginx_reload_status.value
-                else:
-                    step["status"] = "Running"
-
-        if job_status_depends_on_async_nginx_reload:
-            # If status is Queued, mark as Running
-            if nginx_reload_status == NginxReloadStatus.Queued:
-                job["status"] = "Running"
-            # If reload has failed, mark it as failure
-            elif nginx_reload_status == NginxReloadStatus.Failure:
-                job["status"] = "Failure"
-    else:
-        job = list(map(model_to_dict, model))
-    return job
+            for command in step["commands"]:
+                if command.get("output_log"):
+                    yield OutputPublisher.output_key(step_key, command["output_log"]), command
+
+
+def _update_command_outputs(
+    redis,
+    jobs,
+    output_offset: int | None = None,
+    output_offsets: dict[str, int] | None = None,
+) -> dict[str, int]:
+    """
+    Fill in output of commands published as an output log.
+
+    `output_length` is the size of the log in bytes. If `output_offset` is set,
+    `output` has the log from that byte onwards, every line terminated by a newline,
+    and `output_pending` has the line still being written. `output_offsets` does the
+    same with a separate offset for every output key.
+
+    Returns size of every log read, by output key.
+    """
+    commands = list(_commands_with_output_log(jobs))
+    if not commands:
+        return {}
+
+    pipeline = redis.pipeline(transaction=False)
+    offsets = []
+    for output_key, _ in commands:
+        if output_offsets is not None:
+            offsets.append(output_offsets.get(output_key, 0))
+        else:
+            offsets.append(output_offset or 0)
+        pipeline.getrange(output_key, offsets[-1], -1)
+
+    lengths = {}
+    for (output_key, command), offset, log in zip(commands, offsets, pipeline.execute()):
+        # From the bytes read, an append made since can't move the offset past them
+        command["output_length"] = lengths[output_key] = offset + len(log)
+        log = log.decode(errors="replace")
+        del command["output_log"]
+        if output_offset is None and output_offsets is None:
+            command["output"] = OutputPublisher.assemble_output(log, command.pop("output_pending", ""))
+        else:
+            command["output"] = log
+    return lengths
+
+
+def _job_depends_on_nginx_reload(job) -> bool:
+    return any(step["name"] == "Reload NGINX" for step in job["steps"])
+
+
+def _queue_job_lookups(pipeline, job):
+    # Order of commands here should match the order of results consumed in `_update_job_from_lookups`
+    job_key = f"agent:job:{job['id']}"
+    pipeline.hget(RQJob.key_for(str(job["id"])), "status")
+    pipeline.lrange(job_key, 0, -1)
+    for step in job["steps"]:
+        pipeline.lrange(f"{job_key}:step:{step['id']}", 0, -1)
+    if _job_depends_on_nginx_reload(job):
+        pipeline.get(NGINX_RELOAD_REQUEST_STATUS_FORMAT.format(job["agent_job_id"]))
+
+
+def _update_job_from_lookups(job, results):
+    rq_status = next(results)
+    status_from_rq = RQ_STATUS_MAP.get(rq_status.decode()) if rq_status else None
+    if status_from_rq:
+        # Override status from JobModel if rq says the job is already ended
+        TERMINAL_STATUSES = ["Success", "Failure"]
+        if job["status"] not in TERMINAL_STATUSES and status_from_rq in TERMINAL_STATUSES:
+            job["status"] = status_from_rq
+
+    if "data" in job:
+        job["data"] = json.loads(job["data"]) or {}
+    job["commands"] = [json.loads(command) for command in next(results)]
+    for step in job["steps"]:
+        if "data" in step:
+            step["data"] = json.loads(step["data"]) or {}
+        step["commands"] = [json.loads(command) for command in next(results)]
+
+    if _job_depends_on_nginx_reload(job):
+        nginx_reload_status = next(results)
+        # If the job doesn't exist in redis, we assume it was successful
+        nginx_reload_status = (
+            NginxReloadStatus(nginx_reload_status.decode())
+            if nginx_reload_status
+            else NginxReloadStatus.Success
+        )
+        _update_job_from_nginx_reload_status(job, nginx_reload_status)
+
+
+def _update_job_from_nginx_reload_status(job, nginx_reload_status: NginxReloadStatus):
+    # If the `RQ Job` or `RQ Step` has been failed during queuing or at any part
+    # There we dont need to lookup the status of the NGINX reload from redis
+    if job["status"] != "Success":
+        return
+
+    job_status_depends_on_async_nginx_reload = False
+    for step in job["steps"]:
+        if step["name"] == "Reload NGINX" and step["status"] == "Success":
+            job_status_depends_on_async_nginx_reload = True
+            if nginx_reload_status in [NginxReloadStatus.Success, NginxReloadStatus.Failure]:
+                step["status"] = nginx_reload_status.value
+            else:
+                step["status"] = "Running"
+
+    if job_status_depends_on_async_nginx_reload:
+        # If status is Queued, mark as Running
+        if nginx_reload_status == NginxReloadStatus.Queued:
+            job["status"] = "Running"
+        # If reload has failed, mark it as failure
+        elif nginx_reload_status == NginxReloadStatus.Failure:
+            job["status"] = "Failure"
 
 
 @application.route("/jobs")
@@ -1522,11 +1727,14 @@ def to_dict(model):  # noqa: C901
 @application.route("/jobs/status/<string:status>")
 def jobs(id=None, ids=None, status=None):
     choices = [x[1] for x in JobModel._meta.fields["status"].choices]
+    output_offset = request.args.get("offset", type=int)
+    # Job and step data can be large, it's only sent with ?data=1
+    with_data = bool(request.args.get("data", 0, type=int))
     if id:
-        data = to_dict(JobModel.get(JobModel.id == id))
+        data = jobs_to_dict([get_job(JobModel.id == id, with_data)], output_offset, with_data)[0]
     elif ids:
         ids = ids.split(",")
-        data = list(map(to_dict, JobModel.select().where(JobModel.id << ids)))
+        data = jobs_to_dict(select_jobs(JobModel.id << ids, with_data), output_offset, with_data)
     elif status in choices:
         data = to_dict(JobModel.select(JobModel.id, JobModel.name).where(JobModel.status == status))
     else:
@@ -1535,6 +1743,197 @@ def jobs(id=None, ids=None, status=None):
     return jsonify(json.loads(json.dumps(data, default=str)))
 
 
+@application.route("/jobs/<int:id>/updates")
+def job_updates(id):
+    try:
+        cursor = decode_job_cursor(request.args.get("cursor"))
+    except ValueError:
+        return {"message": "Invalid cursor"}, 400
+
+    data = job_updates_to_dict(id, *cursor)
+    return jsonify(json.loads(json.dumps(data, default=str)))
+
+
+JOB_STREAM_KEEPALIVE_INTERVAL = 10
+# Well under gunicorn's 30 second timeout for sync workers, which are held for the whole stream
+JOB_STREAM_MAX_DURATION = 20
+# Open streams by their deadline, shared by all workers to cap how many they hold
+JOB_STREAMS_KEY = "agent:job_streams"
+
+
+@application.route("/jobs/<int:id>/stream")
+def job_stream(id):
+    """
+    Streams changes to the job as server-sent events.
+
+    Every event has the same data as /jobs/<id>/updates, and the cursor as its id.
+    Sync workers are held for the whole stream, so it ends once the job is done or
+    after `timeout` seconds, at most JOB_STREAM_MAX_DURATION; clients reconnect with
+    the Last-Event-ID header to resume from where they left off.
+
+    Only `max_job_streams` (config.json, half the gunicorn workers by default)
+    streams are open at once, so the rest of the workers keep serving the API.
+    Other requests get a 429, clients fall back to polling /jobs/<id>/updates.
+    """
+    try:
+        cursor = decode_job_cursor(request.headers.get("Last-Event-ID") or request.args.get("cursor"))
+    except ValueError:
+        return {"message": "Invalid cursor"}, 400
+
+    JobModel.get(JobModel.id == id)
+    timeout = min(request.args.get("timeout", JOB_STREAM_MAX_DURATION, type=int), JOB_STREAM_MAX_DURATION)
+    if not (stream := open_job_stream(timeout)):
+        return {"message": "Too many open job streams"}, 429, {"Retry-After": str(JOB_STREAM_MAX_DURATION)}
+    return Response(
+        stream_with_context(stream_job_updates(id, *cursor, timeout=timeout, stream=stream)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def open_job_stream(timeout: int) -> str | None:
+    """Counts a stream as open until it's closed or its deadline, returns None if too many are open"""
+    config = Server().config
+    max_streams = config.get("max_job_streams", max(config.get("gunicorn_workers", 2) // 2, 1))
+    stream, now = uuid.uuid4().hex, time.time()
+
+    redis = connection()
+    pipeline = redis.pipeline()
+    # Streams of workers killed mid-stream are dropped once their deadline passes
+    pipeline.zremrangebyscore(JOB_STREAMS_KEY, "-inf", now)
+    pipeline.zadd(JOB_STREAMS_KEY, {stream: now + timeout + JOB_STREAM_KEEPALIVE_INTERVAL})
+    pipeline.zcard(JOB_STREAMS_KEY)
+    *_, open_streams = pipeline.execute()
+    if open_streams > max_streams:
+        redis.zrem(JOB_STREAMS_KEY, stream)
+        return None
+    return stream
+
+
+def stream_job_updates(
+    id: int, version: int, offsets: dict[str, int], timeout: int, stream: str | None = None
+):
+    pubsub = connection().pubsub(ignore_subscribe_messages=True)
+    # Subscribe before reading the job so changes made in between aren't missed
+    pubsub.subscribe(JOB_UPDATES_CHANNEL.format(id))
+    try:
+        deadline = time.monotonic() + timeout
+        updates = job_updates_to_dict(id, version, offsets)
+        yield format_server_sent_event(updates)
+        while updates["job"]["status"] not in ("Success", "Failure"):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+
+            # NGINX reloads aren't published, poll for them instead
+            if pubsub.get_message(timeout=min(remaining, JOB_STREAM_KEEPALIVE_INTERVAL)):
+                # Coalesce changes published in a burst into a single event
+                while pubsub.get_message(timeout=0):
+                    pass
+            elif not _job_depends_on_nginx_reload(updates["job"]):
+                yield ": keepalive\n\n"
+                continue
+
+            previous = updates
+            updates = job_updates_to_dict(id, *decode_job_cursor(updates["cursor"]))
+            changed = updates["cursor"] != previous["cursor"]
+            if changed or _get_nginx_reload_state(updates["job"]) != _get_nginx_reload_state(previous["job"]):
+                yield format_server_sent_event(updates)
+            else:
+                yield ": keepalive\n\n"
+    finally:
+        pubsub.close()
+        if stream:
+            connection().zrem(JOB_STREAMS_KEY, stream)
+
+
+def _get_nginx_reload_state(job) -> list:
+    """Status of the job and its "Reload NGINX" steps, which change without the job's version"""
+    steps = [(step["id"], step["status"]) for step in job["steps"] if step["name"] == "Reload NGINX"]
+    return [job["status"], *steps]
+
+
+def format_server_sent_event(updates: dict) -> str:
+    data = json.dumps(updates, default=str)
+    return f"id: {updates['cursor']}\nevent: update\ndata: {data}\n\n"
+
+
+def encode_job_cursor(version: int, offsets: dict[str, int]) -> str:
+    cursor = json.dumps({"version": version, "offsets": offsets}, separators=(",", ":"))
+    return urlsafe_b64encode(cursor.encode()).decode()
+
+
+def decode_job_cursor(cursor: str | None) -> tuple[int, dict[str, int]]:
+    if not cursor:
+        return 0, {}
+
+    try:
+        cursor = json.loads(urlsafe_b64decode(cursor.encode()))
+        return int(cursor["version"]), dict(cursor["offsets"])
+    except Exception as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def job_updates_to_dict(id: int, version: int = 0, offsets: dict[str, int] | None = None) -> dict:
+    """
+    Returns changes to the job since `version`, along with a cursor for the next call.
+
+    The job itself is always returned, its data and commands only if they changed.
+    Steps are returned only if they changed, their commands only have the output
+    logged since the last call. "Reload NGINX" steps are always returned, their
+    status depends on the NGINX reload manager and not on the job's version.
+    """
+    redis = connection()
+    pipeline = redis.pipeline(transaction=False)
+    pipeline.get(JOB_VERSION_KEY.format(id))
+    pipeline.zrange(JOB_CHANGES_KEY.format(id), 0, -1, withscores=True)
+    current_version, changes = pipeline.execute()
+    current_version = int(current_version or 0)
+
+    if current_version < version:
+        # Version expired along with the job's redis keys, start over
+        version, offsets = 0, {}
+    offsets = offsets or {}
+
+    changed = {change.decode() for change, changed_in in changes if changed_in > version}
+    if not version:
+        changed.add(job_change())
+
+    # Read after the version, so changes made in between are sent again next time.
+    # Data is only read, decompressed and decoded when it's sent
+    data = job_change() in changed
+    model = JobModel.select(*_job_fields(JobModel, data)).where(JobModel.id == id).get()
+    step_ids = [int(change.split(":")[1]) for change in changed if change != job_change()]
+    steps = StepModel.select().where(
+        (StepModel.job == model.id) & ((StepModel.id << step_ids) | (StepModel.name == "Reload NGINX"))
+    )
+
+    job = model_to_dict(model, exclude=[] if data else [JobModel.data])
+    job["steps"] = [model_to_dict(step, exclude=[StepModel.job]) for step in steps]
+
+    pipeline = redis.pipeline(transaction=False)
+    _queue_job_lookups(pipeline, job)
+    _update_job_from_lookups(job, iter(pipeline.execute()))
+
+    # Offsets are kept relative to the job's key to keep the cursor short
+    prefix = f"agent:job:{model.id}:"
+    lengths = _update_command_outputs(
+        redis,
+        [job],
+        output_offsets={prefix + key: offset for key, offset in offsets.items()},
+    )
+    offsets.update({key[len(prefix) :]: length for key, length in lengths.items()})
+
+    if job_change() not in changed:
+        del job["commands"]
+
+    return {
+        "cursor": encode_job_cursor(current_version, offsets),
+        "version": current_version,
+        "job": job,
+    }
+
+
 @application.route("/jobs/<int:id>/cancel", methods=["POST"])
 def cancel_job(id=None):
     job = AgentJob(id=id)
@@ -1570,13 +1969,16 @@ def get_jobs(limit: int = 100):
 @application.route("/agent-jobs/<int:id>")
 @application.route("/agent-jobs/<string:ids>")
 def agent_jobs(id=None, ids=None):
+    output_offset = request.args.get("offset", type=int)
+    # Job and step data can be large, it's only sent with ?data=1
+    with_data = bool(request.args.get("data", 0, type=int))
     if id:
-        job = to_dict(JobModel.get(JobModel.agent_job_id == id))
+        job = jobs_to_dict([get_job(JobModel.agent_job_id == id, with_data)], output_offset, with_data)[0]
         return jsonify(json.loads(json.dumps(job, default=str)))
 
     if ids:
         ids = ids.split(",")
-        job = list(map(to_dict, JobModel.select().where(JobModel.agent_job_id << ids)))
+        job = jobs_to_dict(select_jobs(JobModel.agent_job_id << ids, with_data), output_offset, with_data)
         return jsonify(json.loads(json.dumps(job, default=str)))
 
     jobs = JobModel.select(JobModel.agent_job_id).order_by(JobModel.id.desc()).limit(100)
@@ -1630,7 +2032,7 @@ def remove_minio_user(username):
 @validate_bench_and_site
 def update_saas_plan(bench, site):
     data = request.json
-    job = Server().benches[bench].sites[site].update_saas_plan(data["plan"])
+    job = Server().get_bench(bench).get_site(site).update_saas_plan(data["plan"])
     return {"job": job}
 
 
@@ -1641,7 +2043,7 @@ def update_saas_plan(bench, site):
 @validate_bench_and_site
 def run_after_migrate_steps(bench, site):
     data = request.json
-    job = Server().benches[bench].sites[site].run_after_migrate_steps_job(data["admin_password"])
+    job = Server().get_bench(bench).get_site(site).run_after_migrate_steps_job(data["admin_password"])
     return {"job": job}
 
 
@@ -1667,7 +2069,7 @@ def move_site_to_bench(bench, site):
 @validate_bench
 def setup_code_server(bench):
     data = request.json
-    job = Server().benches[bench].setup_code_server(**data)
+    job = Server().get_bench(bench).setup_code_server(**data)
 
     return {"job": job}
 
@@ -1676,21 +2078,21 @@ def setup_code_server(bench):
 @validate_bench
 def start_code_server(bench):
     data = request.json
-    job = Server().benches[bench].start_code_server(**data)
+    job = Server().get_bench(bench).start_code_server(**data)
     return {"job": job}
 
 
 @application.route("/benches/<string:bench>/codeserver/stop", methods=["POST"])
 @validate_bench
 def stop_code_server(bench):
-    job = Server().benches[bench].stop_code_server()
+    job = Server().get_bench(bench).stop_code_server()
     return {"job": job}
 
 
 @application.route("/benches/<string:bench>/codeserver/archive", methods=["POST"])
 @validate_bench
 def archive_code_server(bench):
-    job = Server().benches[bench].archive_code_server()
+    job = Server().get_bench(bench).archive_code_server()
     return {"job": job}
 
 
@@ -1700,7 +2102,7 @@ def patch_app(bench, app):
     data = request.json
     job = (
         Server()
-        .benches[bench]
+        .get_bench(bench)
         .patch_app(
             app,
             data["patch"],
@@ -1729,7 +2131,7 @@ def all_exception_handler(error):
 @validate_bench
 def docker_execute(bench: str):
     data = request.json
-    _bench = Server().benches[bench]
+    _bench = Server().get_bench(bench)
     result: ExecuteReturn = _bench.docker_execute(
         command=data.get("command"),
         subdir=data.get("subdir"),
@@ -1747,7 +2149,7 @@ def docker_execute(bench: str):
 @validate_bench
 def call_bench_supervisorctl(bench: str):
     data = request.json
-    _bench = Server().benches[bench]
+    _bench = Server().get_bench(bench)
     job = _bench.call_supervisorctl(
         data["command"],
         data["programs"],
@@ -1786,7 +2188,7 @@ def update_inplace(bench: str):
     sites = request.json.get("sites")
     apps = request.json.get("apps")
     image = request.json.get("image")
-    _bench = Server().benches[bench]
+    _bench = Server().get_bench(bench)
     job = _bench.update_inplace(
         sites,
         image,
@@ -1797,7 +2199,7 @@ def update_inplace(bench: str):
 
 @application.route("/benches/<string:bench>/recover_update_inplace", methods=["POST"])
 def recover_update_inplace(bench: str):
-    _bench = Server().benches[bench]
+    _bench = Server().get_bench(bench)
     job = _bench.recover_update_inplace(
         request.json.get("sites"),
         request.json.get("image"),